@@ -6,6 +6,7 @@ import aiohttp
 import asyncio
 import logging
 from database import get_shortener_link_async
+from http_client import start_http_client, get_http_session, close_http_client
 
 # Configure logging to capture errors and info
 logging.basicConfig(level=logging.INFO)
@@ -13,6 +14,14 @@ logger = logging.getLogger(__name__)
 
 app = Quart(__name__)
 
+@app.before_serving
+async def open_http_client():
+    await start_http_client()
+
+@app.after_serving
+async def shutdown_http_client():
+    await close_http_client()
+
 async def resolve_final_url(start_url: str) -> str:
     """
     Follows redirects to find the final destination URL server-side.
@@ -36,16 +45,16 @@ async def resolve_final_url(start_url: str) -> str:
             "Accept-Language": "en-US,en;q=0.5"
         }
 
-        # Use aiohttp to follow redirects asynchronously
-        async with aiohttp.ClientSession(headers=headers) as session:
-            # We use GET because some shorteners block HEAD requests.
-            # allow_redirects=True is default, but explicit is better.
-            # Timeout is critical to prevent hanging the request.
-            timeout = aiohttp.ClientTimeout(total=10)
-            async with session.get(start_url, allow_redirects=True, timeout=timeout) as response:
-                final_url = str(response.url)
-                logger.info(f"Resolved URL: {start_url} -> {final_url}")
-                return final_url
+        # Use the shared aiohttp session to follow redirects asynchronously
+        session = await get_http_session()
+        # We use GET because some shorteners block HEAD requests.
+        # allow_redirects=True is default, but explicit is better.
+        # Timeout is critical to prevent hanging the request.
+        timeout = aiohttp.ClientTimeout(total=10)
+        async with session.get(start_url, headers=headers, allow_redirects=True, timeout=timeout) as response:
+            final_url = str(response.url)
+            logger.info(f"Resolved URL: {start_url} -> {final_url}")
+            return final_url
 
     except Exception as e:
         logger.error(f"Error resolving URL {start_url}: {e}")
@@ -0,0 +1,57 @@
+import heapq
+from time import time as tm
+
+
+class BanRegistry:
+    """
+    Active bans held in memory: ban_until by user id, plus a min-heap on
+    ban_until so the bans that ran out are found without scanning them all.
+    A user banned again keeps their old heap entry; it is skipped when popped.
+    """
+
+    def __init__(self):
+        self._bans = {}
+        self._heap = []
+
+    def load(self, bans):
+        """Replaces the registry with (user_id, ban_until) pairs read from the database."""
+        self._bans = dict(bans)
+        self._heap = [(ban_until, user_id) for user_id, ban_until in self._bans.items()]
+        heapq.heapify(self._heap)
+
+    def ban(self, user_id, ban_until):
+        self._bans[user_id] = ban_until
+        heapq.heappush(self._heap, (ban_until, user_id))
+
+    def unban(self, user_id):
+        self._bans.pop(user_id, None)
+
+    def ban_until(self, user_id):
+        return self._bans.get(user_id, 0)
+
+    def is_banned(self, user_id):
+        return tm() < self._bans.get(user_id, 0)
+
+    def _drop_stale(self):
+        while self._heap and self._bans.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def next_expiry(self):
+        """The earliest ban_until still in the registry, or None."""
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_expired(self):
+        """Removes the bans that ran out and returns their user ids."""
+        now = tm()
+        expired = []
+        self._drop_stale()
+        while self._heap and self._heap[0][0] <= now:
+            _, user_id = heapq.heappop(self._heap)
+            del self._bans[user_id]
+            expired.append(user_id)
+            self._drop_stale()
+        return expired
+
+    def __len__(self):
+        return len(self._bans)
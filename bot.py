@@ -1,31 +1,34 @@
 # Version 1.1 - Added User Channel Feature
 import uvloop
 import asyncio
+import io
 import uuid
 import sys
-import hashlib
 from time import time as tm
 from asyncio import create_subprocess_exec, gather
 from pyrogram.types import User
 from pyrogram import Client, enums, filters
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from pyrogram.errors import FloodWait, UserIsBlocked, InputUserDeactivated, WebpageCurlFailed, WebpageMediaEmpty, MessageNotModified, UserNotParticipant
-from asyncio import Queue
 from config import *
 from utils import *
-from tmdb import get_by_name
+from tmdb import get_by_name, get_tmdb_cache_stats, tmdb_cache_key
+from release_parser import parse_release, parser_cache_stats
+from http_client import start_http_client, close_http_client, get_http_stats
 from shorterner import shorten_url
 from system_stats import get_system_stats
+from ingest import AdaptiveRateLimiter, LaneQueue, IngestPipeline, Stage, GroupingWindow, IngestJournal
+from fingerprint import compute_fingerprint, find_fingerprint, fingerprint_lookup_stats
+from cover_art import extract_cover_art, cover_art_stats
+from scheduler import deletion_scheduler
+from user_session import UserSessionStore
 from database import (
-    add_user, del_user, full_userbase, present_user,
-    ban_user, is_user_banned, unban_user,
-    get_bypass_attempts, increment_bypass_attempts,
-    update_user_data, get_user_data, increment_file_count, load_all_user_data,
+    del_user, full_userbase, claim_file_quota, load_ban_registry, expire_bans, ban_registry,
     reset_daily_stats_v2, save_shortener_link, get_dynamic_config, update_dynamic_config,
-    get_expired_users, increment_verified_today, increment_files_shared_today, get_daily_stats,
-    get_inactive_unverified_users, delete_users_bulk, add_processed_file, is_file_processed, ensure_indexes,
+    get_expired_users, increment_verified_today, increment_files_shared_today, get_daily_stats, flush_daily_stats, DAILY_STATS_FLUSH_INTERVAL,
+    get_inactive_unverified_users, delete_users_bulk, build_processed_file_document, add_processed_file_document, confirm_processed_file, discard_processed_file, is_file_processed, find_processed_batch, ensure_indexes,
     remove_processed_file_by_caption, remove_processed_file_by_id_or_hash, remove_any_duplicate,
-    get_db_stats, clean_db
+    get_db_stats, clean_db, load_dedup_filter, get_file_reference, save_file_reference, forget_file_references
 )
 import urllib.parse
 from datetime import datetime, timedelta, timezone, time
@@ -35,10 +38,15 @@ asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 loop = asyncio.new_event_loop()
 asyncio.set_event_loop(loop)
 
-# Define an async queue to handle messages sequentially
-message_queue = Queue()
+# Ingest queue with weighted lanes: live uploads first, backfills and retries keep moving
+message_queue = LaneQueue({'live': INGEST_LIVE_WEIGHT, 'backfill': INGEST_BACKFILL_WEIGHT, 'maintenance': 1})
 
-user_data = {}
+# Shared token bucket for ingest, slowed down by every FloodWait seen by the bot
+ingest_limiter = AdaptiveRateLimiter(INGEST_RATE, INGEST_WORKERS)
+flood_wait_listeners.append(ingest_limiter.report_flood_wait)
+
+# Users are read through cached sessions (user document, ban and channel in one lookup)
+user_sessions = UserSessionStore(maxsize=USER_CACHE_SIZE)
 bot_config = {}
 bot_start_time = tm()
 
@@ -59,9 +67,9 @@ def clean_force_sub_url(url_str):
 # PROGRAM BOT INITIALIZATION 
 
 async def load_initial_data():
-    global user_data, bot_config
+    global bot_config
     await ensure_indexes()
-    user_data = await load_all_user_data()
+    await load_ban_registry()
 
     # Load dynamic config
     db_config = await get_dynamic_config()
@@ -84,7 +92,7 @@ async def load_initial_data():
         'detect': str(db_config.get('detect', detect)).lower() in ('true', '1', 't')
     }
 
-    logger.info("Successfully loaded all user data and dynamic config from the database.")
+    logger.info("Successfully loaded dynamic config from the database.")
 
 bot = Client(
     "bot",
@@ -98,6 +106,76 @@ bot = Client(
 bot_loop = bot.loop
 bot_username = bot.me.username
 
+# Delivery references of recently requested files by DB_CHANNEL message id
+delivery_cache = LRUCache(maxsize=1024, ttl=6 * 60 * 60)
+
+async def get_delivery_reference(message_id, refresh=False):
+    """
+    Returns {'file_id', 'caption'} for a DB_CHANNEL file: from memory, then from its
+    processed_files record, and only then by fetching the channel message.
+    """
+    if not refresh:
+        reference = delivery_cache.get(message_id, None)
+        if reference:
+            return reference
+        doc = await get_file_reference(message_id)
+        if doc and doc.get('file_id'):
+            reference = {'file_id': doc['file_id'], 'caption': doc.get('caption_html') or ""}
+            delivery_cache.set(message_id, reference)
+            return reference
+
+    file_message = await safe_api_call(lambda: bot.get_messages(DB_CHANNEL_ID, message_id))
+    media = file_message and (file_message.video or file_message.audio or file_message.document)
+    if not media:
+        if file_message is not None and file_message.empty:
+            # The channel post is gone; its stored file_id must not be served any more
+            await forget_delivery_references([message_id])
+        else:
+            delivery_cache.pop(message_id)
+        return None
+
+    file_type = 'video' if file_message.video else 'audio' if file_message.audio else 'document'
+    reference = {'file_id': media.file_id, 'caption': file_message.caption.html if file_message.caption else ""}
+    delivery_cache.set(message_id, reference)
+    try:
+        # Records ingested before file_id was stored get it now
+        await save_file_reference(message_id, media.file_id, file_type, reference['caption'])
+    except Exception as e:
+        logger.warning(f"Could not save file reference for message {message_id}: {e}")
+    return reference
+
+async def forget_delivery_references(message_ids):
+    """Stops delivering DB_CHANNEL files whose post was deleted."""
+    for message_id in message_ids:
+        delivery_cache.pop(message_id)
+    try:
+        await forget_file_references(message_ids)
+    except Exception as e:
+        logger.warning(f"Could not drop the file references of messages {message_ids}: {e}")
+
+@bot.on_deleted_messages(filters.chat(DB_CHANNEL_ID))
+async def db_channel_deleted(client, messages):
+    await forget_delivery_references([message.id for message in messages])
+
+async def deliver_file(message_id, reference, chat_id, warning, protect_content):
+    """Sends a file by its stored file_id, refetching the DB_CHANNEL message once if the reference went stale."""
+    async def send(reference):
+        caption = await remove_extension(reference['caption'])
+        return await safe_api_call(lambda: bot.send_cached_media(
+            chat_id=chat_id,
+            file_id=reference['file_id'],
+            caption=f"<b>{caption}</b>{warning}",
+            parse_mode=enums.ParseMode.HTML,
+            protect_content=protect_content
+        ))
+
+    sent = await send(reference)
+    if sent is None:
+        reference = await get_delivery_reference(message_id, refresh=True)
+        if reference:
+            sent = await send(reference)
+    return sent
+
 @bot.on_message(filters.private & filters.command("start"))
 async def start_command(client, message):
     try:
@@ -106,13 +184,8 @@ async def start_command(client, message):
         if not await check_force_sub(client, message, user_id):
             return
 
-        if not await present_user(user_id):
-            try:
-                await add_user(user_id)
-            except:
-                pass
-        
-        if await is_user_banned(user_id):
+        session = await user_sessions.get(user_id, create=True)
+        if session.is_banned:
             await message.reply_text("You are currently banned from using this bot. Please try again later.")
             return
 
@@ -142,8 +215,8 @@ async def start_command(client, message):
                 msg = await safe_api_call(lambda: bot.get_messages(LOG_CHANNEL_ID, tut_id))
                 sent_msg = await safe_api_call(lambda: msg.copy(chat_id=message.chat.id))
                 await safe_api_call(lambda: message.delete())
-                await asyncio.sleep(300)
-                await safe_api_call(lambda: sent_msg.delete())
+                if sent_msg:
+                    await deletion_scheduler.schedule(sent_msg.chat.id, [sent_msg.id], 300)
                 return
 
             # Handle limit extension verification
@@ -151,21 +224,16 @@ async def start_command(client, message):
                 input_token = command_arg[10:]
 
                 # Check if user exists
-                udata = user_data.get(user_id)
-                if not udata:
-                     udata = await get_user_data(user_id)
-                     if udata: user_data[user_id] = udata
-
-                if not udata:
+                if not session.exists:
                     reply = await safe_api_call(lambda: message.reply_text("User data not found. Please /start first."))
                     await auto_delete_message(message, reply)
                     return
 
                 # Verify token
-                stored_token = udata.get('token')
+                stored_token = session.token
                 if input_token == stored_token:
                     # Check Max Extensions
-                    current_stage = udata.get('extension_stage', 0)
+                    current_stage = session.extension_stage
                     if current_stage >= 2:
                         reply = await safe_api_call(lambda: message.reply_text("You have reached the maximum extension limit for this session. ❌"))
                         await auto_delete_message(message, reply)
@@ -179,11 +247,7 @@ async def start_command(client, message):
                         'file_count': 0,
                         'extension_stage': new_stage
                     }
-                    await update_user_data(user_id, update_payload)
-
-                    # Update local cache
-                    user_data[user_id]['file_count'] = 0
-                    user_data[user_id]['extension_stage'] = new_stage
+                    await user_sessions.update(user_id, update_payload)
 
                     success_msg = (
                         f"<b>Limit Extended! 🚀</b>\n\n"
@@ -204,19 +268,18 @@ async def start_command(client, message):
             if command_arg.startswith("token_"):
                 input_token = command_arg[6:]
                 
-                if user_data.get(user_id, {}).get('status') == 'verified':
+                if session.status == 'verified':
                     reply = await safe_api_call(lambda: message.reply_text("You are already verified! ✅"))
                     await auto_delete_message(message, reply)
                     return
 
                 # Bypass detection logic
-                if user_id in user_data and 'inittime' in user_data[user_id]:
-                    inittime = user_data[user_id]['inittime']
+                if session.exists:
+                    inittime = session.inittime
                     duration = tm() - inittime
                     min_duration = bot_config.get('MINIMUM_DURATION', MINIMUM_DURATION)
                     if min_duration and (duration < min_duration):
-                        await increment_bypass_attempts(user_id)
-                        attempts = await get_bypass_attempts(user_id)
+                        attempts = await user_sessions.add_bypass_attempt(user_id)
 
                         ban_duration = 0
                         ban_message = ""
@@ -248,11 +311,10 @@ async def start_command(client, message):
                             ban_duration = 24 * 60 * 60  # 1 day
                             ban_message = "BANNED for 1 Day"
 
-                        await ban_user(user_id, ban_duration)
+                        await user_sessions.ban(user_id, ban_duration)
                         
                         # Reset user data in database after banning
-                        await update_user_data(user_id, {'status': 'unverified', 'time': 0, 'file_count': 0})
-                        user_data[user_id] = await get_user_data(user_id) # Refresh local cache
+                        await user_sessions.update(user_id, {'status': 'unverified', 'time': 0, 'file_count': 0})
 
                         log_message = (
                             f"User🕵️‍♂️{user_link} with 🆔 {user_id} @{bot_username} "
@@ -282,17 +344,24 @@ async def start_command(client, message):
             if not await check_access(message, user_id):
                 return
 
-            file_message = await safe_api_call(lambda: bot.get_messages(DB_CHANNEL_ID, file_id))
-            media = file_message.video or file_message.audio or file_message.document
-            if media:
-                caption = await remove_extension(file_message.caption.html or "")
+            file_reference = await get_delivery_reference(file_id)
+            if file_reference:
+                # Count the file before sending it, so concurrent clicks cannot go past the limit
+                daily_limit = bot_config.get('DAILY_LIMIT', DAILY_LIMIT)
+                current_count = await claim_file_quota(user_id, daily_limit)
+                if current_count is None:
+                    session.apply({'file_count': daily_limit})
+                    await send_limit_reached(message, user_id, session)
+                    return
+                session.apply({'file_count': current_count})
+                await increment_files_shared_today() # Buffered, written by daily_stats_flusher
 
                 # Check for User Target Channel
                 target_chat_id = message.chat.id
                 protect_content = bot_config.get('PROTECT_CONTENT', False)
                 auto_delete_time = bot_config.get('AUTO_DELETE_TIME', 60)
 
-                user_channel_id = user_data.get(user_id, {}).get('user_channel_id')
+                user_channel_id = session.user_channel_id
                 if user_channel_id:
                     try:
                         # Validate if bot is still admin/member of that channel
@@ -308,36 +377,20 @@ async def start_command(client, message):
                     warning = f"\n\n<b>⚠️ This file will be deleted in {auto_delete_time} seconds!</b>"
 
                 try:
-                    copy_message = await safe_api_call(lambda: file_message.copy(
-                        chat_id=target_chat_id,
-                        caption=f"<b>{caption}</b>{warning}",
-                        parse_mode=enums.ParseMode.HTML,
-                        protect_content=protect_content
-                    ))
+                    copy_message = await deliver_file(file_id, file_reference, target_chat_id, warning, protect_content)
                 except Exception as e:
                      # Fallback to DM if channel delivery fails (e.g. bot removed from channel)
                      logger.warning(f"Failed to send to user channel {user_channel_id}: {e}. Falling back to DM.")
                      target_chat_id = message.chat.id
                      protect_content = bot_config.get('PROTECT_CONTENT', False)
                      warning = f"\n\n<b>⚠️ This file will be deleted in {auto_delete_time} seconds!</b>"
-                     copy_message = await safe_api_call(lambda: file_message.copy(
-                        chat_id=target_chat_id,
-                        caption=f"<b>{caption}</b>{warning}",
-                        parse_mode=enums.ParseMode.HTML,
-                        protect_content=protect_content
-                    ))
-
-                await increment_file_count(user_id)
-                await increment_files_shared_today() # New line to track daily file shares
-                user_data[user_id]['file_count'] += 1
+                     copy_message = await deliver_file(file_id, file_reference, target_chat_id, warning, protect_content)
 
                 # Notify user in DM if sent to channel
                 if target_chat_id != message.chat.id:
-                     await safe_api_call(lambda: message.reply_text(f"✅ File sent to your channel: <b>{user_data[user_id].get('user_channel_name')}</b>", parse_mode=enums.ParseMode.HTML))
+                     await safe_api_call(lambda: message.reply_text(f"✅ File sent to your channel: <b>{session.user_channel_name}</b>", parse_mode=enums.ParseMode.HTML))
 
                 # File Limit Warning Logic
-                daily_limit = bot_config.get('DAILY_LIMIT', DAILY_LIMIT)
-                current_count = user_data[user_id]['file_count']
                 warning_threshold = int(daily_limit * 0.8)
 
                 if current_count == warning_threshold:
@@ -371,9 +424,50 @@ async def start_command(client, message):
 
 @bot.on_message(filters.chat(DB_CHANNEL_ID) & (filters.document | filters.video | filters.audio | filters.sticker))
 async def handle_new_message(client, message):
-    # Add the message to the queue for sequential processing
-    await message_queue.put(message)
+    # Journal the message so it survives restarts, then queue it for the ingest workers
+    await ingest_journal.add_live(message)
     
+async def report_index_progress(status_msg, first_id, last_id, interval=15, stall_timeout=1800):
+    """Edits the /index status message with the journal progress of the range until it is done."""
+    total = last_id - first_id + 1
+    started = tm()
+    last_done, last_change = 0, started
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            counts = await ingest_journal.stats(first_id, last_id)
+        except Exception as e:
+            logger.error(f"Could not read index progress: {e}")
+            continue
+
+        done = sum(counts.get(state, 0) for state in ('published', 'duplicate', 'failed', 'skipped'))
+        now = tm()
+        if done != last_done:
+            last_done, last_change = done, now
+        rate = done / (now - started)
+        eta = get_readable_time(int((total - done) / rate)) if rate and done < total else "N/A"
+        finished = done >= total
+        stalled = now - last_change > stall_timeout
+
+        text = (
+            f"{'✅ <b>Indexing Complete</b>' if finished else '⏳ <b>Indexing</b>'} "
+            f"<code>{first_id}</code> → <code>{last_id}</code>\n\n"
+            f"<b>Progress:</b> <code>{done}/{total}</code> ({done / total:.0%})\n"
+            f"<b>Published:</b> <code>{counts.get('published', 0)}</code> | <b>Duplicates:</b> <code>{counts.get('duplicate', 0)}</code>\n"
+            f"<b>Skipped:</b> <code>{counts.get('skipped', 0)}</code> | <b>Failed:</b> <code>{counts.get('failed', 0)}</code>\n"
+            f"<b>Speed:</b> <code>{rate * 60:.1f}</code> msgs/min | <b>ETA:</b> <code>{eta}</code>"
+        )
+        if stalled and not finished:
+            text += "\n\n⚠️ No progress for 30 minutes, status updates stopped. Check /ingest."
+        try:
+            await status_msg.edit_text(text)
+        except MessageNotModified:
+            pass
+        except Exception as e:
+            logger.warning(f"Could not update index progress: {e}")
+        if finished or stalled:
+            return
+
 @bot.on_message(filters.private & filters.command("index") & filters.user(OWNER_ID))
 async def handle_file(client, message):
     try:
@@ -383,26 +477,17 @@ async def handle_file(client, message):
         async def get_user_input(prompt):
             bot_message = await message.reply_text(prompt)
             user_message = await bot.listen(chat_id=message.chat.id, filters=filters.user(OWNER_ID))
-            asyncio.create_task(auto_delete_message(bot_message, user_message))
+            await deletion_scheduler.schedule(message.chat.id, [bot_message.id, user_message.id], 10)
             return await extract_tg_link(user_message.text.strip())
 
-        async def auto_delete_message(bot_message, user_message):
-            await asyncio.sleep(10)
-            await bot_message.delete()
-            await user_message.delete()
-
         # Get the start and end message IDs
         start_msg_id = int(await get_user_input("Send first msg link"))
         end_msg_id = int(await get_user_input("Send end msg link"))
 
-        batch_size = 199
-
-        for start in range(int(start_msg_id), int(end_msg_id) + 1, batch_size):            
-            end = min(start + batch_size - 1, int(end_msg_id))
-            file_messages = await bot.get_messages(DB_CHANNEL_ID, range(start, end + 1))
-
-            for file_message in file_messages:
-                await message_queue.put(file_message)
+        # Messages are journaled and fetched in batches by the journal feeder as the workers drain the queue
+        queued = await ingest_journal.add_range(range(start_msg_id, end_msg_id + 1))
+        status_msg = await message.reply_text(f"✅ Queued {queued} messages for indexing. Progress survives restarts, this message is updated as files are processed.")
+        asyncio.create_task(report_index_progress(status_msg, start_msg_id, end_msg_id))
 
     except Exception as e:
         await message.reply_text(f"An error occurred: {e}")
@@ -463,59 +548,25 @@ async def remove_duplicate_command(client, message):
         content_hash = None
         hash_middle = None
         hash_end = None
-        file_size = media.file_size or 0
+        fingerprint_key = None
 
-        # Only compute hash for videos and documents (same logic as process_message)
+        # Only compute hash for videos and documents (same logic as fingerprint_stage)
         if (media_msg.video or media_msg.document) and bot_config.get('HASH_CALCULATION', True):
-            status_msg = await message.reply_text("Computing hashes for removal...")
-
-            hash_parts_config = str(bot_config.get('HASH_PARTS', "1,2,3"))
-            parts = [int(p.strip()) for p in hash_parts_config.split(',') if p.strip().isdigit()]
-
-            hash_retries = 3
-            for attempt in range(hash_retries):
-                try:
-                    total_chunks = (file_size + (1024 * 1024) - 1) // (1024 * 1024)
-                    processed_parts = 0
-
-                    if 1 in parts:
-                        async for chunk in client.stream_media(media_msg, offset=0, limit=1):
-                            if chunk: content_hash = hashlib.sha256(chunk).hexdigest()
-                            break
-                        processed_parts += 1
-
-                    if 2 in parts:
-                        if processed_parts > 0: await asyncio.sleep(10)
-                        offset = total_chunks // 2 if total_chunks > 0 else 0
-                        async for chunk in client.stream_media(media_msg, offset=offset, limit=1):
-                            if chunk: hash_middle = hashlib.sha256(chunk).hexdigest()
-                            break
-                        processed_parts += 1
-
-                    if 3 in parts:
-                        if processed_parts > 0: await asyncio.sleep(10)
-                        offset = total_chunks - 1 if total_chunks > 0 else 0
-                        async for chunk in client.stream_media(media_msg, offset=offset, limit=1):
-                            if chunk: hash_end = hashlib.sha256(chunk).hexdigest()
-                            break
-                        processed_parts += 1
-
-                    break # Success
-                except FloodWait as e:
-                    if attempt < hash_retries - 1:
-                        wait_time = e.value + 5
-                        logger.warning(f"FloodWait removal hash. Sleeping {wait_time}s. Attempt {attempt + 1}/{hash_retries}")
-                        await asyncio.sleep(wait_time)
-                    else:
-                        logger.error(f"Could not compute hash for removal after retries: {e}")
-                except Exception as e:
-                    logger.error(f"Could not compute hash for removal: {e}")
-                    break
-            await status_msg.delete()
+            # Hashes stored at ingest (or computed recently) make re-streaming the file unnecessary
+            fingerprint = await find_fingerprint(file_unique_id)
+            if fingerprint is None:
+                status_msg = await message.reply_text("Computing hashes for removal...")
+                fingerprint = await compute_fingerprint(client, media_msg, bot_config.get('HASH_PARTS', "1,2,3"))
+                if fingerprint.error:
+                    logger.error(f"Could not compute hash for removal: {fingerprint.error}")
+                await status_msg.delete()
+            content_hash, hash_middle, hash_end = fingerprint.content_hash, fingerprint.hash_middle, fingerprint.hash_end
+            fingerprint_key = fingerprint.key
 
         try:
-            deleted_count = await remove_processed_file_by_id_or_hash(file_unique_id, content_hash, hash_middle, hash_end)
+            deleted_count = await remove_processed_file_by_id_or_hash(file_unique_id, content_hash, hash_middle, hash_end, fingerprint_key)
             if deleted_count > 0:
+                delivery_cache.clear() # Removed records may back cached delivery references
                 await message.reply_text(f"✅ Successfully removed {deleted_count} record(s) matching this file (ID/Hash).")
             else:
                 await message.reply_text("⚠️ No records found matching this file's unique ID or hash.")
@@ -543,6 +594,7 @@ async def remove_duplicate_command(client, message):
         deleted_count = await remove_any_duplicate(arg_to_remove)
 
         if deleted_count > 0:
+            delivery_cache.clear() # Removed records may back cached delivery references
             response = f"✅ Successfully removed {deleted_count} record(s) matching: <code>{arg_to_remove}</code>."
             logger.info(f"Admin manually removed duplicate record for arg: {arg_to_remove}")
         else:
@@ -589,10 +641,12 @@ async def send_text(client, message):
             except UserIsBlocked:
                 logger.info(f"User {chat_id} is blocked. Removing from DB.")
                 await del_user(chat_id)
+                user_sessions.invalidate(chat_id)
                 blocked += 1
             except InputUserDeactivated:
                 logger.info(f"User {chat_id} is deactivated. Removing from DB.")
                 await del_user(chat_id)
+                user_sessions.invalidate(chat_id)
                 deleted += 1
             except Exception as e:
                 logger.error(f"Failed to send message to {chat_id}: {e}")
@@ -664,6 +718,62 @@ async def get_stats(client, message):
     except MessageNotModified:
         pass # Ignore if the message content is the same
 
+@bot.on_message(filters.command('ingest') & filters.private & filters.user(OWNER_ID))
+async def ingest_stats_command(client, message):
+    stats = ingest_pipeline.stats()
+    journal = await ingest_journal.stats()
+    tmdb = get_tmdb_cache_stats()
+    http = get_http_stats()
+    parser = parser_cache_stats()
+    sessions = user_sessions.stats()
+    deletions = deletion_scheduler.stats()
+    lanes = "\n".join(
+        f"<b>{name.title()}</b> (x{lane['weight']}): <code>{lane['depth']}</code> waiting, avg wait <code>{get_readable_time(int(lane['avg_wait']))}</code>, oldest <code>{get_readable_time(int(lane['oldest_wait']))}</code>"
+        for name, lane in stats['lanes'].items()
+    )
+    stages = "\n".join(
+        f"<b>{stage['name'].title()}:</b> <code>{stage['active']}/{stage['workers']}</code> active, <code>{stage['queued']}</code> queued, <code>{stage['processed']}</code> done"
+        for stage in stats['stages']
+    )
+
+    stats_text = (
+        "⚙️ <b>INGEST STATISTICS</b> ⚙️\n\n"
+        f"<b>Queued Files:</b> <code>{stats['queued']}</code>\n"
+        f"<b>Active Workers:</b> <code>{stats['active']}</code> (Throttled Stages: {stats['concurrency']} max)\n"
+        f"<b>In Flight:</b> <code>{stats['in_flight']}/{stats['max_in_flight']}</code> files\n"
+        f"<b>Throughput:</b> <code>{stats['files_per_minute']}</code> files/min\n"
+        f"<b>Rate Limit:</b> <code>{stats['rate']:.1f}/{stats['max_rate']}</code> files/min\n"
+        f"<b>FloodWaits:</b> <code>{stats['flood_waits']}</code> (Last: {stats['last_flood_wait']}s)\n"
+        f"<b>Processed:</b> <code>{stats['processed']}</code> | <b>Failed:</b> <code>{stats['failed']}</code>\n\n"
+        "<b>Lanes</b>\n"
+        f"{lanes}\n\n"
+        "<b>Stages</b>\n"
+        f"{stages}\n"
+        f"<b>Grouped Posts:</b> <code>{publish_grouper.groups_posted}</code> ({publish_grouper.jobs_grouped} files)\n\n"
+        "<b>Fingerprints</b>\n"
+        f"<b>Memory Hits:</b> <code>{fingerprint_lookup_stats['memory_hits']}</code> | <b>DB Hits:</b> <code>{fingerprint_lookup_stats['db_hits']}</code> | <b>Computed:</b> <code>{fingerprint_lookup_stats['computed']}</code>\n\n"
+        "<b>Journal</b>\n"
+        f"<b>Pending:</b> <code>{journal.get('pending', 0)}</code> | <b>In Progress:</b> <code>{journal.get('leased', 0) + journal.get('hashing', 0)}</code>\n"
+        f"<b>Published:</b> <code>{journal.get('published', 0)}</code> | <b>Duplicates:</b> <code>{journal.get('duplicate', 0)}</code> | <b>Skipped:</b> <code>{journal.get('skipped', 0)}</code> | <b>Failed:</b> <code>{journal.get('failed', 0)}</code>\n\n"
+        "<b>TMDB Cache</b>\n"
+        f"<b>Hit Rate:</b> <code>{tmdb['hit_rate']:.1%}</code> ({tmdb['memory_entries']} in memory)\n"
+        f"<b>Memory Hits:</b> <code>{tmdb['memory_hits']}</code> | <b>DB Hits:</b> <code>{tmdb['db_hits']}</code> | <b>Shared:</b> <code>{tmdb['coalesced']}</code>\n"
+        f"<b>Misses:</b> <code>{tmdb['misses']}</code> | <b>No Match (Cached):</b> <code>{tmdb['negative_hits']}</code> | <b>Errors:</b> <code>{tmdb['errors']}</code>\n"
+        f"<b>Caption Parser Hit Rate:</b> <code>{parser['hit_rate']:.1%}</code> ({parser['size']} cached)\n\n"
+        "<b>User Sessions</b>\n"
+        f"<b>Hit Rate:</b> <code>{sessions['hit_rate']:.1%}</code> ({sessions['cached']} cached)\n"
+        f"<b>Hits:</b> <code>{sessions['hits']}</code> | <b>Loads:</b> <code>{sessions['misses']}</code>\n\n"
+        "<b>Scheduled Deletions</b>\n"
+        f"<b>Pending:</b> <code>{deletions['pending']}</code> | <b>Deleted:</b> <code>{deletions['deleted']}</code> ({deletions['batches']} batches) | <b>Failed:</b> <code>{deletions['failed']}</code>\n\n"
+        "<b>HTTP Client</b>\n"
+        f"<b>Requests:</b> <code>{http['requests']}</code> | <b>Connection Reuse:</b> <code>{http['reuse_rate']:.1%}</code>\n"
+        f"<b>New Connections:</b> <code>{http['new_connections']}</code> | <b>DNS Cache Hits:</b> <code>{http['dns_cache_hits']}/{http['dns_cache_hits'] + http['dns_cache_misses']}</code>\n\n"
+        "<b>Audio Cover Art</b>\n"
+        f"<b>Header Reads:</b> <code>{cover_art_stats['range_reads']}</code> | <b>Full Downloads:</b> <code>{cover_art_stats['full_downloads']}</code>\n"
+        f"<b>Downloaded:</b> <code>{humanbytes(cover_art_stats['bytes_read'])}</code> | <b>Saved:</b> <code>{humanbytes(cover_art_stats['bytes_saved'])}</code>"
+    )
+    await message.reply_text(stats_text)
+
 @bot.on_message(filters.command("log") & filters.user(OWNER_ID))
 async def log_command(client, message):
     user_id = message.from_user.id
@@ -679,7 +789,7 @@ async def unban_command(client, message):
     try:
         if len(message.command) > 1:
             user_id_to_unban = int(message.command[1])
-            await unban_user(user_id_to_unban)
+            await user_sessions.unban(user_id_to_unban)
             await message.reply_text(f"User {user_id_to_unban} has been unbanned.")
 
             # Notify the unbanned user
@@ -697,20 +807,15 @@ async def unban_command(client, message):
 @bot.on_message(filters.command(["me", "status"]) & filters.private)
 async def my_status(client, message):
     user_id = message.from_user.id
-    udata = user_data.get(user_id)
-
-    if not udata:
-        udata = await get_user_data(user_id)
-        if udata:
-            user_data[user_id] = udata
+    session = await user_sessions.get(user_id)
 
-    if not udata:
+    if not session.exists:
         await message.reply_text("User data not found. Please /start the bot first.")
         return
 
-    status = udata.get('status', 'unverified')
-    file_count = udata.get('file_count', 0)
-    token_time = udata.get('time', 0)
+    status = session.status
+    file_count = session.file_count
+    token_time = session.time
 
     daily_limit = bot_config.get('DAILY_LIMIT', DAILY_LIMIT)
     token_timeout = bot_config.get('TOKEN_TIMEOUT', TOKEN_TIMEOUT)
@@ -773,6 +878,10 @@ async def clean_db_command(client, message):
     msg = await message.reply_text(f"🧹 Cleaning <b>{target}</b> data... Please wait.", parse_mode=enums.ParseMode.HTML)
 
     result = await clean_db(target)
+    if target in ('files', 'all'):
+        delivery_cache.clear()
+    if target in ('users', 'all'):
+        user_sessions.clear()
 
     await msg.edit(result)
 
@@ -952,6 +1061,7 @@ async def settings_callback(client, callback_query):
 @bot.on_callback_query(filters.regex("^restart_bot"))
 async def restart_callback(client, callback_query):
     await callback_query.answer("Restarting...", show_alert=True)
+    await stop_ingest()
     os.system("python3 update.py")
     os.execl(sys.executable, sys.executable, "bot.py")
 
@@ -962,14 +1072,10 @@ async def close_settings_callback(client, callback_query):
 @bot.on_callback_query(filters.regex("^manage_user_channel"))
 async def manage_user_channel_callback(client, callback_query):
     user_id = callback_query.from_user.id
-    udata = user_data.get(user_id)
-
-    if not udata:
-         udata = await get_user_data(user_id)
-         if udata: user_data[user_id] = udata
+    session = await user_sessions.get(user_id)
 
-    current_channel_id = udata.get('user_channel_id')
-    current_channel_name = udata.get('user_channel_name', 'Unknown')
+    current_channel_id = session.user_channel_id
+    current_channel_name = session.user_channel_name or 'Unknown'
 
     if current_channel_id:
         text = (
@@ -1062,13 +1168,7 @@ async def manage_user_channel_callback(client, callback_query):
                          'user_channel_id': chat.id,
                          'user_channel_name': chat.title
                      }
-                     await update_user_data(user_id, update_payload)
-
-                     # Update local cache
-                     if user_id in user_data:
-                         user_data[user_id].update(update_payload)
-                     else:
-                         user_data[user_id] = await get_user_data(user_id)
+                     await user_sessions.update(user_id, update_payload)
 
                      await msg.delete()
                      success_msg = await user_response.reply_text(f"✅ Channel <b>{chat.title}</b> linked successfully!")
@@ -1103,20 +1203,12 @@ async def remove_user_channel_callback(client, callback_query):
     user_id = callback_query.from_user.id
 
     # Retrieve info before deletion for logging
-    udata = user_data.get(user_id)
-    if not udata:
-         udata = await get_user_data(user_id)
-
-    channel_name = udata.get('user_channel_name', 'Unknown') if udata else 'Unknown'
-    channel_id = udata.get('user_channel_id', 'Unknown') if udata else 'Unknown'
+    session = await user_sessions.get(user_id)
+    channel_name = session.user_channel_name or 'Unknown'
+    channel_id = session.user_channel_id or 'Unknown'
 
     # Remove from DB using $unset
-    await update_user_data(user_id, {'$unset': {'user_channel_id': "", 'user_channel_name': ""}})
-
-    # Update local cache
-    if user_id in user_data:
-        user_data[user_id].pop('user_channel_id', None)
-        user_data[user_id].pop('user_channel_name', None)
+    await user_sessions.update(user_id, {'$unset': {'user_channel_id': "", 'user_channel_name': ""}})
 
     await callback_query.message.edit_text("✅ Channel removed. Files will be sent to your DM.")
 
@@ -1135,15 +1227,8 @@ async def verify_command(client, message):
         if len(message.command) > 1:
             user_id_to_verify = int(message.command[1])
 
-            # Check if user exists (optional, but good practice)
-            if not await present_user(user_id_to_verify):
-                # If user doesn't exist, we might want to add them or just warn.
-                # For now, let's just warn as verifying a non-existent user might be weird.
-                # But to be safe, we can try to add then verify.
-                try:
-                    await add_user(user_id_to_verify)
-                except:
-                    pass
+            # Users who never started the bot are added, then verified
+            await user_sessions.get(user_id_to_verify, create=True)
 
             current_time = tm()
             # Determine token (dummy token for manual verification)
@@ -1157,14 +1242,7 @@ async def verify_command(client, message):
                 "inittime": current_time
             }
 
-            await update_user_data(user_id_to_verify, new_data)
-
-            # Update local cache if available
-            if user_id_to_verify in user_data:
-                 user_data[user_id_to_verify] = {**user_data.get(user_id_to_verify, {}), **new_data}
-            else:
-                 # Load fresh if not in cache
-                 user_data[user_id_to_verify] = await get_user_data(user_id_to_verify)
+            await user_sessions.update(user_id_to_verify, new_data)
 
             await message.reply_text(f"User {user_id_to_verify} has been manually verified! ✅")
 
@@ -1197,19 +1275,18 @@ async def reset_limit_command(client, message):
         return
 
     # Check if the user exists in the database
-    if not await present_user(user_id_to_reset):
+    session = await user_sessions.get(user_id_to_reset)
+    if not session.exists:
         await message.reply_text(f"❌ Error: User {user_id_to_reset} not found. They must start the bot at least once.")
         return
 
     # Check if the user is banned
-    if await is_user_banned(user_id_to_reset):
+    if session.is_banned:
         await message.reply_text(f"❌ Error: Cannot reset limit for User {user_id_to_reset} because they are currently banned.")
         return
 
     # Reset the file count
-    await update_user_data(user_id_to_reset, {'file_count': 0})
-    if user_id_to_reset in user_data:
-        user_data[user_id_to_reset]['file_count'] = 0
+    await user_sessions.update(user_id_to_reset, {'file_count': 0})
 
     admin_confirmation = f"✅ User {user_id_to_reset}'s file limit has been reset to 0."
 
@@ -1239,20 +1316,19 @@ async def expire_token_command(client, message):
         return
 
     # Check if the user exists
-    if not await present_user(user_id_to_expire):
+    session = await user_sessions.get(user_id_to_expire)
+    if not session.exists:
         await message.reply_text(f"❌ Error: User {user_id_to_expire} not found. They must start the bot at least once.")
         return
 
     # Check if the user is banned
-    if await is_user_banned(user_id_to_expire):
+    if session.is_banned:
         await message.reply_text(f"❌ Error: Cannot expire token for User {user_id_to_expire} because they are already banned.")
         return
 
     # Expire the token by updating status and resetting time/file_count
     update_data = {'status': 'unverified', 'time': 0, 'file_count': 0}
-    await update_user_data(user_id_to_expire, update_data)
-    if user_id_to_expire in user_data:
-        user_data[user_id_to_expire].update(update_data)
+    await user_sessions.update(user_id_to_expire, update_data)
 
     admin_confirmation = f"✅ User {user_id_to_expire}'s token has been manually expired."
 
@@ -1269,267 +1345,560 @@ async def expire_token_command(client, message):
 
     await message.reply_text(admin_confirmation)
 
-async def process_queue():
-    logging.info("Task started: process_queue")
-    while True:
-        message = await message_queue.get()  
-        if message is None:  
-            break
-        try:
-            await process_message(bot, message)
-        except Exception as e:
-            logger.error(f"Error in process_queue: {e}", exc_info=True)
-        finally:
-            sleep_time = 10 if bot_config.get('detect', True) else 6
-            await asyncio.sleep(sleep_time) # Throttle processing to prevent floods
-            message_queue.task_done()
+# Messages whose own record is still marked publish_pending, found by precheck_batch()
+resumed_message_ids = set()
 
-async def process_message(client, message):
+def resume_own_record(job, duplicate_doc):
+    """
+    Handles a duplicate check that found the job's own record (an interrupted or repeated run).
+    Returns 'published' if the file was posted, or None to post it: the job then skips hashing and storing.
+    """
+    if duplicate_doc.get('publish_pending'):
+        logger.info(f"Message {job.message.id} was stored but not posted yet, resuming: {job.caption}")
+        job.stored = True
+        return None
+    logger.info(f"Message {job.message.id} was already published, skipping: {job.caption}")
+    return 'published'
 
+async def precheck_batch(messages):
+    """
+    Batch version of the precheck_stage() pre-check, run on every journal batch
+    (mostly /index backfills). Resolves Unique ID, Caption and Metadata duplicates
+    against the database with a few $in queries and against earlier files of the
+    same batch, deletes them in bulk and returns the messages left to process.
+    """
+    if not bot_config.get('detect', True):
+        return messages
+
+    files = {}
+    for message in messages:
+        media = message.document or message.video or message.audio
+        if media and media.file_unique_id:
+            file_name = getattr(media, 'file_name', 'None')
+            caption = message.caption if message.caption else file_name
+            files[message.id] = (media.file_unique_id, caption, (media.file_size, file_name, getattr(media, 'duration', 0)))
+    if not files:
+        return messages
+
+    documents = await find_processed_batch(
+        [f[0] for f in files.values()], [f[1] for f in files.values()], [f[2] for f in files.values()]
+    )
+    by_id, by_caption, by_meta = {}, {}, {}
+    def remember(doc, same_batch=False):
+        entry = (doc, same_batch)
+        by_id.setdefault(doc['_id'], entry)
+        by_caption.setdefault(doc.get('caption'), entry)
+        if doc.get('file_size') and doc.get('file_name'):
+            by_meta.setdefault((doc['file_size'], doc['file_name'], doc.get('duration')), entry)
+    for doc in documents:
+        remember(doc)
+
+    remaining = []
+    duplicates = []
+    for message in messages:
+        if message.id not in files:
+            remaining.append(message)
+            continue
+
+        file_unique_id, caption, meta = files[message.id]
+        match_reason, match = None, None
+        if file_unique_id in by_id:
+            match_reason, match = "Unique ID", by_id[file_unique_id]
+        elif caption in by_caption:
+            match_reason, match = "Caption", by_caption[caption]
+        elif meta[0] and meta[1] and meta in by_meta:
+            match_reason, match = "Metadata (Size/Name/Duration)", by_meta[meta]
+
+        if not match_reason:
+            remaining.append(message)
+            remember({'_id': file_unique_id, 'caption': caption, 'file_size': meta[0], 'file_name': meta[1], 'duration': meta[2], 'message_id': message.id}, True)
+            continue
+
+        duplicate_doc, same_batch = match
+        if duplicate_doc.get('message_id') == message.id:
+            # The record is this very message; never delete the original
+            if duplicate_doc.get('publish_pending'):
+                # Stored but never posted (interrupted run): resume at the enrich and publish stages
+                resumed_message_ids.add(message.id)
+                remaining.append(message)
+            else:
+                logger.info(f"Message {message.id} was already published, skipping: {caption}")
+                ingest_journal.mark(message.id, 'published')
+            continue
+
+        if same_batch:
+            match_reason += " (Same Batch)"
+        logger.warning(f"Duplicate file detected and removed (Batch Pre-check): {caption} (Reason: {match_reason})")
+        ingest_journal.mark(message.id, 'duplicate')
+        duplicates.append((message.id, caption, match_reason))
+
+    if duplicates:
+        await safe_api_call(lambda: bot.delete_messages(DB_CHANNEL_ID, [d[0] for d in duplicates]))
+        lines = "\n".join(f"• <code>{caption}</code> ({reason})" for _, caption, reason in duplicates[:20])
+        if len(duplicates) > 20:
+            lines += f"\n...and {len(duplicates) - 20} more."
+        log_msg = (
+            f"<b>⚠️ {len(duplicates)} Duplicate Files Removed</b>\n\n"
+            f"{lines}\n\n"
+            f"<b>Status:</b> Skipped Download 🚀"
+        )
+        await safe_api_call(lambda: bot.send_message(LOG_CHANNEL_ID, log_msg))
+
+    return remaining
+
+ingest_journal = IngestJournal(bot, DB_CHANNEL_ID, message_queue, precheck=precheck_batch)
+
+# Recently posted video thumbnails, so re-indexing a file does not fetch its thumbnail again
+thumbnail_cache = LRUCache(maxsize=64, ttl=6 * 60 * 60)
+
+async def get_video_thumbnail(thumb):
+    """Fetches a video thumbnail into memory and returns it as a fresh BytesIO ready for send_photo."""
+    data = thumbnail_cache.get(thumb.file_unique_id, None)
+    if data is None:
+        downloaded = await safe_api_call(lambda: bot.download_media(thumb.file_id, in_memory=True))
+        if not downloaded:
+            return None
+        data = downloaded.getvalue()
+        thumbnail_cache.set(thumb.file_unique_id, data)
+    photo = io.BytesIO(data)
+    photo.name = "thumbnail.jpg"
+    return photo
+
+def log_duplicate_removed(job, duplicate_doc, match_reason, status_line):
+    return (
+        f"<b>⚠️ Duplicate File Removed</b>\n\n"
+        f"<b>Caption:</b> {job.caption}\n"
+        f"<b>File Name:</b> <code>{job.file_name}</code>\n"
+        f"<b>New File ID:</b> <code>{job.file_unique_id}</code>\n"
+        + (f"<b>Blocking ID (In DB):</b> <code>{duplicate_doc['_id']}</code>\n" if duplicate_doc else "")
+        + f"<b>Match Reason:</b> <code>{match_reason}</code>"
+        + (f"\n{status_line}" if status_line else "")
+    )
+
+async def precheck_stage(job):
+    """Stage 1: reads the file's metadata and drops duplicates before anything is downloaded."""
+    message = job.message
     media = message.document or message.video or message.audio
-    poster_url = None
-    thumbnail = None
+    job.media = media
+    job.stored = False # True once this job's processed_files record exists
+    if not media:
+        # Stickers are copied as they are; anything else is not ingested
+        return None if message.sticker else 'skipped'
+
+    job.file_unique_id = media.file_unique_id
+    job.file_name = getattr(media, 'file_name', 'None')
+    job.caption = message.caption if message.caption else job.file_name
+    job.file_size = media.file_size
+    job.duration_raw = getattr(media, 'duration', 0)
+
+    if not job.file_unique_id:
+        logger.error(f"File with missing file_unique_id received: {job.caption}")
+        return 'failed'
+
+    # Journal batches were already pre-checked together in precheck_batch()
+    prechecked = ingest_journal.take_prechecked(message.id)
+    if message.id in resumed_message_ids:
+        resumed_message_ids.discard(message.id)
+        logger.info(f"Message {message.id} was stored but not posted yet, resuming: {job.caption}")
+        job.stored = True
+        return None
 
-    if media:
-        file_unique_id = media.file_unique_id
-        file_name = getattr(media, 'file_name', 'None')
-        caption = message.caption if message.caption else file_name
+    # Only perform detection logic if 'detect' is True
+    if bot_config.get('detect', True) and not prechecked:
+        # Pre-check for duplicates (Database First) to avoid unnecessary downloads
+        duplicate_doc = await is_file_processed(job.file_unique_id, job.caption, None, None, None, job.file_size, job.file_name, job.duration_raw)
+        if duplicate_doc and duplicate_doc.get('message_id') == message.id:
+            # Same message resumed from the journal; never delete the original
+            return resume_own_record(job, duplicate_doc)
+        if duplicate_doc:
+            match_reason = "Unique ID" if duplicate_doc['_id'] == job.file_unique_id else \
+                           "Caption" if duplicate_doc['caption'] == job.caption else \
+                           "Metadata (Size/Name/Duration)"
+
+            logger.warning(f"Duplicate file detected and removed (Pre-check): {job.caption} (Reason: {match_reason})")
+            await bot.send_message(LOG_CHANNEL_ID, log_duplicate_removed(job, duplicate_doc, match_reason, "<b>Status:</b> Skipped Download 🚀"))
+            await safe_api_call(lambda: message.delete())
+            return 'duplicate'
+    return None
+
+async def fingerprint_stage(job):
+    """Stage 2: hashes the file, runs the full duplicate check and stores the processed_files record."""
+    # Only files that survive the pre-check spend rate limit tokens
+    await ingest_limiter.acquire()
+
+    message = job.message
+    if not job.media or job.stored or not bot_config.get('detect', True):
+        return None
 
-        if not file_unique_id:
-            logger.error(f"File with missing file_unique_id received: {caption}")
-            return
+    content_hash = None
+    hash_middle = None
+    hash_end = None
+    fingerprint_key = None
+    caption = job.caption
+
+    if (message.video or message.document) and bot_config.get('HASH_CALCULATION', True):
+        ingest_journal.mark(message.id, 'hashing')
+        fingerprint = await compute_fingerprint(bot, message, bot_config.get('HASH_PARTS', "1,2,3"))
+        content_hash, hash_middle, hash_end = fingerprint.content_hash, fingerprint.hash_middle, fingerprint.hash_end
+        fingerprint_key = fingerprint.key
+
+        if isinstance(fingerprint.error, FloodWait):
+            logger.error(f"Could not compute hash for {caption} after retries: {fingerprint.error}")
+            await bot.send_message(OWNER_ID, f"<b>Warning:</b> Could not compute hash for file <code>{caption}</code> after 3 attempts. Proceeding without hash-based duplicate check.")
+        elif fingerprint.error:
+            logger.error(f"Could not compute hash for {caption}: {fingerprint.error}")
+            await bot.send_message(OWNER_ID, f"<b>Warning:</b> An error occurred during hash computation for <code>{caption}</code>. Proceeding without hash-based duplicate check.\n\n<b>Error:</b> {fingerprint.error}")
+
+    duplicate_doc = await is_file_processed(job.file_unique_id, caption, content_hash, hash_middle, hash_end, job.file_size, job.file_name, job.duration_raw, fingerprint_key)
+    if duplicate_doc and duplicate_doc.get('message_id') == message.id:
+        # The record is this very message, stored by an earlier run or lease; never delete the original
+        return resume_own_record(job, duplicate_doc)
+    if duplicate_doc:
+        match_reason = None
+
+        # 1. Unique ID Match
+        if duplicate_doc['_id'] == job.file_unique_id:
+            match_reason = "Unique ID"
+
+        # 2. Fingerprint Match (all sampled chunks and size)
+        elif fingerprint_key and duplicate_doc.get('fingerprint') == fingerprint_key:
+            match_reason = "Fingerprint"
+
+        # 3. Caption Match
+        elif duplicate_doc['caption'] == caption:
+            match_reason = "Caption"
+
+        # 4. Hash Match (Robust)
+        else:
+            hashes_match = False
+            contradiction = False
 
-        content_hash = None
-        hash_middle = None
-        hash_end = None
-        file_size = media.file_size
-        duration_raw = getattr(media, 'duration', 0)
-
-        # Only perform detection logic if 'detect' is True
-        if bot_config.get('detect', True):
-            # Pre-check for duplicates (Database First) to avoid unnecessary downloads
-            duplicate_doc = await is_file_processed(file_unique_id, caption, None, None, None, file_size, file_name, duration_raw)
-            if duplicate_doc:
-                match_reason = "Unique ID" if duplicate_doc['_id'] == file_unique_id else \
-                               "Caption" if duplicate_doc['caption'] == caption else \
-                               "Metadata (Size/Name/Duration)"
-
-                logger.warning(f"Duplicate file detected and removed (Pre-check): {caption} (Reason: {match_reason})")
-                log_msg = (
-                    f"<b>⚠️ Duplicate File Removed</b>\n\n"
-                    f"<b>Caption:</b> {caption}\n"
-                    f"<b>File Name:</b> <code>{file_name}</code>\n"
-                    f"<b>New File ID:</b> <code>{file_unique_id}</code>\n"
-                    f"<b>Blocking ID (In DB):</b> <code>{duplicate_doc['_id']}</code>\n"
-                    f"<b>Match Reason:</b> <code>{match_reason}</code>\n"
-                    f"<b>Status:</b> Skipped Download 🚀"
-                )
-                await bot.send_message(LOG_CHANNEL_ID, log_msg)
-                await safe_api_call(lambda: message.delete())
-                return
+            # Check Start Hash
+            if content_hash and duplicate_doc.get('content_hash'):
+                if content_hash == duplicate_doc['content_hash']:
+                    hashes_match = True
+                else:
+                    contradiction = True
 
-            if (message.video or message.document) and bot_config.get('HASH_CALCULATION', True):
-                hash_parts_config = str(bot_config.get('HASH_PARTS', "1,2,3"))
-                parts = [int(p.strip()) for p in hash_parts_config.split(',') if p.strip().isdigit()]
+            # Check Middle Hash
+            if not contradiction and hash_middle and duplicate_doc.get('hash_middle'):
+                if hash_middle == duplicate_doc['hash_middle']:
+                    hashes_match = True
+                else:
+                    contradiction = True
 
-                max_retries = 3
-                for attempt in range(max_retries):
-                    try:
-                        total_chunks = (file_size + (1024 * 1024) - 1) // (1024 * 1024)
-                        processed_parts = 0
-
-                        # Part 1: Start
-                        if 1 in parts:
-                            async for chunk in bot.stream_media(message, offset=0, limit=1):
-                                content_hash = hashlib.sha256(chunk).hexdigest()
-                                break
-                            processed_parts += 1
-
-                        # Part 2: Middle
-                        if 2 in parts:
-                            if processed_parts > 0: await asyncio.sleep(10)
-
-                            offset = total_chunks // 2 if total_chunks > 0 else 0
-                            async for chunk in bot.stream_media(message, offset=offset, limit=1):
-                                hash_middle = hashlib.sha256(chunk).hexdigest()
-                                break
-                            processed_parts += 1
-
-                        # Part 3: End
-                        if 3 in parts:
-                            if processed_parts > 0: await asyncio.sleep(10)
-
-                            offset = total_chunks - 1 if total_chunks > 0 else 0
-                            async for chunk in bot.stream_media(message, offset=offset, limit=1):
-                                hash_end = hashlib.sha256(chunk).hexdigest()
-                                break
-                            processed_parts += 1
-
-                        break
-                    except FloodWait as e:
-                        if attempt < max_retries - 1:
-                            wait_time = e.value + 5
-                            logger.warning(f"FloodWait during hash computation for {caption}. Sleeping for {wait_time}s. Attempt {attempt + 1}/{max_retries}")
-                            await asyncio.sleep(wait_time)
-                        else:
-                            logger.error(f"Could not compute hash for {caption} after {max_retries} attempts: {e}")
-                            await bot.send_message(OWNER_ID, f"<b>Warning:</b> Could not compute hash for file <code>{caption}</code> after {max_retries} attempts. Proceeding without hash-based duplicate check.")
-                    except Exception as e:
-                        logger.error(f"Could not compute hash for {caption}: {e}")
-                        await bot.send_message(OWNER_ID, f"<b>Warning:</b> An error occurred during hash computation for <code>{caption}</code>. Proceeding without hash-based duplicate check.\n\n<b>Error:</b> {e}")
-                        break
+            # Check End Hash
+            if not contradiction and hash_end and duplicate_doc.get('hash_end'):
+                if hash_end == duplicate_doc['hash_end']:
+                    hashes_match = True
+                else:
+                    contradiction = True
+
+            if hashes_match and not contradiction:
+                match_reason = "Hash"
+
+            # 5. Metadata Match (Only if not contradicted by hashes)
+            if not match_reason and not contradiction:
+                 # Check if file size and name match
+                 if duplicate_doc.get('file_size') == job.file_size and \
+                    duplicate_doc.get('file_name') == job.file_name:
+                         match_reason = "Metadata (Size/Name/Duration)"
+
+        if match_reason:
+            logger.warning(f"Duplicate file detected and removed: {caption} (Reason: {match_reason})")
+            await bot.send_message(LOG_CHANNEL_ID, log_duplicate_removed(job, duplicate_doc, match_reason, f"<b>Hash (Start):</b> <code>{content_hash or 'N/A'}</code>"))
+            await safe_api_call(lambda: message.delete())
+            return 'duplicate'
+
+    saved = await add_processed_file_document(build_processed_file_document(
+        job.file_unique_id, caption, content_hash, hash_middle, hash_end, job.file_size, job.file_name, job.duration_raw, message.id, fingerprint_key,
+        file_id=job.media.file_id,
+        file_type='video' if message.video else 'audio' if message.audio else 'document',
+        caption_html=message.caption.html if message.caption else None,
+        publish_pending=True
+    ))
+    if saved is False:
+        # Another worker stored the same file (ID or fingerprint) between our check and insert
+        existing = await is_file_processed(job.file_unique_id, caption, fingerprint=fingerprint_key)
+        if existing is not None and existing.get('message_id') == message.id:
+            return resume_own_record(job, existing)
+        if existing is None:
+            # The conflicting record can't be found to prove it is another message; keep the original and retry later
+            logger.warning(f"Message {message.id} conflicts with a record that could not be found, retrying later: {caption}")
+            return 'failed'
+        logger.warning(f"Duplicate file detected and removed while saving: {caption}")
+        await bot.send_message(LOG_CHANNEL_ID, log_duplicate_removed(job, None, "Concurrent Upload", None))
+        await safe_api_call(lambda: message.delete())
+        return 'duplicate'
+    job.stored = True
+    return None
+
+async def enrich_stage(job):
+    """Stage 3: prepares the post: TMDB poster or thumbnail, cover art and caption text."""
+    message = job.message
+    media = job.media
+    job.poster_url = None
+    job.thumbnail = None
+    job.audio_thumb = None
+    job.group_key = None
+    job.episode = None
+    if not media:
+        return None
 
-            duplicate_doc = await is_file_processed(file_unique_id, caption, content_hash, hash_middle, hash_end, file_size, file_name, duration_raw)
-            if duplicate_doc:
-                match_reason = None
+    file_name = await remove_extension(job.caption)
+    file_size = humanbytes(media.file_size)
+    if message.video:
+        duration = TimeFormatter(media.duration * 1000)
+    else:
+        duration = ""
+    if not message.audio: 
+        release = parse_release(file_name)
+        if release.year:
+            # Season/episode, resolution and codec are left out of the TMDB query
+            job.poster_url = await get_by_name(release.title, release.year)
+        if release.title:
+            # Episodes and qualities of one season share a group key
+            job.episode = release.episode_label
+            job.group_title = release.title
+            job.group_year = release.year
+            job.group_key = f"{tmdb_cache_key(release.title, release.year)}|{release.season or ''}"
+        # The thumbnail is only posted when TMDB has no poster
+        if message.video and not job.poster_url and media.thumbs:
+            job.thumbnail = await get_video_thumbnail(media.thumbs[0])
+    if message.audio:
+        job.audio_thumb = await extract_cover_art(bot, message)
+
+    job.display_name = file_name
+    job.v_info = f"<blockquote expandable><b>{file_name}</b></blockquote>\n<blockquote><b>{file_size}</b></blockquote>\n<blockquote><b>{duration}</b></blockquote>"
+    if message.audio:
+        job.a_info = f"<blockquote ><b>{media.title}</b></blockquote>\n<blockquote><b>{media.performer}</b></blockquote>"
+    return None
+
+async def publish_stage(job):
+    """
+    Stage 4: posts to UPDATE_CHANNEL_ID in upload order. Consecutive files of the
+    same release are held for PUBLISH_GROUP_WINDOW seconds and posted together.
+    """
+    if job.media and job.group_key and PUBLISH_GROUP_WINDOW > 0 and not job.message.audio:
+        return await publish_grouper.add(job.group_key, job)
 
-                # 1. Unique ID Match
-                if duplicate_doc['_id'] == file_unique_id:
-                    match_reason = "Unique ID"
+    # Anything posted on its own must not overtake files still held for a group
+    await publish_grouper.flush()
+    if not job.media:
+        await safe_api_call(lambda: job.message.copy(UPDATE_CHANNEL_ID))
+        return 'published'
+    return await post_single(job)
 
-                # 2. Caption Match
-                elif duplicate_doc['caption'] == caption:
-                    match_reason = "Caption"
+async def post_group(jobs):
+    """Posts held files: a single file as usual, several as one post with a Send in DM button each."""
+    if len(jobs) == 1:
+        return await post_single(jobs[0])
 
-                # 3. Hash Match (Robust)
-                else:
-                    hashes_match = False
-                    contradiction = False
+    first = jobs[0]
+    title = f"{first.group_title} ({first.group_year})" if first.group_year else first.group_title
+    photo = next((job.poster_url for job in jobs if job.poster_url), None) or next((job.thumbnail for job in jobs if job.thumbnail), None)
 
-                    # Check Start Hash
-                    if content_hash and duplicate_doc.get('content_hash'):
-                        if content_hash == duplicate_doc['content_hash']:
-                            hashes_match = True
-                        else:
-                            contradiction = True
+    buttons = [
+        InlineKeyboardButton(f"📥 {job.episode or index}", url=f"https://telegram.dog/{bot_username}?start={job.message.id}")
+        for index, job in enumerate(jobs, 1)
+    ]
+    keyboard = InlineKeyboardMarkup([buttons[i:i + 2] for i in range(0, len(buttons), 2)])
 
-                    # Check Middle Hash
-                    if not contradiction and hash_middle and duplicate_doc.get('hash_middle'):
-                        if hash_middle == duplicate_doc['hash_middle']:
-                            hashes_match = True
-                        else:
-                            contradiction = True
+    lines = "\n".join(f"<b>{job.episode or index}.</b> {job.display_name} | {humanbytes(job.file_size)}" for index, job in enumerate(jobs, 1))
+    text = f"<blockquote><b>{title}</b></blockquote>\n<blockquote expandable>{lines}</blockquote>"
+    if photo and len(text) > 1024:
+        # Photo captions are limited to 1024 characters
+        lines = "\n".join(f"<b>{job.episode or index}.</b> {humanbytes(job.file_size)}" for index, job in enumerate(jobs, 1))
+        text = f"<blockquote><b>{title}</b></blockquote>\n<blockquote expandable>{lines}</blockquote>"
 
-                    # Check End Hash
-                    if not contradiction and hash_end and duplicate_doc.get('hash_end'):
-                        if hash_end == duplicate_doc['hash_end']:
-                            hashes_match = True
-                        else:
-                            contradiction = True
-
-                    if hashes_match and not contradiction:
-                        match_reason = "Hash"
-
-                    # 4. Metadata Match (Only if not contradicted by hashes)
-                    if not match_reason and not contradiction:
-                         # Check if file size and name match
-                         if duplicate_doc.get('file_size') == file_size and \
-                            duplicate_doc.get('file_name') == file_name:
-                                 match_reason = "Metadata (Size/Name/Duration)"
-
-                if match_reason:
-                    logger.warning(f"Duplicate file detected and removed: {caption} (Reason: {match_reason})")
-                    log_msg = (
-                        f"<b>⚠️ Duplicate File Removed</b>\n\n"
-                        f"<b>Caption:</b> {caption}\n"
-                        f"<b>File Name:</b> <code>{file_name}</code>\n"
-                        f"<b>New File ID:</b> <code>{file_unique_id}</code>\n"
-                        f"<b>Blocking ID (In DB):</b> <code>{duplicate_doc['_id']}</code>\n"
-                        f"<b>Match Reason:</b> <code>{match_reason}</code>\n"
-                        f"<b>Hash (Start):</b> <code>{content_hash or 'N/A'}</code>"
-                    )
-                    await bot.send_message(LOG_CHANNEL_ID, log_msg)
-                    await safe_api_call(lambda: message.delete())
-                    return
+    try:
+        if photo:
+            sent = await safe_api_call(lambda: bot.send_photo(UPDATE_CHANNEL_ID, photo=photo, caption=text, parse_mode=enums.ParseMode.HTML, reply_markup=keyboard))
+        else:
+            sent = None
+        if not sent:
+            await safe_api_call(lambda: bot.send_message(UPDATE_CHANNEL_ID, text=text, parse_mode=enums.ParseMode.HTML, reply_markup=keyboard))
+    except Exception as e:
+        await safe_api_call(lambda: bot.send_message(OWNER_ID, text=f"Error in Proccessing Group:{title} {e}"))
+        return 'failed'
 
-            await add_processed_file(file_unique_id, caption, content_hash, hash_middle, hash_end, file_size, file_name, duration_raw)
+    logger.info(f"Published {len(jobs)} files of {title} as one post.")
+    return 'published'
 
-        file_name = await remove_extension(caption)
-        file_size = humanbytes(media.file_size)
-        if message.video:
-            duration = TimeFormatter(media.duration * 1000)
-            if media.thumbs:
-                thumbnail = await safe_api_call(lambda: bot.download_media(media.thumbs[0].file_id))
-            else:
-                thumbnail = None
-        else:
-            duration = ""
-        if not message.audio: 
-            movie_name, release_year = await extract_movie_info(file_name)
-            poster_url = await get_by_name(movie_name, release_year)
-        if message.audio:
-            audio_path = await safe_api_call(lambda: bot.download_media(message.audio.file_id))
-            audio_thumb = await get_audio_thumbnail(audio_path)
+async def post_single(job):
+    message = job.message
 
-        file_id = message.id
-        v_info = f"<blockquote expandable><b>{file_name}</b></blockquote>\n<blockquote><b>{file_size}</b></blockquote>\n<blockquote><b>{duration}</b></blockquote>"
-        if message.audio:
-            a_info = f"<blockquote ><b>{media.title}</b></blockquote>\n<blockquote><b>{media.performer}</b></blockquote>"
-
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Send in DM", url=f"https://telegram.dog/{bot_username}?start={file_id}")]])
-
-        try:           
-            if poster_url:
-                await safe_api_call(lambda: bot.send_photo(
-                    UPDATE_CHANNEL_ID,
-                    photo=poster_url,
-                    caption=v_info,
-                    parse_mode=enums.ParseMode.HTML,
-                    reply_markup=keyboard
-                    ))
-            elif thumbnail:
-                await safe_api_call(lambda: bot.send_photo(
-                    UPDATE_CHANNEL_ID,
-                    photo=thumbnail,
-                    caption=v_info,
-                    parse_mode=enums.ParseMode.HTML,
-                    reply_markup=keyboard
+    poster_url = job.poster_url
+    thumbnail = job.thumbnail
+    v_info = job.v_info
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Send in DM", url=f"https://telegram.dog/{bot_username}?start={message.id}")]])
+
+    try:           
+        if poster_url:
+            await safe_api_call(lambda: bot.send_photo(
+                UPDATE_CHANNEL_ID,
+                photo=poster_url,
+                caption=v_info,
+                parse_mode=enums.ParseMode.HTML,
+                reply_markup=keyboard
                 ))
-            elif not message.audio:
-                await safe_api_call(lambda: bot.send_message(
-                    UPDATE_CHANNEL_ID,
-                    text=v_info,
-                    parse_mode=enums.ParseMode.HTML,
-                    reply_markup=keyboard 
-                    ))
-                
-            if message.audio:
-                await safe_api_call(lambda: bot.send_photo(
-                    UPDATE_CHANNEL_ID,
-                    photo=audio_thumb,
-                    caption=a_info,
-                    parse_mode=enums.ParseMode.HTML,
-                    reply_markup=keyboard
-                    ))
-                os.remove(audio_path) 
-
-        except (WebpageMediaEmpty, WebpageCurlFailed):
-            logger.info(f"{poster_url}")
+        elif thumbnail:
+            await safe_api_call(lambda: bot.send_photo(
+                UPDATE_CHANNEL_ID,
+                photo=thumbnail,
+                caption=v_info,
+                parse_mode=enums.ParseMode.HTML,
+                reply_markup=keyboard
+            ))
+        elif not message.audio:
             await safe_api_call(lambda: bot.send_message(
                 UPDATE_CHANNEL_ID,
                 text=v_info,
                 parse_mode=enums.ParseMode.HTML,
+                reply_markup=keyboard 
+                ))
+            
+        if message.audio:
+            await safe_api_call(lambda: bot.send_photo(
+                UPDATE_CHANNEL_ID,
+                photo=job.audio_thumb,
+                caption=job.a_info,
+                parse_mode=enums.ParseMode.HTML,
                 reply_markup=keyboard
                 ))
 
-        except FloodWait as f:
-            await asyncio.sleep(f.value)
-            await process_message(client, message)
+    except (WebpageMediaEmpty, WebpageCurlFailed):
+        logger.info(f"{poster_url}")
+        await safe_api_call(lambda: bot.send_message(
+            UPDATE_CHANNEL_ID,
+            text=v_info,
+            parse_mode=enums.ParseMode.HTML,
+            reply_markup=keyboard
+            ))
+
+    except FloodWait as f:
+        notify_flood_wait(f.value)
+        await asyncio.sleep(f.value)
+        if thumbnail:
+            thumbnail.seek(0)
+        return await post_single(job)
+
+    except Exception as e:
+        await safe_api_call(lambda: bot.send_message(OWNER_ID, text=f"Error in Proccessing MSG:{job.display_name} {e}"))
+        return 'failed'
 
+    return 'published'
+
+async def ingest_done(job, state, error=None):
+    """
+    Records the outcome of every ingested message in the journal. The record of a
+    posted file is confirmed; the record of a file that failed after it was stored is
+    removed, so indexing the message again posts it instead of matching itself.
+    """
+    if getattr(job, 'stored', False) and state in ('published', 'failed'):
+        try:
+            if state == 'published':
+                await confirm_processed_file(job.message.id)
+            else:
+                await discard_processed_file(job.message.id)
         except Exception as e:
-            await safe_api_call(lambda: bot.send_message(OWNER_ID, text=f"Error in Proccessing MSG:{file_name} {e}"))
-    
-    elif message.sticker:
-        await safe_api_call(lambda: message.copy(UPDATE_CHANNEL_ID))
+            logger.error(f"Failed to update the record of message {job.message.id} after it {state}: {e}")
+    ingest_journal.mark(job.message.id, state, error)
+
+# Files whose titles match within the window are published as one post
+publish_grouper = GroupingWindow(PUBLISH_GROUP_WINDOW, PUBLISH_GROUP_MAX, post_group)
+
+ingest_pipeline = IngestPipeline(
+    message_queue,
+    [
+        Stage('precheck', precheck_stage, INGEST_PRECHECK_WORKERS, INGEST_QUEUE_SIZE),
+        Stage('fingerprint', fingerprint_stage, INGEST_WORKERS, INGEST_QUEUE_SIZE, throttled=True),
+        Stage('enrich', enrich_stage, INGEST_ENRICH_WORKERS, INGEST_QUEUE_SIZE, throttled=True),
+        Stage('publish', publish_stage, queue_size=INGEST_QUEUE_SIZE, ordered=True)
+    ],
+    ingest_limiter,
+    ingest_done
+)
 
 
+# Seconds a restart waits for the files in the ingest pipeline; files still in flight resume on the next start
+INGEST_DRAIN_TIMEOUT = 60
+
+async def stop_ingest(timeout=INGEST_DRAIN_TIMEOUT):
+    """
+    Called before a restart: stops intake, posts the files held for a group and waits
+    for the pipeline to go idle, then writes the journal and the buffered daily stats.
+    """
+    ingest_pipeline.stop_intake()
+    deadline = tm() + timeout
+    while ingest_pipeline.in_flight() and tm() < deadline:
+        await publish_grouper.flush()
+        await asyncio.sleep(0.5)
+    if ingest_pipeline.in_flight():
+        logger.warning(f"Restarting with {ingest_pipeline.in_flight()} files still in the ingest pipeline; they resume on the next start.")
+    await ingest_journal.flush()
+    await flush_daily_stats()
+
 @bot.on_message(filters.command('restart') & filters.private & filters.user(OWNER_ID))
 async def restart(client, message):
     restart_msg = await message.reply_text("Restarting...")
     await update_dynamic_config('restart_data', {'chat_id': message.chat.id, 'message_id': restart_msg.id})
+    await stop_ingest()
     os.system("python3 update.py")  
     os.execl(sys.executable, sys.executable, "bot.py")
 
+# Force-sub membership by (channel, user_id): the member status, or None while the user has not joined
+force_sub_cache = LRUCache(maxsize=10000, ttl=FORCE_SUB_CACHE_TTL)
+# Invite link per force-sub channel, exported once
+force_sub_invite_links = {}
+
+async def get_force_sub_status(client, force_sub_channel, user_id):
+    """The user's status in the force-sub channel (None if not joined), cached; raises on other errors."""
+    key = (force_sub_channel, user_id)
+    status = force_sub_cache.get(key)
+    if status is not LRUCache.MISSING:
+        return status
+    try:
+        member = await client.get_chat_member(force_sub_channel, user_id)
+        status = member.status
+        # Users who left (or were banned) may join any moment, so they are rechecked soon
+        not_joined = status in (enums.ChatMemberStatus.LEFT, enums.ChatMemberStatus.BANNED)
+        force_sub_cache.set(key, status, ttl=FORCE_SUB_NEGATIVE_TTL if not_joined else None)
+    except UserNotParticipant:
+        status = None
+        force_sub_cache.set(key, status, ttl=FORCE_SUB_NEGATIVE_TTL)
+    return status
+
+async def get_force_sub_invite_link(client, force_sub_channel):
+    invite_link = force_sub_invite_links.get(force_sub_channel)
+    if invite_link:
+        return invite_link
+    try:
+        invite_link = await client.export_chat_invite_link(force_sub_channel)
+        force_sub_invite_links[force_sub_channel] = invite_link
+    except Exception:
+        # Fallback if bot can't export link (maybe public channel)
+        if str(force_sub_channel).startswith("-100"):
+             # It's an ID, difficult to guess link if not public/admin
+             invite_link = "Please contact admin for link."
+        else:
+             # It's likely a username
+             invite_link = f"https://t.me/{force_sub_channel}" if not str(force_sub_channel).startswith("http") else force_sub_channel
+    return invite_link
+
+@bot.on_chat_member_updated()
+async def force_sub_member_updated(client, update):
+    """Joins, leaves and bans in the force-sub channel replace the cached membership right away."""
+    force_sub_channel = clean_force_sub_url(bot_config.get('FORCE_SUB_CHANNEL'))
+    if not force_sub_channel:
+        return
+    chat = update.chat
+    if force_sub_channel != chat.id and str(force_sub_channel).lower() != (chat.username or "").lower():
+        return
+    member = update.new_chat_member or update.old_chat_member
+    if member and member.user:
+        force_sub_cache.pop((force_sub_channel, member.user.id))
+
 async def check_force_sub(client, message, user_id):
     force_sub_channel = bot_config.get('FORCE_SUB_CHANNEL')
     if not force_sub_channel:
@@ -1537,22 +1906,14 @@ async def check_force_sub(client, message, user_id):
 
     try:
         force_sub_channel = clean_force_sub_url(force_sub_channel)
-        user = await client.get_chat_member(force_sub_channel, user_id)
-        if user.status == enums.ChatMemberStatus.BANNED:
+        status = await get_force_sub_status(client, force_sub_channel, user_id)
+        if status == enums.ChatMemberStatus.BANNED:
             await message.reply_text("You are banned from the update channel. Contact admin.")
             return False
-        return True
-    except UserNotParticipant:
-        try:
-            invite_link = await client.export_chat_invite_link(force_sub_channel)
-        except Exception:
-            # Fallback if bot can't export link (maybe public channel)
-            if str(force_sub_channel).startswith("-100"):
-                 # It's an ID, difficult to guess link if not public/admin
-                 invite_link = "Please contact admin for link."
-            else:
-                 # It's likely a username
-                 invite_link = f"https://t.me/{force_sub_channel}" if not str(force_sub_channel).startswith("http") else force_sub_channel
+        if status is not None and status != enums.ChatMemberStatus.LEFT:
+            return True
+
+        invite_link = await get_force_sub_invite_link(client, force_sub_channel)
 
         join_button = InlineKeyboardButton("📢 Join Channel", url=invite_link)
 
@@ -1582,44 +1943,36 @@ async def check_force_sub(client, message, user_id):
 async def verify_token(user_id, input_token):
     current_time = tm()
     
-    # Get user data from local cache or DB
-    udata = user_data.get(user_id)
-    if not udata:
-        udata = await get_user_data(user_id)
-        if not udata:
-            return 'Token Mismatched ❌'
-        user_data[user_id] = udata
-
-    stored_token = udata.get('token')
+    session = await user_sessions.get(user_id)
+    if not session.exists:
+        return 'Token Mismatched ❌'
+
+    stored_token = session.token
     if input_token == stored_token:
         new_token = str(uuid.uuid4())
         new_data = {"token": new_token, "time": current_time, "status": "verified", "file_count": 0, "inittime": current_time}
-        await update_user_data(user_id, new_data)
+        await user_sessions.update(user_id, new_data)
         await increment_verified_today() # New line to track daily verifications
-        user_data[user_id] = {**udata, **new_data} # Update local cache
         token_timeout = bot_config.get('TOKEN_TIMEOUT', TOKEN_TIMEOUT)
         return f'Token Verified ✅ (Validity: {get_readable_time(token_timeout)})'
     else:
         return f'Token Mismatched ❌'
 
 async def check_access(message, user_id):
-    udata = user_data.get(user_id)
-    if not udata:
-        udata = await get_user_data(user_id)
-        if not udata:
-            # This case happens for new users who are not in the DB yet
-            button = await genrate_token(user_id)
-            send_message = await message.reply_text( 
-                                                    text=f"👋 Welcome! Please get a token to access files. 🚀",
-                                                    reply_markup=button
-                                                    )
-            await auto_delete_message(message, send_message)
-            return False
-        user_data[user_id] = udata
+    session = await user_sessions.get(user_id)
+    if not session.exists:
+        # This case happens for new users who are not in the DB yet
+        button = await genrate_token(user_id)
+        send_message = await message.reply_text( 
+                                                text=f"👋 Welcome! Please get a token to access files. 🚀",
+                                                reply_markup=button
+                                                )
+        await auto_delete_message(message, send_message)
+        return False
 
-    time = udata.get('time', 0)
-    status = udata.get('status', 'unverified')
-    file_count = udata.get('file_count', 0)
+    time = session.time
+    status = session.status
+    file_count = session.file_count
 
     token_timeout = bot_config.get('TOKEN_TIMEOUT', TOKEN_TIMEOUT)
     daily_limit = bot_config.get('DAILY_LIMIT', DAILY_LIMIT)
@@ -1631,26 +1984,8 @@ async def check_access(message, user_id):
         if file_count < daily_limit:
             return True
         else:
-            # Limit Reached Logic
-            extension_stage = udata.get('extension_stage', 0)
-
-            # Check if extension is possible (Stage < 2 and Secondary Shortener Configured)
-            shortener_url_2 = bot_config.get('SHORTERNER_URL_2')
-            if extension_stage < 2 and shortener_url_2:
-                button = await generate_extension_token_button(user_id)
-                warning_msg = (
-                    f"⚠️ <b>Daily Limit Reached!</b> ({daily_limit}/{daily_limit})\n\n"
-                    f"You have used your daily file quota.\n"
-                    f"But don't worry! You can extend your limit for free.\n\n"
-                    f"<b>Current Extension:</b> {extension_stage}/2"
-                )
-                reply = await message.reply_text(warning_msg, reply_markup=button)
-                await auto_delete_message(message, reply)
-                return False
-            else:
-                reply = await message.reply_text(f"You have reached the daily limit. Please wait until the token expires.")
-                await auto_delete_message(message, reply)
-                return False
+            await send_limit_reached(message, user_id, session)
+            return False
     else:
         button = await update_token(user_id)
         send_message = await message.reply_text( 
@@ -1660,14 +1995,33 @@ async def check_access(message, user_id):
         await auto_delete_message(message, send_message)
         return False
 
+async def send_limit_reached(message, user_id, session):
+    """Tells the user the daily limit is used up and offers an extension if one is still available."""
+    daily_limit = bot_config.get('DAILY_LIMIT', DAILY_LIMIT)
+    extension_stage = session.extension_stage
+
+    # Check if extension is possible (Stage < 2 and Secondary Shortener Configured)
+    shortener_url_2 = bot_config.get('SHORTERNER_URL_2')
+    if extension_stage < 2 and shortener_url_2:
+        button = await generate_extension_token_button(user_id)
+        warning_msg = (
+            f"⚠️ <b>Daily Limit Reached!</b> ({daily_limit}/{daily_limit})\n\n"
+            f"You have used your daily file quota.\n"
+            f"But don't worry! You can extend your limit for free.\n\n"
+            f"<b>Current Extension:</b> {extension_stage}/2"
+        )
+        reply = await message.reply_text(warning_msg, reply_markup=button)
+    else:
+        reply = await message.reply_text(f"You have reached the daily limit. Please wait until the token expires.")
+    await auto_delete_message(message, reply)
+
 async def generate_extension_token_button(user_id):
     """Generates a button for limit extension using the secondary shortener."""
     try:
         # We reuse the existing token or generate a specific one.
         # Logic: We use the existing token but prefix it in the deep link.
         # Actually, simpler to just use the stored token.
-        udata = user_data.get(user_id)
-        token = udata.get('token')
+        token = (await user_sessions.get(user_id)).token
 
         # Ensure bot_username is available
         current_bot_username = bot_username or bot.me.username
@@ -1713,8 +2067,7 @@ async def update_token(user_id):
             "extension_stage": 0,
             "inittime": current_time
         }
-        await update_user_data(user_id, new_data)
-        user_data[user_id] = {**user_data.get(user_id, {}), **new_data} # Update local cache
+        await user_sessions.update(user_id, new_data)
 
         # 1. Create the deep link URL for the bot
         bot_deep_link = f'https://telegram.dog/{bot_username}?start=token_{token}'
@@ -1753,8 +2106,7 @@ async def genrate_token(user_id):
             "extension_stage": 0,
             "inittime": current_time
         }
-        await update_user_data(user_id, new_data)
-        user_data[user_id] = {**user_data.get(user_id, {}), **new_data} # Update local cache
+        await user_sessions.update(user_id, new_data)
         
         bot_deep_link = f'https://telegram.dog/{bot_username}?start=token_{token}'
         external_shortened_url = await shorten_url(
@@ -1814,7 +2166,6 @@ async def get_user_link(user: User) -> str:
 
 async def daily_reset_scheduler():
     logging.info("Task started: daily_reset_scheduler")
-    global user_data
     while True:
         try:
             # Run reset immediately on startup if needed
@@ -1828,9 +2179,33 @@ async def daily_reset_scheduler():
             logger.error(f"Error in daily_reset_scheduler: {e}")
             await asyncio.sleep(60)  # Retry after 1 minute if error occurs
 
+async def ban_sweeper():
+    logging.info("Task started: ban_sweeper")
+    while True:
+        try:
+            expired = await expire_bans()
+            if expired:
+                user_sessions.bans_expired(expired)
+                logger.info(f"Ban sweeper: {len(expired)} bans expired.")
+
+            # Bans last at least 15 minutes, checking once a minute is enough
+            next_expiry = ban_registry.next_expiry()
+            await asyncio.sleep(min(60, max(1, next_expiry - tm())) if next_expiry else 60)
+        except Exception as e:
+            logger.error(f"Error in ban_sweeper: {e}")
+            await asyncio.sleep(60)
+
+async def daily_stats_flusher():
+    logging.info("Task started: daily_stats_flusher")
+    while True:
+        await asyncio.sleep(DAILY_STATS_FLUSH_INTERVAL)
+        try:
+            await flush_daily_stats()
+        except Exception as e:
+            logger.error(f"Error in daily_stats_flusher: {e}")
+
 async def check_expired_tokens():
     logging.info("Task started: check_expired_tokens")
-    global user_data
     while True:
         try:
             token_timeout = bot_config.get('TOKEN_TIMEOUT', TOKEN_TIMEOUT)
@@ -1844,13 +2219,7 @@ async def check_expired_tokens():
                 for user_id in expired_users:
                     # Update status in DB
                     # Reset extension_stage as well
-                    await update_user_data(user_id, {'status': 'unverified', 'extension_stage': 0, 'file_count': 0})
-
-                    # Update local cache
-                    if user_id in user_data:
-                        user_data[user_id]['status'] = 'unverified'
-                        user_data[user_id]['extension_stage'] = 0
-                        user_data[user_id]['file_count'] = 0
+                    await user_sessions.update(user_id, {'status': 'unverified', 'extension_stage': 0, 'file_count': 0})
 
                     # Notify user
                     logging.info(f"Attempting to notify user {user_id} of token expiry...")
@@ -1892,6 +2261,8 @@ async def prune_inactive_users_scheduler():
 
             if inactive_user_ids:
                 deleted_count = await delete_users_bulk(inactive_user_ids)
+                for user_id in inactive_user_ids:
+                    user_sessions.invalidate(user_id)
 
                 # Log the result
                 summary_message = f"✅ Automated Prune: Removed {deleted_count} inactive unverified users."
@@ -1910,6 +2281,7 @@ async def prune_inactive_users_scheduler():
 
 async def main():
     await load_initial_data()
+    await start_http_client()
 
     # Check for pending restart
     try:
@@ -1935,10 +2307,22 @@ async def main():
     except Exception as e:
         logger.error(f"Error checking restart status: {e}")
 
-    logging.info("Scheduling task: process_queue")
-    asyncio.create_task(process_queue())
+    if DEDUP_FILTER:
+        logging.info("Scheduling task: load_dedup_filter")
+        asyncio.create_task(load_dedup_filter(DEDUP_FILTER_FP_RATE))
+    logging.info("Scheduling task: deletion scheduler")
+    await deletion_scheduler.start(bot)
+    logging.info("Scheduling task: ingest journal feeder")
+    await ingest_journal.recover()
+    asyncio.create_task(ingest_journal.run())
+    logging.info("Starting ingest pipeline")
+    ingest_pipeline.start()
     logging.info("Scheduling task: daily_reset_scheduler")
     asyncio.create_task(daily_reset_scheduler())
+    logging.info("Scheduling task: ban_sweeper")
+    asyncio.create_task(ban_sweeper())
+    logging.info("Scheduling task: daily_stats_flusher")
+    asyncio.create_task(daily_stats_flusher())
     logging.info("Scheduling task: check_expired_tokens")
     asyncio.create_task(check_expired_tokens())
     logging.info("Scheduling task: prune_inactive_users_scheduler")
@@ -1957,4 +2341,6 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         logger.info("Keyboard interrupt received. Shutting down gracefully...")
     finally:
+        bot.loop.run_until_complete(stop_ingest())
+        bot.loop.run_until_complete(close_http_client())
         logger.info("Bot has stopped.")
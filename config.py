@@ -80,12 +80,33 @@ MINIMUM_DURATION = int(os.getenv('MINIMUM_DURATION', '0')) # Added: Minimum dura
 
 # New Configs
 FORCE_SUB_CHANNEL = os.getenv('FORCE_SUB_CHANNEL', None) # Force subscribe channel ID or Link
+FORCE_SUB_CACHE_TTL = int(os.getenv('FORCE_SUB_CACHE_TTL', '600')) # Seconds a membership check is reused
+FORCE_SUB_NEGATIVE_TTL = int(os.getenv('FORCE_SUB_NEGATIVE_TTL', '30')) # Seconds a "not joined" answer is reused
 AUTO_DELETE_TIME = int(os.getenv('AUTO_DELETE_TIME', '60')) # Auto delete time in seconds
 PROTECT_CONTENT = os.getenv('PROTECT_CONTENT', 'False').lower() in ('true', '1', 't')
 
+# Users kept in memory (least recently active users are dropped first)
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+
 # Hash Configuration
 HASH_CALCULATION = os.getenv('HASH_CALCULATION', 'True').lower() in ('true', '1', 't')
 HASH_PARTS = os.getenv('HASH_PARTS', '1,2,3') # Default: Start, Middle, End
+HASH_DOWNLOAD_CONCURRENCY = int(os.getenv('HASH_DOWNLOAD_CONCURRENCY', '3')) # Max chunk downloads in flight for hashing
+
+# Dedup Pre-Filter Configuration
+DEDUP_FILTER = os.getenv('DEDUP_FILTER', 'True').lower() in ('true', '1', 't') # In-memory Bloom filter in front of duplicate checks
+DEDUP_FILTER_FP_RATE = float(os.getenv('DEDUP_FILTER_FP_RATE', '0.01')) # Target false-positive rate
 
 # Detect Configuration (New)
 detect = os.getenv('detect', 'True').lower() in ('true', '1', 't')
+
+# Ingest Configuration
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '3')) # Concurrent files in the hashing stage
+INGEST_PRECHECK_WORKERS = int(os.getenv('INGEST_PRECHECK_WORKERS', '2')) # Concurrent duplicate pre-checks
+INGEST_ENRICH_WORKERS = int(os.getenv('INGEST_ENRICH_WORKERS', '3')) # Concurrent TMDB/thumbnail lookups
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', '20')) # Files buffered between two ingest stages
+INGEST_LIVE_WEIGHT = int(os.getenv('INGEST_LIVE_WEIGHT', '10')) # Share of ingest turns for live uploads
+INGEST_BACKFILL_WEIGHT = int(os.getenv('INGEST_BACKFILL_WEIGHT', '3')) # Share of ingest turns for /index backfills (retries get 1)
+PUBLISH_GROUP_WINDOW = int(os.getenv('PUBLISH_GROUP_WINDOW', '10')) # Seconds to wait for more files of the same release (0 disables grouping)
+PUBLISH_GROUP_MAX = int(os.getenv('PUBLISH_GROUP_MAX', '10')) # Max files in one grouped post
+INGEST_RATE = int(os.getenv('INGEST_RATE', '12')) # Max files per minute, lowered automatically on FloodWait
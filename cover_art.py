@@ -0,0 +1,167 @@
+import io
+import os
+import logging
+from mutagen.id3 import ID3
+from mutagen.flac import Picture
+from utils import safe_api_call, get_audio_thumbnail
+from fingerprint import CHUNK_SIZE, read_chunk
+
+logger = logging.getLogger(__name__)
+
+# Cover art lives in the tag/metadata region; give up on range reads beyond this many chunks
+COVER_ART_MAX_CHUNKS = 8
+
+cover_art_stats = {'range_reads': 0, 'full_downloads': 0, 'bytes_read': 0, 'bytes_saved': 0}
+
+
+class _Unresolved(Exception):
+    """The art could not be located within the range-read budget."""
+
+
+class _RangeReader:
+    """Random access over a Telegram file, fetching (and keeping) only the 1 MB chunks that are touched."""
+
+    def __init__(self, client, message, file_size, max_chunks):
+        self.client = client
+        self.message = message
+        self.file_size = file_size
+        self.max_chunks = max_chunks
+        self.bytes_read = 0
+        self._chunks = {}
+
+    async def read(self, start, length):
+        length = min(length, self.file_size - start)
+        if start < 0 or length <= 0:
+            raise _Unresolved("read outside the file")
+
+        first = start // CHUNK_SIZE
+        last = (start + length - 1) // CHUNK_SIZE
+        for index in range(first, last + 1):
+            if index in self._chunks:
+                continue
+            if len(self._chunks) >= self.max_chunks:
+                raise _Unresolved("header region exceeds the range-read budget")
+            chunk = await read_chunk(self.client, self.message, index)
+            if not chunk:
+                raise _Unresolved(f"chunk {index} could not be read")
+            self._chunks[index] = chunk
+            self.bytes_read += len(chunk)
+
+        data = b''.join(self._chunks[index] for index in range(first, last + 1))
+        offset = start - first * CHUNK_SIZE
+        return data[offset:offset + length]
+
+
+def _syncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+async def _id3_cover(reader):
+    """Returns (art, end of the tag). Reads only the ID3v2 tag at the start of the file."""
+    header = await reader.read(0, 10)
+    tag_size = 10 + _syncsafe(header[6:10]) + (10 if header[5] & 0x10 else 0)
+    tags = ID3(io.BytesIO(await reader.read(0, tag_size)), load_v1=False)
+    pictures = tags.getall('APIC')
+    return (pictures[0].data if pictures else None), tag_size
+
+async def _flac_cover(reader, start):
+    """Walks the FLAC metadata blocks after the `fLaC` marker up to the first PICTURE block."""
+    position = start + 4
+    while True:
+        header = await reader.read(position, 4)
+        if len(header) < 4:
+            raise _Unresolved("truncated FLAC metadata")
+        is_last = header[0] & 0x80
+        block_type = header[0] & 0x7F
+        length = int.from_bytes(header[1:4], 'big')
+        if block_type == 6:
+            return Picture(await reader.read(position + 4, length)).data
+        if block_type == 127:
+            raise _Unresolved("invalid FLAC metadata block")
+        position += 4 + length
+        if is_last:
+            return None
+
+async def _mp4_atoms(reader, start, end):
+    """Lists (kind, content start, atom end) for the atoms between start and end, reading only their headers."""
+    atoms = []
+    position = start
+    while position + 8 <= end:
+        header = await reader.read(position, 16)
+        size = int.from_bytes(header[:4], 'big')
+        header_size = 8
+        if size == 1:
+            size = int.from_bytes(header[8:16], 'big')
+            header_size = 16
+        elif size == 0:
+            size = end - position
+        if size < header_size:
+            raise _Unresolved("invalid MP4 atom")
+        atoms.append((header[4:8], position + header_size, position + size))
+        position += size
+    return atoms
+
+async def _mp4_child(reader, start, end, kind):
+    for atom_kind, content_start, atom_end in await _mp4_atoms(reader, start, end):
+        if atom_kind == kind:
+            return content_start, atom_end
+    return None
+
+async def _mp4_cover(reader):
+    """Follows moov/udta/meta/ilst/covr/data. Only atom headers are read on the way, so mdat is skipped."""
+    span = (0, reader.file_size)
+    for kind in (b'moov', b'udta', b'meta', b'ilst', b'covr', b'data'):
+        span = await _mp4_child(reader, span[0], span[1], kind)
+        if span is None:
+            return None
+        if kind == b'meta':
+            span = (span[0] + 4, span[1]) # meta is a full box: skip version and flags
+    # data atom payload: 4 bytes type + 4 bytes locale, then the image
+    return await reader.read(span[0] + 8, span[1] - span[0] - 8)
+
+async def _read_cover(reader):
+    magic = await reader.read(0, 12)
+    if magic[:3] == b'ID3':
+        art, tag_end = await _id3_cover(reader)
+        # FLAC files occasionally carry an ID3 tag in front of their own metadata
+        if art is None and reader.file_size > tag_end + 4 and await reader.read(tag_end, 4) == b'fLaC':
+            return await _flac_cover(reader, tag_end)
+        return art
+    if magic[:4] == b'fLaC':
+        return await _flac_cover(reader, 0)
+    if magic[4:8] == b'ftyp':
+        return await _mp4_cover(reader)
+    # Other containers carry no art that get_audio_thumbnail() understands
+    return None
+
+async def _full_download_cover(client, message):
+    audio_path = await safe_api_call(lambda: client.download_media(message.audio.file_id))
+    if not audio_path:
+        return None
+    try:
+        return await get_audio_thumbnail(audio_path)
+    finally:
+        os.remove(audio_path)
+
+async def extract_cover_art(client, message):
+    """
+    Returns the embedded cover art of an audio message as a BytesIO, or None.
+    Only the tag region (ID3v2 tag, FLAC metadata blocks or the MP4 moov atom)
+    is streamed; the whole track is downloaded only if the art cannot be found there.
+    """
+    file_size = message.audio.file_size or 0
+    reader = _RangeReader(client, message, file_size, COVER_ART_MAX_CHUNKS)
+    try:
+        art = await _read_cover(reader)
+        cover_art_stats['range_reads'] += 1
+        cover_art_stats['bytes_read'] += reader.bytes_read
+        cover_art_stats['bytes_saved'] += max(0, file_size - reader.bytes_read)
+        cover = io.BytesIO(art) if art else None
+    except Exception as e:
+        logger.info(f"Cover art not found in the header of message {message.id} ({e}), downloading the full file.")
+        cover_art_stats['full_downloads'] += 1
+        cover_art_stats['bytes_read'] += reader.bytes_read + file_size
+        cover = await _full_download_cover(client, message)
+
+    if cover:
+        cover.name = "cover.jpg"
+    return cover
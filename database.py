@@ -1,10 +1,16 @@
+import asyncio
 import pymongo
-from pymongo import MongoClient
+from collections import OrderedDict
+from pymongo import MongoClient, UpdateOne, ReturnDocument
 from motor.motor_asyncio import AsyncIOMotorClient
-from config import MONGO_URI, MONGO_URI_2, MONGO_DB_NAME
+from config import MONGO_URI, MONGO_URI_2, MONGO_DB_NAME, USER_CACHE_SIZE
+from dedup_filter import BloomFilter, processed_file_keys
+from ban_registry import BanRegistry
 from time import time as tm
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
+import uuid
+import hashlib
 import logging
 
 logger = logging.getLogger(__name__)
@@ -20,6 +26,9 @@ daily_stats = async_db['daily_stats']
 shortener_requests = async_db['shortener_requests']
 config_collection = async_db['config']
 processed_files = async_db['processed_files']
+ingest_journal = async_db['ingest_journal']
+tmdb_cache = async_db['tmdb_cache']
+scheduled_deletions = async_db['scheduled_deletions']
 
 # Initialize Second Database if URI is present
 async_client_2 = None
@@ -38,30 +47,127 @@ if MONGO_URI_2:
         logger.error(f"Failed to connect to Secondary Database: {e}")
         async_client_2 = None
 
+# True while some hashed records have no composite fingerprint yet (they need the $or fallback)
+legacy_hash_records = True
 
-async def add_processed_file(file_unique_id, caption, content_hash=None, hash_middle=None, hash_end=None, file_size=None, file_name=None, duration=None):
+# In-memory Bloom filter over processed_files, a miss means the file was never seen
+dedup_filter = None
+_dedup_filter_building = None
+dedup_filter_skips = 0
+
+# Active bans, loaded on startup and kept in sync by ban_user() / unban_user()
+ban_registry = BanRegistry()
+
+async def load_dedup_filter(fp_rate=0.01):
     """
-    Adds a file's metadata and hashes to the processed files collection.
-    Tries DB1 first; if it fails (e.g. quota full), tries DB2.
+    Builds the dedup pre-filter by streaming processed_files from both databases.
+    Until it is ready, duplicate checks go straight to MongoDB.
+    """
+    global dedup_filter, _dedup_filter_building
+    total = await processed_files.estimated_document_count()
+    if processed_files_2 is not None:
+        total += await processed_files_2.estimated_document_count()
+
+    # About six keys per record, with room for the collection to double
+    bloom = BloomFilter(max(total * 12, 100000), fp_rate)
+    _dedup_filter_building = bloom
+
+    projection = {'caption': 1, 'fingerprint': 1, 'content_hash': 1, 'hash_middle': 1, 'hash_end': 1, 'file_size': 1, 'file_name': 1, 'duration': 1}
+    for collection in (processed_files, processed_files_2):
+        if collection is None:
+            continue
+        async for doc in collection.find({}, projection):
+            for key in processed_file_keys(
+                doc['_id'], doc.get('caption'), doc.get('content_hash'), doc.get('hash_middle'), doc.get('hash_end'),
+                doc.get('file_size'), doc.get('file_name'), doc.get('duration'), doc.get('fingerprint')
+            ):
+                bloom.add(key)
+
+    dedup_filter = bloom
+    _dedup_filter_building = None
+    logger.info(f"Dedup filter loaded: {bloom.count} keys, {bloom.memory_bytes / 1024 / 1024:.1f} MB, est. FP rate {bloom.false_positive_rate:.4%}.")
+
+def get_dedup_filter_stats():
+    if dedup_filter is None:
+        return None
+    return {
+        'keys': dedup_filter.count,
+        'capacity': dedup_filter.capacity,
+        'memory_bytes': dedup_filter.memory_bytes,
+        'fp_rate': dedup_filter.false_positive_rate,
+        'skipped_lookups': dedup_filter_skips
+    }
+
+def make_fingerprint_key(file_size, content_hash=None, hash_middle=None, hash_end=None):
+    """
+    Combines the start/middle/end chunk hashes and the file size into one digest.
+    Only defined when all three parts were hashed, so keys are always comparable.
+    """
+    if not (content_hash and hash_middle and hash_end):
+        return None
+    material = f"{file_size or 0}|{content_hash}|{hash_middle}|{hash_end}"
+    return hashlib.sha256(material.encode()).hexdigest()
+
+def build_processed_file_document(file_unique_id, caption, content_hash=None, hash_middle=None, hash_end=None, file_size=None, file_name=None, duration=None, message_id=None, fingerprint=None, file_id=None, file_type=None, caption_html=None, publish_pending=False):
+    """
+    Builds the processed_files record for a file, leaving out empty fields.
+    With publish_pending the record is marked until confirm_processed_file()
+    is called once the file has been posted.
     """
     document = {
         '_id': file_unique_id,
         'caption': caption,
         'processed_at': tm()
     }
+    if message_id: document['message_id'] = message_id
+    if fingerprint: document['fingerprint'] = fingerprint
     if content_hash: document['content_hash'] = content_hash
     if hash_middle: document['hash_middle'] = hash_middle
     if hash_end: document['hash_end'] = hash_end
     if file_size: document['file_size'] = file_size
     if file_name: document['file_name'] = file_name
     if duration: document['duration'] = duration
+    # Telegram reference used to deliver the file without fetching the DB_CHANNEL message
+    if file_id: document['file_id'] = file_id
+    if file_type: document['file_type'] = file_type
+    if caption_html: document['caption_html'] = caption_html
+    if publish_pending: document['publish_pending'] = True
+    return document
+
+def _remember_processed_file(document):
+    """Keeps the legacy-hash flag and the dedup filter in step with a newly stored record."""
+    global legacy_hash_records
+    if not document.get('fingerprint') and (document.get('content_hash') or document.get('hash_middle') or document.get('hash_end')):
+        legacy_hash_records = True
+
+    for bloom in (dedup_filter, _dedup_filter_building):
+        if bloom is not None:
+            for key in processed_file_keys(
+                document['_id'], document['caption'], document.get('content_hash'), document.get('hash_middle'), document.get('hash_end'),
+                document.get('file_size'), document.get('file_name'), document.get('duration'), document.get('fingerprint')
+            ):
+                bloom.add(key)
+
+async def add_processed_file(file_unique_id, caption, content_hash=None, hash_middle=None, hash_end=None, file_size=None, file_name=None, duration=None, message_id=None, fingerprint=None):
+    """
+    Adds a file's metadata and hashes to the processed files collection.
+    Tries DB1 first; if it fails (e.g. quota full), tries DB2.
+    Returns False if an identical record (same ID or fingerprint) already exists.
+    """
+    document = build_processed_file_document(file_unique_id, caption, content_hash, hash_middle, hash_end, file_size, file_name, duration, message_id, fingerprint)
+    return await add_processed_file_document(document)
+
+async def add_processed_file_document(document):
+    """add_processed_file() for a document from build_processed_file_document()."""
+    _remember_processed_file(document)
+    file_unique_id = document['_id']
 
     # Try inserting into DB 1
     try:
         await processed_files.insert_one(document)
-        return # Success
+        return True # Success
     except pymongo.errors.DuplicateKeyError:
-        return # Already exists, ignore
+        return False # Already exists
     except pymongo.errors.WriteError as e:
         logger.warning(f"WriteError on DB 1 (likely full): {e}. Attempting DB 2...")
     except Exception as e:
@@ -73,34 +179,76 @@ async def add_processed_file(file_unique_id, caption, content_hash=None, hash_mi
             await processed_files_2.insert_one(document)
             logger.info(f"Saved file {file_unique_id} to DB 2.")
         except pymongo.errors.DuplicateKeyError:
-            pass
+            return False
         except Exception as e:
             logger.error(f"Failed to save file to DB 2 as well: {e}")
     else:
         logger.error("DB 2 not configured or unavailable. File save failed.")
+    return True
 
-async def is_file_processed(file_unique_id, caption, content_hash=None, hash_middle=None, hash_end=None, file_size=None, file_name=None, duration=None):
+async def find_processed_batch(file_unique_ids, captions, metas):
+    """
+    Looks up a whole batch of files with one $in query per database.
+    `metas` holds (file_size, file_name, duration) tuples. Returns every record
+    that matches one of the IDs, captions or file names; the caller matches them
+    back to individual files. Values the dedup filter rules out are left out of the query.
+    """
+    if dedup_filter is not None:
+        file_unique_ids = [i for i in file_unique_ids if f"id:{i}" in dedup_filter]
+        captions = [c for c in captions if f"caption:{c}" in dedup_filter]
+        metas = [m for m in metas if m[0] and m[1] and f"meta:{m[0]}|{m[1]}|{m[2] or 0}" in dedup_filter]
+
+    query_conditions = []
+    if file_unique_ids: query_conditions.append({'_id': {'$in': list(set(file_unique_ids))}})
+    if captions: query_conditions.append({'caption': {'$in': list(set(captions))}})
+    file_names = {m[1] for m in metas if m[0] and m[1]}
+    if file_names: query_conditions.append({'file_name': {'$in': list(file_names)}})
+    if not query_conditions:
+        return []
+
+    query = {'$or': query_conditions}
+    projection = {'caption': 1, 'file_size': 1, 'file_name': 1, 'duration': 1, 'message_id': 1, 'publish_pending': 1}
+    documents = await processed_files.find(query, projection).to_list(length=None)
+    if processed_files_2 is not None:
+        documents += await processed_files_2.find(query, projection).to_list(length=None)
+    return documents
+
+async def is_file_processed(file_unique_id, caption, content_hash=None, hash_middle=None, hash_end=None, file_size=None, file_name=None, duration=None, fingerprint=None):
     """
     Checks if a file is a duplicate.
     Checks DB1 first, then DB2 if not found.
     Returns the matching document if found, otherwise None.
+
+    With a fingerprint the hash and metadata clauses are replaced by one
+    lookup on its unique index, next to the ID and caption lookups; the full
+    $or over individual hashes only runs while records without a fingerprint remain.
     """
+    global dedup_filter_skips
+    if dedup_filter is not None:
+        keys = processed_file_keys(file_unique_id, caption, content_hash, hash_middle, hash_end, file_size, file_name, duration, fingerprint)
+        if not any(key in dedup_filter for key in keys):
+            dedup_filter_skips += 1
+            return None
+
     query_conditions = [
         {'_id': file_unique_id},
         {'caption': caption}
     ]
 
-    if content_hash: query_conditions.append({'content_hash': content_hash})
-    if hash_middle: query_conditions.append({'hash_middle': hash_middle})
-    if hash_end: query_conditions.append({'hash_end': hash_end})
+    if fingerprint: query_conditions.append({'fingerprint': fingerprint})
 
-    # Composite check for re-uploads with different IDs/Hashes
-    if file_size and file_name:
-        query_conditions.append({
-            'file_size': file_size,
-            'file_name': file_name,
-            'duration': duration
-        })
+    if not fingerprint or legacy_hash_records:
+        if content_hash: query_conditions.append({'content_hash': content_hash})
+        if hash_middle: query_conditions.append({'hash_middle': hash_middle})
+        if hash_end: query_conditions.append({'hash_end': hash_end})
+
+        # Composite check for re-uploads with different IDs/Hashes
+        if file_size and file_name:
+            query_conditions.append({
+                'file_size': file_size,
+                'file_name': file_name,
+                'duration': duration
+            })
 
     query = {'$or': query_conditions}
 
@@ -131,9 +279,55 @@ async def remove_processed_file_by_caption(caption: str):
 
     return deleted_count
 
-async def remove_processed_file_by_id_or_hash(file_unique_id: str, content_hash: str = None, hash_middle: str = None, hash_end: str = None):
+async def get_stored_fingerprint(file_unique_id: str):
+    """Returns the stored hashes and fingerprint of a file by its unique ID (DB1, then DB2), or None."""
+    projection = {'content_hash': 1, 'hash_middle': 1, 'hash_end': 1, 'file_size': 1, 'fingerprint': 1}
+    doc = await processed_files.find_one({'_id': file_unique_id}, projection)
+    if doc is None and processed_files_2 is not None:
+        doc = await processed_files_2.find_one({'_id': file_unique_id}, projection)
+    return doc
+
+async def confirm_processed_file(message_id: int):
+    """Clears the publish_pending mark of a DB_CHANNEL message's record once it has been posted."""
+    update = {'$unset': {'publish_pending': ""}}
+    res = await processed_files.update_many({'message_id': message_id, 'publish_pending': True}, update)
+    if res.matched_count == 0 and processed_files_2 is not None:
+        await processed_files_2.update_many({'message_id': message_id, 'publish_pending': True}, update)
+
+async def discard_processed_file(message_id: int):
+    """Removes the still unconfirmed record of a DB_CHANNEL message whose post failed."""
+    query = {'message_id': message_id, 'publish_pending': True}
+    res = await processed_files.delete_many(query)
+    if res.deleted_count == 0 and processed_files_2 is not None:
+        await processed_files_2.delete_many(query)
+
+async def get_file_reference(message_id: int):
+    """Returns the stored file_id, file_type and caption_html of a DB_CHANNEL message, or None."""
+    projection = {'file_id': 1, 'file_type': 1, 'caption_html': 1}
+    doc = await processed_files.find_one({'message_id': message_id}, projection)
+    if doc is None and processed_files_2 is not None:
+        doc = await processed_files_2.find_one({'message_id': message_id}, projection)
+    return doc
+
+async def save_file_reference(message_id: int, file_id: str, file_type: str, caption_html: str):
+    """Stores the delivery reference on an existing record (records from before file_id was stored)."""
+    update = {'$set': {'file_id': file_id, 'file_type': file_type, 'caption_html': caption_html}}
+    res = await processed_files.update_one({'message_id': message_id}, update)
+    if res.matched_count == 0 and processed_files_2 is not None:
+        await processed_files_2.update_one({'message_id': message_id}, update)
+
+async def forget_file_references(message_ids):
+    """Drops the stored delivery reference of DB_CHANNEL messages that were deleted."""
+    query = {'message_id': {'$in': list(message_ids)}}
+    update = {'$unset': {'file_id': "", 'file_type': "", 'caption_html': ""}}
+    await processed_files.update_many(query, update)
+    if processed_files_2 is not None:
+        await processed_files_2.update_many(query, update)
+
+async def remove_processed_file_by_id_or_hash(file_unique_id: str, content_hash: str = None, hash_middle: str = None, hash_end: str = None, fingerprint: str = None):
     """Removes a file's record based on file_unique_id or content_hash."""
     or_conditions = [{'_id': file_unique_id}]
+    if fingerprint: or_conditions.append({'fingerprint': fingerprint})
     if content_hash: or_conditions.append({'content_hash': content_hash})
     if hash_middle: or_conditions.append({'hash_middle': hash_middle})
     if hash_end: or_conditions.append({'hash_end': hash_end})
@@ -157,6 +351,7 @@ async def remove_any_duplicate(arg: str):
     query = {
         '$or': [
             {'_id': arg},
+            {'fingerprint': arg},
             {'content_hash': arg},
             {'hash_middle': arg},
             {'hash_end': arg},
@@ -191,11 +386,216 @@ async def ensure_indexes():
             ("file_size", pymongo.ASCENDING),
             ("duration", pymongo.ASCENDING)
         ], sparse=True)
+        await collection.create_index([("fingerprint", pymongo.ASCENDING)], unique=True, sparse=True)
+        await collection.create_index([("message_id", pymongo.ASCENDING)], sparse=True)
 
     await create_idxs(processed_files)
     if processed_files_2 is not None:
         await create_idxs(processed_files_2)
 
+    await backfill_fingerprints()
+
+    # Ingest journal: pending lookups by state, finished entries expire after a week
+    await ingest_journal.create_index([("state", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)])
+    await ingest_journal.create_index("finished_at", expireAfterSeconds=JOURNAL_RETENTION)
+
+    # TMDB lookups expire on their own deadline
+    await tmdb_cache.create_index("expires_at", expireAfterSeconds=0)
+
+    # Pending deletions are loaded in due order; Telegram refuses deletes of old messages, so leftovers expire
+    await scheduled_deletions.create_index([("due_at", pymongo.ASCENDING)])
+    await scheduled_deletions.create_index("created_at", expireAfterSeconds=SCHEDULED_DELETION_RETENTION)
+
+async def backfill_fingerprints():
+    """
+    Computes the composite fingerprint for records stored before it existed,
+    from their stored hashes, so duplicate checks can skip the $or fallback.
+    """
+    global legacy_hash_records
+    legacy_query = {
+        'fingerprint': {'$exists': False},
+        'content_hash': {'$exists': True},
+        'hash_middle': {'$exists': True},
+        'hash_end': {'$exists': True}
+    }
+    remaining = False
+
+    for collection in (processed_files, processed_files_2):
+        if collection is None:
+            continue
+        operations = []
+        async for doc in collection.find(legacy_query, {'content_hash': 1, 'hash_middle': 1, 'hash_end': 1, 'file_size': 1}):
+            key = make_fingerprint_key(doc.get('file_size'), doc['content_hash'], doc['hash_middle'], doc['hash_end'])
+            operations.append(UpdateOne({'_id': doc['_id']}, {'$set': {'fingerprint': key}}))
+        for i in range(0, len(operations), 1000):
+            try:
+                await collection.bulk_write(operations[i:i + 1000], ordered=False)
+            except pymongo.errors.BulkWriteError as e:
+                # Records sharing a fingerprint are existing duplicates; they stay on the fallback path
+                logger.warning(f"Fingerprint backfill skipped {len(e.details.get('writeErrors', []))} conflicting records.")
+        if operations:
+            logger.info(f"Backfilled fingerprints for {len(operations)} processed file records.")
+
+        hashed_without_key = {
+            'fingerprint': {'$exists': False},
+            '$or': [{'content_hash': {'$exists': True}}, {'hash_middle': {'$exists': True}}, {'hash_end': {'$exists': True}}]
+        }
+        if await collection.count_documents(hashed_without_key, limit=1):
+            remaining = True
+
+    legacy_hash_records = remaining
+
+# --- Ingest Journal Functions ---
+
+JOURNAL_RETENTION = 7 * 24 * 60 * 60
+JOURNAL_MAX_ATTEMPTS = 5
+JOURNAL_FINAL_STATES = ('published', 'duplicate', 'failed', 'skipped')
+
+async def add_ingest_entries(message_ids, source, lease_owner=None, lease_seconds=0):
+    """
+    Records DB_CHANNEL message ids as pending in the ingest journal.
+    If lease_owner is given the entries are leased to it straight away (live uploads).
+    Otherwise entries under a live lease are left alone, so an /index range that
+    overlaps files already in the pipeline does not queue them a second time.
+    """
+    now = tm()
+    state_fields = {'state': 'pending', 'source': source, 'enqueued_at': now, 'attempts': 0}
+    if lease_owner:
+        state_fields.update({'state': 'leased', 'lease_owner': lease_owner, 'lease_until': now + lease_seconds, 'attempts': 1})
+        operations = [
+            UpdateOne({'_id': message_id}, {'$set': state_fields, '$unset': {'finished_at': "", 'error': ""}}, upsert=True)
+            for message_id in message_ids
+        ]
+        for i in range(0, len(operations), 1000):
+            await ingest_journal.bulk_write(operations[i:i + 1000], ordered=False)
+        return len(operations)
+
+    not_in_flight = {'$or': [{'state': {'$nin': ['leased', 'hashing']}}, {'lease_until': {'$lt': now}}]}
+    unset_fields = {'finished_at': "", 'error': "", 'lease_owner': "", 'lease_until': ""}
+    for i in range(0, len(message_ids), 1000):
+        chunk = message_ids[i:i + 1000]
+        await ingest_journal.update_many({'_id': {'$in': chunk}, **not_in_flight}, {'$set': state_fields, '$unset': unset_fields})
+        await ingest_journal.bulk_write(
+            [UpdateOne({'_id': message_id}, {'$setOnInsert': state_fields}, upsert=True) for message_id in chunk],
+            ordered=False
+        )
+    return len(message_ids)
+
+async def lease_ingest_entries(lease_owner, limit, lease_seconds):
+    """
+    Leases up to `limit` pending (or abandoned) journal entries in message order.
+    Returns the leased entries as a list of {'_id', 'source', 'attempts'} documents.
+    """
+    now = tm()
+    available = {
+        'attempts': {'$lt': JOURNAL_MAX_ATTEMPTS},
+        '$or': [
+            {'state': 'pending'},
+            {'state': {'$in': ['leased', 'hashing']}, 'lease_until': {'$lt': now}}
+        ]
+    }
+    candidate_ids = [doc['_id'] async for doc in ingest_journal.find(available, {'_id': 1}).sort('_id', 1).limit(limit)]
+    if not candidate_ids:
+        return []
+
+    lease_id = f"{lease_owner}:{uuid.uuid4().hex}"
+    await ingest_journal.update_many(
+        {'_id': {'$in': candidate_ids}, **available},
+        {'$set': {'state': 'leased', 'lease_owner': lease_id, 'lease_until': now + lease_seconds}, '$inc': {'attempts': 1}}
+    )
+    cursor = ingest_journal.find({'_id': {'$in': candidate_ids}, 'lease_owner': lease_id}, {'_id': 1, 'source': 1, 'attempts': 1})
+    return [doc async for doc in cursor.sort('_id', 1)]
+
+async def renew_ingest_leases(lease_owner, message_ids, lease_seconds):
+    """Extends the leases `lease_owner` holds on entries still waiting in its pipeline."""
+    if not message_ids: return 0
+    res = await ingest_journal.update_many(
+        {
+            '_id': {'$in': list(message_ids)},
+            'state': {'$in': ['leased', 'hashing']},
+            'lease_owner': {'$regex': f"^{lease_owner}"}
+        },
+        {'$set': {'lease_until': tm() + lease_seconds}}
+    )
+    return res.modified_count
+
+async def update_ingest_states(updates):
+    """Applies a batch of (message_id, state, error) journal transitions in one round trip."""
+    if not updates: return
+    operations = []
+    for message_id, state, error in updates:
+        if state in JOURNAL_FINAL_STATES:
+            update = {'$set': {'state': state, 'finished_at': datetime.utcnow()}, '$unset': {'lease_owner': "", 'lease_until': ""}}
+            if error: update['$set']['error'] = error
+        else:
+            update = {'$set': {'state': state}}
+        operations.append(UpdateOne({'_id': message_id}, update))
+    await ingest_journal.bulk_write(operations, ordered=True)
+
+async def requeue_stale_ingest_entries():
+    """
+    Called on startup: entries leased by a previous process go back to pending,
+    entries that keep failing are given up on.
+    """
+    in_flight = {'state': {'$in': ['leased', 'hashing']}}
+    await ingest_journal.update_many(
+        {**in_flight, 'attempts': {'$gte': JOURNAL_MAX_ATTEMPTS}},
+        {'$set': {'state': 'failed', 'error': 'Too many attempts', 'finished_at': datetime.utcnow()}, '$unset': {'lease_owner': "", 'lease_until': ""}}
+    )
+    res = await ingest_journal.update_many(in_flight, {'$set': {'state': 'pending'}, '$unset': {'lease_owner': "", 'lease_until': ""}})
+    return res.modified_count
+
+async def get_ingest_journal_stats(first_id=None, last_id=None):
+    """Returns the number of journal entries per state, optionally for a range of message ids only."""
+    pipeline = [{'$group': {'_id': '$state', 'count': {'$sum': 1}}}]
+    if first_id is not None and last_id is not None:
+        pipeline.insert(0, {'$match': {'_id': {'$gte': first_id, '$lte': last_id}}})
+    counts = {}
+    async for doc in ingest_journal.aggregate(pipeline):
+        counts[doc['_id']] = doc['count']
+    return counts
+
+# --- Scheduled Deletion Functions ---
+
+SCHEDULED_DELETION_RETENTION = 2 * 24 * 60 * 60
+
+async def add_scheduled_deletions(entries):
+    """Persists (due_at, chat_id, message_id) deletions; a message scheduled twice keeps its earliest due time."""
+    if not entries: return
+    now = datetime.utcnow()
+    operations = [
+        UpdateOne(
+            {'_id': f"{chat_id}:{message_id}"},
+            {'$min': {'due_at': due_at}, '$setOnInsert': {'chat_id': chat_id, 'message_id': message_id, 'created_at': now}},
+            upsert=True
+        )
+        for due_at, chat_id, message_id in entries
+    ]
+    await scheduled_deletions.bulk_write(operations, ordered=False)
+
+async def load_scheduled_deletions():
+    """Returns every pending deletion as (due_at, chat_id, message_id), earliest first."""
+    cursor = scheduled_deletions.find({}, {'due_at': 1, 'chat_id': 1, 'message_id': 1}).sort('due_at', 1)
+    return [(doc['due_at'], doc['chat_id'], doc['message_id']) async for doc in cursor]
+
+async def remove_scheduled_deletions(chat_id: int, message_ids):
+    await scheduled_deletions.delete_many({'_id': {'$in': [f"{chat_id}:{message_id}" for message_id in message_ids]}})
+
+async def get_tmdb_cache(key: str):
+    """Returns the cached TMDB lookup for a normalized title key, or None if absent or expired."""
+    doc = await tmdb_cache.find_one({'_id': key})
+    if doc and doc['expires_at'].replace(tzinfo=timezone.utc) > datetime.now(timezone.utc):
+        return doc
+    return None
+
+async def set_tmdb_cache(key: str, poster_url, ttl: int):
+    """Caches a TMDB lookup result; poster_url None records a lookup without a match."""
+    await tmdb_cache.update_one(
+        {'_id': key},
+        {'$set': {'poster_url': poster_url, 'expires_at': datetime.now(timezone.utc) + timedelta(seconds=ttl)}},
+        upsert=True
+    )
+
 async def save_shortener_link(request_id: str, shortened_url: str):
     """Saves the shortened URL mapping. (Only needs to be in DB1 for now)"""
     try:
@@ -218,17 +618,85 @@ async def get_shortener_link_async(request_id: str):
     req = await shortener_requests.find_one({'_id': request_id})
     return req.get('shortened_url') if req else None
 
-async def present_user(user_id : int):
-    # Check DB 1
-    found = await user_data.find_one({'_id': user_id})
-    if found: return True
+# --- User Shard Directory ---
+# Users are stored in DB1 unless DB1 refused the insert. Every user stored in DB2 also gets an
+# entry in DB2's user_directory collection, written with the user. The shard of a user is looked
+# up there the first time it is needed and kept in a bounded in-memory cache, so per-user
+# operations go to the database that holds the user. A miss there falls back to the other
+# database and repairs the directory entry (users stored in DB2 before the directory existed).
+
+user_directory = async_db_2['user_directory'] if async_db_2 is not None else None
+_user_shards = OrderedDict() # user_id -> True if the user is stored in DB2
+
+def _remember_shard(user_id, in_db2):
+    _user_shards[user_id] = in_db2
+    _user_shards.move_to_end(user_id)
+    while len(_user_shards) > USER_CACHE_SIZE:
+        _user_shards.popitem(last=False)
+
+async def register_db2_user(user_id):
+    """Records a user just written to DB2 in the directory."""
+    _remember_shard(user_id, True)
+    await user_directory.replace_one({'_id': user_id}, {'_id': user_id}, upsert=True)
+
+async def unregister_users(user_ids):
+    """Drops deleted users from the directory."""
+    for user_id in user_ids:
+        _user_shards.pop(user_id, None)
+    if user_directory is not None:
+        await user_directory.delete_many({'_id': {'$in': list(user_ids)}})
+
+async def _users_for(user_id):
+    """Returns (collection expected to hold the user, the other collection or None)."""
+    if user_data_2 is None:
+        return user_data, None
+    in_db2 = _user_shards.get(user_id)
+    if in_db2 is None:
+        in_db2 = await user_directory.find_one({'_id': user_id}) is not None
+        _remember_shard(user_id, in_db2)
+    if in_db2:
+        return user_data_2, user_data
+    return user_data, user_data_2
+
+async def _found_in(collection, user_id):
+    """Repairs the directory after the user turned up in `collection`."""
+    if collection is user_data_2:
+        await register_db2_user(user_id)
+    else:
+        _remember_shard(user_id, False)
+        await user_directory.delete_one({'_id': user_id})
 
-    # Check DB 2
-    if user_data_2 is not None:
-        found_2 = await user_data_2.find_one({'_id': user_id})
-        return bool(found_2)
+def _split_by_database(user_ids):
+    """
+    Splits user ids into (collection, ids) pairs, one per database holding some of them.
+    Users whose shard isn't cached are sent to both databases.
+    """
+    if user_data_2 is None:
+        return [(user_data, list(user_ids))]
+    db1_ids = [user_id for user_id in user_ids if _user_shards.get(user_id) is not True]
+    db2_ids = [user_id for user_id in user_ids if _user_shards.get(user_id) is not False]
+    return [(collection, ids) for collection, ids in ((user_data, db1_ids), (user_data_2, db2_ids)) if ids]
+
+async def _find_user(user_id: int):
+    collection, fallback = await _users_for(user_id)
+    user = await collection.find_one({'_id': user_id})
+    if user is None and fallback is not None:
+        user = await fallback.find_one({'_id': user_id})
+        if user is not None:
+            await _found_in(fallback, user_id)
+    return user
+
+async def _update_user(user_id: int, update: dict):
+    collection, fallback = await _users_for(user_id)
+    res = await collection.update_one({'_id': user_id}, update)
+    if res.matched_count == 0 and fallback is not None:
+        res = await fallback.update_one({'_id': user_id}, update)
+        if res.matched_count:
+            await _found_in(fallback, user_id)
+    return res
 
-    return False
+async def present_user(user_id : int):
+    return bool(await _find_user(user_id))
 
 async def add_user(user_id: int):
     """Adds a new user. Tries DB1 first, then DB2."""
@@ -254,6 +722,7 @@ async def add_user(user_id: int):
     if user_data_2 is not None:
         try:
             await user_data_2.insert_one(user_doc)
+            await register_db2_user(user_id)
         except:
             pass
     return
@@ -266,30 +735,23 @@ async def update_user_data(user_id: int, data: dict):
     # Handle $unset operations if passed in data (keys starting with $)
     # If data contains MongoDB operators (like $unset), pass them directly
     if any(k.startswith('$') for k in data.keys()):
-        # Try Update DB 1
-        res = await user_data.update_one({'_id': user_id}, data)
-
-        # If not found in DB 1, try DB 2
-        if res.matched_count == 0 and user_data_2 is not None:
-             await user_data_2.update_one({'_id': user_id}, data)
+        await _update_user(user_id, data)
         return
 
     update_doc = {k: v for k, v in data.items() if k in valid_fields}
     if not update_doc: return
 
-    # Try Update DB 1
-    res = await user_data.update_one(
-        {'_id': user_id},
-        {'$set': update_doc}
-    )
+    # Update wherever the user is stored
+    res = await _update_user(user_id, {'$set': update_doc})
 
-    # If not found in DB 1, try DB 2
+    # Unknown user: created in DB 2 if it is configured
     if res.matched_count == 0 and user_data_2 is not None:
         await user_data_2.update_one(
             {'_id': user_id},
             {'$set': update_doc},
-            upsert=True # If user moved to DB2 or new
+            upsert=True
         )
+        await register_db2_user(user_id)
     elif res.matched_count == 0 and user_data_2 is None:
         # If DB2 not active, upsert to DB1
          await user_data.update_one(
@@ -299,11 +761,19 @@ async def update_user_data(user_id: int, data: dict):
         )
     return
 
+async def load_user_state(user_id: int):
+    """Fetches the user's document from the database that holds it. Returns it, or None."""
+    if user_data_2 is None or user_id in _user_shards:
+        return await _find_user(user_id)
+    # Shard not cached yet: ask both databases at once instead of the directory first
+    results = await asyncio.gather(user_data.find_one({'_id': user_id}), user_data_2.find_one({'_id': user_id}))
+    if results[0] is not None or results[1] is not None:
+        _remember_shard(user_id, results[0] is None)
+    return results[0] or results[1]
+
 async def get_user_data(user_id: int):
-    """Gets the user's data. Checks both DBs."""
-    user = await user_data.find_one({'_id': user_id})
-    if not user and user_data_2 is not None:
-        user = await user_data_2.find_one({'_id': user_id})
+    """Gets the user's data from the database that holds them."""
+    user = await _find_user(user_id)
 
     if user:
         return {
@@ -321,47 +791,23 @@ async def get_user_data(user_id: int):
 
 async def increment_file_count(user_id: int):
     """Increments the file count for a user."""
-    res = await user_data.update_one(
-        {'_id': user_id},
-        {'$inc': {'file_count': 1}}
-    )
-    if res.matched_count == 0 and user_data_2 is not None:
-        await user_data_2.update_one(
-            {'_id': user_id},
-            {'$inc': {'file_count': 1}}
-        )
+    await _update_user(user_id, {'$inc': {'file_count': 1}})
     return
 
-async def load_all_user_data():
-    """Loads all user data from both databases."""
-    all_user_data = {}
-
-    # Load from DB 1
-    async for user in user_data.find({}):
-        all_user_data[user['_id']] = {
-            'token': user.get('token'),
-            'time': user.get('time', 0),
-            'status': user.get('status', 'unverified'),
-            'file_count': user.get('file_count', 0),
-            'extension_stage': user.get('extension_stage', 0),
-            'inittime': user.get('inittime', 0),
-            'bypass_attempts': user.get('bypass_attempts', 0)
-        }
-
-    # Load from DB 2 (Overwrites if duplicate ID, which shouldn't happen ideally)
-    if user_data_2 is not None:
-        async for user in user_data_2.find({}):
-            all_user_data[user['_id']] = {
-                'token': user.get('token'),
-                'time': user.get('time', 0),
-                'status': user.get('status', 'unverified'),
-                'file_count': user.get('file_count', 0),
-                'extension_stage': user.get('extension_stage', 0),
-                'inittime': user.get('inittime', 0),
-                'bypass_attempts': user.get('bypass_attempts', 0)
-            }
-
-    return all_user_data
+async def claim_file_quota(user_id: int, daily_limit: int):
+    """
+    Atomically counts one delivered file against the user's limit.
+    Returns the new file_count, or None if the limit is already used up (or the user is unknown).
+    """
+    query = {'_id': user_id, '$or': [{'file_count': {'$lt': daily_limit}}, {'file_count': {'$exists': False}}]}
+    update = {'$inc': {'file_count': 1}}
+    collection, fallback = await _users_for(user_id)
+    doc = await collection.find_one_and_update(query, update, projection={'file_count': 1}, return_document=ReturnDocument.AFTER)
+    if doc is None and fallback is not None:
+        doc = await fallback.find_one_and_update(query, update, projection={'file_count': 1}, return_document=ReturnDocument.AFTER)
+        if doc is not None:
+            await _found_in(fallback, user_id)
+    return doc['file_count'] if doc else None
 
 async def full_userbase():
     user_ids = []
@@ -376,9 +822,11 @@ async def full_userbase():
     return user_ids
 
 async def del_user(user_id: int):
-    await user_data.delete_one({'_id': user_id})
-    if user_data_2 is not None:
-        await user_data_2.delete_one({'_id': user_id})
+    collection, fallback = await _users_for(user_id)
+    await collection.delete_one({'_id': user_id})
+    if fallback is not None:
+        await fallback.delete_one({'_id': user_id})
+    await unregister_users([user_id])
     return
 
 async def ban_user(user_id: int, ban_duration: int):
@@ -389,11 +837,13 @@ async def ban_user(user_id: int, ban_duration: int):
         {'$set': {'ban_until': ban_until}},
         upsert=True
     )
+    ban_registry.ban(user_id, ban_until)
     return
 
 async def unban_user(user_id: int):
     """Unbans a user."""
     await banned_users.delete_one({'_id': user_id})
+    ban_registry.unban(user_id)
     await reset_bypass_attempts(user_id)
     return
 
@@ -404,103 +854,119 @@ async def get_bypass_attempts(user_id: int):
 
 async def increment_bypass_attempts(user_id: int):
     """Increments the bypass attempts."""
-    res = await user_data.update_one(
-        {'_id': user_id},
-        {'$inc': {'bypass_attempts': 1}}
-    )
-    if res.matched_count == 0 and user_data_2 is not None:
-         await user_data_2.update_one(
-            {'_id': user_id},
-            {'$inc': {'bypass_attempts': 1}}
-        )
+    await _update_user(user_id, {'$inc': {'bypass_attempts': 1}})
     return
 
 async def reset_bypass_attempts(user_id: int):
     """Resets the bypass attempts."""
-    res = await user_data.update_one(
-        {'_id': user_id},
-        {'$set': {'bypass_attempts': 0}}
-    )
-    if res.matched_count == 0 and user_data_2 is not None:
-        await user_data_2.update_one(
-            {'_id': user_id},
-            {'$set': {'bypass_attempts': 0}}
-        )
+    await _update_user(user_id, {'$set': {'bypass_attempts': 0}})
     return
 
 async def is_user_banned(user_id: int):
-    """Checks if a user is currently banned."""
-    user = await banned_users.find_one({'_id': user_id})
-    if user:
-        ban_until = user.get('ban_until', 0)
-        if tm() < ban_until:
-            return True
-        else:
-            await banned_users.delete_one({'_id': user_id})
-            await reset_bypass_attempts(user_id)
-            return False
-    return False
+    """Checks if a user is currently banned (in memory, see load_ban_registry)."""
+    return ban_registry.is_banned(user_id)
+
+async def load_ban_registry():
+    """Loads every stored ban into the in-memory registry. Called once on startup."""
+    bans = [(doc['_id'], doc.get('ban_until', 0)) async for doc in banned_users.find({}, {'ban_until': 1})]
+    ban_registry.load(bans)
+    logger.info(f"Ban registry loaded with {len(bans)} bans.")
+    return len(bans)
+
+async def expire_bans():
+    """
+    Removes the bans that ran out and resets those users' bypass attempts,
+    with one bulk write per collection. Returns the user ids that were unbanned.
+    """
+    user_ids = ban_registry.pop_expired()
+    if not user_ids:
+        return []
+    await banned_users.delete_many({'_id': {'$in': user_ids}, 'ban_until': {'$lte': tm()}})
+    for collection, ids in _split_by_database(user_ids):
+        await collection.update_many({'_id': {'$in': ids}}, {'$set': {'bypass_attempts': 0}})
+    return user_ids
 
 # --- New Daily Statistics Functions ---
 
 STATS_ID = "daily_stats_v2"
+# Increments are buffered in memory and written as one $inc per day document.
+# At most DAILY_STATS_MAX_PENDING increments, or DAILY_STATS_FLUSH_INTERVAL seconds of them, are lost on a crash.
+DAILY_STATS_FLUSH_INTERVAL = 5
+DAILY_STATS_MAX_PENDING = 100
+
+_daily_stats_pending = {} # (day, field) -> count not yet written
+_daily_stats_pending_total = 0
+
+def stats_day():
+    """The current statistics day (IST), e.g. '2024-05-31'."""
+    try:
+        TZ_IST = ZoneInfo("Asia/Kolkata")
+    except Exception:
+        TZ_IST = timezone.utc
+    return datetime.now(TZ_IST).date().isoformat()
+
+def _stats_day_id(day):
+    return f"{STATS_ID}:{day}"
 
 async def get_daily_stats():
-    """Retrieves the daily statistics document (DB1)."""
-    stats = await daily_stats.find_one({'_id': STATS_ID})
-    if not stats:
-        return {'verified_today': 0, 'files_shared_today': 0}
-    return stats
+    """Retrieves today's statistics (DB1), including increments not flushed yet."""
+    day = stats_day()
+    stats = await daily_stats.find_one({'_id': _stats_day_id(day)}) or {}
+    return {
+        field: stats.get(field, 0) + _daily_stats_pending.get((day, field), 0)
+        for field in ('verified_today', 'files_shared_today')
+    }
+
+async def _increment_daily_stat(field):
+    global _daily_stats_pending_total
+    key = (stats_day(), field)
+    _daily_stats_pending[key] = _daily_stats_pending.get(key, 0) + 1
+    _daily_stats_pending_total += 1
+    if _daily_stats_pending_total >= DAILY_STATS_MAX_PENDING:
+        await flush_daily_stats()
 
 async def increment_verified_today():
-    await daily_stats.update_one(
-        {'_id': STATS_ID},
-        {'$inc': {'verified_today': 1}},
-        upsert=True
-    )
+    await _increment_daily_stat('verified_today')
 
 async def increment_files_shared_today():
-    await daily_stats.update_one(
-        {'_id': STATS_ID},
-        {'$inc': {'files_shared_today': 1}},
-        upsert=True
-    )
+    await _increment_daily_stat('files_shared_today')
+
+async def flush_daily_stats():
+    """Writes the buffered increments, one upsert per day. Failed writes stay buffered for the next flush."""
+    global _daily_stats_pending, _daily_stats_pending_total
+    pending, _daily_stats_pending = _daily_stats_pending, {}
+    _daily_stats_pending_total = 0
+    per_day = {}
+    for (day, field), count in pending.items():
+        per_day.setdefault(day, {})[field] = count
+
+    for day, increments in per_day.items():
+        try:
+            await daily_stats.update_one({'_id': _stats_day_id(day)}, {'$inc': increments}, upsert=True)
+        except Exception as e:
+            logger.error(f"Failed to flush daily stats for {day}: {e}")
+            for field, count in increments.items():
+                _daily_stats_pending[(day, field)] = _daily_stats_pending.get((day, field), 0) + count
+                _daily_stats_pending_total += count
 
 # --- End New Daily Statistics Functions ---
 
 async def reset_daily_stats_v2():
+    """
+    Counters live in one document per day, so nothing is zeroed here: the new day
+    is recorded once and True is returned the first time this runs on a new day.
+    """
+    today = stats_day()
+    await flush_daily_stats()
     try:
-        TZ_IST = ZoneInfo("Asia/Kolkata")
-    except Exception:
-        TZ_IST = timezone.utc
-
-    stats_doc = await daily_stats.find_one({'_id': STATS_ID})
-
-    last_reset_timestamp = 0
-    if stats_doc and 'last_reset' in stats_doc:
-        last_reset_timestamp = stats_doc['last_reset']
-
-    try:
-        last_reset_date = datetime.fromtimestamp(last_reset_timestamp, tz=TZ_IST).date()
-    except (TypeError, ValueError):
-        last_reset_date = datetime.now(TZ_IST).date() - timedelta(days=1)
-
-    current_date = datetime.now(TZ_IST).date()
-
-    if current_date != last_reset_date:
-        await daily_stats.update_one(
-            {'_id': STATS_ID},
-            {
-                '$set': {
-                    'verified_today': 0,
-                    'files_shared_today': 0,
-                    'last_reset': tm()
-                }
-            },
+        res = await daily_stats.update_one(
+            {'_id': STATS_ID, 'day': {'$ne': today}},
+            {'$set': {'day': today, 'last_reset': tm()}},
             upsert=True
         )
-        return True
-    return False
+    except pymongo.errors.DuplicateKeyError:
+        return False # Already reset today
+    return bool(res.modified_count or res.upserted_id is not None)
 
 async def get_dynamic_config():
     """Loads dynamic configuration from database."""
@@ -558,12 +1024,10 @@ async def delete_users_bulk(user_ids):
     if not user_ids: return 0
     deleted = 0
 
-    res1 = await user_data.delete_many({'_id': {'$in': user_ids}})
-    deleted += res1.deleted_count
-
-    if user_data_2 is not None:
-        res2 = await user_data_2.delete_many({'_id': {'$in': user_ids}})
-        deleted += res2.deleted_count
+    for collection, ids in _split_by_database(user_ids):
+        res = await collection.delete_many({'_id': {'$in': ids}})
+        deleted += res.deleted_count
+    await unregister_users(user_ids)
 
     return deleted
 
@@ -602,6 +1066,18 @@ async def get_db_stats():
     else:
         stats_text += "<b>DB 2:</b> Not Connected (No URI)"
 
+    filter_stats = get_dedup_filter_stats()
+    if filter_stats:
+        stats_text += (
+            f"\n\n<b>Dedup Filter:</b>\n"
+            f"Keys: {filter_stats['keys']}/{filter_stats['capacity']}\n"
+            f"Memory: {humanbytes(filter_stats['memory_bytes'])}\n"
+            f"Est. False Positives: {filter_stats['fp_rate']:.3%}\n"
+            f"Lookups Skipped: {filter_stats['skipped_lookups']}"
+        )
+    else:
+        stats_text += "\n\n<b>Dedup Filter:</b> Not Loaded"
+
     return stats_text
 
 async def clean_db(target: str):
@@ -632,6 +1108,8 @@ async def clean_db(target: str):
             if user_data_2 is not None:
                 r2 = await user_data_2.delete_many({})
                 count += r2.deleted_count
+                await user_directory.delete_many({})
+            _user_shards.clear()
             msg += f"✅ Removed {count} user records.\n"
         except Exception as e:
             msg += f"❌ Error cleaning users: {e}\n"
@@ -0,0 +1,56 @@
+import math
+import hashlib
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter sized for `capacity` keys at the target false-positive rate.
+    A key that is not in the filter has definitely never been added.
+    """
+
+    def __init__(self, capacity, fp_rate=0.01):
+        self.capacity = max(1, int(capacity))
+        self.target_fp_rate = fp_rate
+        self.size = max(64, int(-self.capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # Double hashing: k positions derived from one 128-bit digest
+        digest = hashlib.blake2b(key.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    @property
+    def false_positive_rate(self):
+        """Estimated false-positive rate for the number of keys added so far."""
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+    @property
+    def memory_bytes(self):
+        return len(self.bits)
+
+
+def processed_file_keys(file_unique_id=None, caption=None, content_hash=None, hash_middle=None, hash_end=None, file_size=None, file_name=None, duration=None, fingerprint=None):
+    """
+    Filter keys for every field is_file_processed() can match a record on.
+    Each field gets its own prefix so values never collide across fields.
+    """
+    keys = [f"caption:{caption}"]
+    if file_unique_id: keys.append(f"id:{file_unique_id}")
+    if fingerprint: keys.append(f"fp:{fingerprint}")
+    if content_hash: keys.append(f"start:{content_hash}")
+    if hash_middle: keys.append(f"middle:{hash_middle}")
+    if hash_end: keys.append(f"end:{hash_end}")
+    if file_size and file_name: keys.append(f"meta:{file_size}|{file_name}|{duration or 0}")
+    return keys
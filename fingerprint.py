@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import logging
+from pyrogram.errors import FloodWait
+from config import HASH_DOWNLOAD_CONCURRENCY
+from utils import notify_flood_wait, LRUCache
+from database import make_fingerprint_key, get_stored_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# stream_media works in 1 MB chunks
+CHUNK_SIZE = 1024 * 1024
+
+# Shared by every fingerprint so parallel chunk reads never exceed the download budget
+download_limiter = asyncio.Semaphore(HASH_DOWNLOAD_CONCURRENCY)
+
+# Recently computed fingerprints by file_unique_id
+fingerprint_cache = LRUCache(maxsize=1024, ttl=24 * 60 * 60)
+fingerprint_lookup_stats = {'memory_hits': 0, 'db_hits': 0, 'computed': 0}
+
+
+class Fingerprint:
+    """Hashes of the sampled start/middle/end chunks of a file."""
+
+    __slots__ = ('content_hash', 'hash_middle', 'hash_end', 'file_size', 'error')
+
+    def __init__(self, content_hash=None, hash_middle=None, hash_end=None, file_size=0, error=None):
+        self.content_hash = content_hash
+        self.hash_middle = hash_middle
+        self.hash_end = hash_end
+        self.file_size = file_size
+        self.error = error # First error hit while reading a chunk, if any
+
+    def __bool__(self):
+        return bool(self.content_hash or self.hash_middle or self.hash_end)
+
+    @property
+    def key(self):
+        """Composite key stored in processed_files, None unless every part was hashed."""
+        if self.error:
+            return None
+        return make_fingerprint_key(self.file_size, self.content_hash, self.hash_middle, self.hash_end)
+
+
+def parse_hash_parts(value):
+    """Parses the HASH_PARTS setting ("1,2,3") into a sorted list of part numbers."""
+    return sorted({int(p.strip()) for p in str(value).split(',') if p.strip() in ('1', '2', '3')})
+
+def chunk_offset(part, file_size):
+    """Returns the chunk index sampled for part 1 (start), 2 (middle) or 3 (end)."""
+    total_chunks = (file_size + CHUNK_SIZE - 1) // CHUNK_SIZE
+    if part == 1 or total_chunks == 0:
+        return 0
+    if part == 2:
+        return total_chunks // 2
+    return total_chunks - 1
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+async def read_chunk(client, message, offset, max_retries=3):
+    """Reads a single chunk of the message's media, retrying on FloodWait."""
+    for attempt in range(max_retries):
+        try:
+            async with download_limiter:
+                async for chunk in client.stream_media(message, offset=offset, limit=1):
+                    return chunk
+            return None
+        except FloodWait as e:
+            notify_flood_wait(e.value)
+            if attempt == max_retries - 1:
+                raise
+            wait_time = e.value + 5
+            logger.warning(f"FloodWait while reading chunk {offset} of message {message.id}. Sleeping {wait_time}s. Attempt {attempt + 1}/{max_retries}")
+            await asyncio.sleep(wait_time)
+
+async def _hash_part(client, message, part, file_size, max_retries):
+    chunk = await read_chunk(client, message, chunk_offset(part, file_size), max_retries)
+    if not chunk:
+        return None
+    # Hash in a worker thread so large chunks never block the event loop
+    return await asyncio.to_thread(_sha256, chunk)
+
+async def compute_fingerprint(client, message, hash_parts, max_retries=3):
+    """
+    Fetches the configured chunks of a file concurrently and hashes them.
+    Latency is bounded by the slowest chunk. If a chunk fails the remaining
+    hashes are still returned and the error is kept on the fingerprint.
+    """
+    media = message.document or message.video or message.audio
+    file_size = media.file_size or 0
+    parts = parse_hash_parts(hash_parts)
+
+    results = await asyncio.gather(
+        *(_hash_part(client, message, part, file_size, max_retries) for part in parts),
+        return_exceptions=True
+    )
+
+    hashes = {}
+    error = None
+    for part, result in zip(parts, results):
+        if isinstance(result, BaseException):
+            error = error or result
+        else:
+            hashes[part] = result
+
+    fingerprint = Fingerprint(hashes.get(1), hashes.get(2), hashes.get(3), file_size, error)
+    fingerprint_lookup_stats['computed'] += 1
+    if fingerprint and not error:
+        fingerprint_cache.set(media.file_unique_id, fingerprint)
+    return fingerprint
+
+async def find_fingerprint(file_unique_id):
+    """
+    Returns an already known fingerprint for a file without downloading anything:
+    from the local cache, else from its processed_files record. None if neither has hashes.
+    """
+    fingerprint = fingerprint_cache.get(file_unique_id, None)
+    if fingerprint is not None:
+        fingerprint_lookup_stats['memory_hits'] += 1
+        return fingerprint
+
+    doc = await get_stored_fingerprint(file_unique_id)
+    if not doc:
+        return None
+    fingerprint = Fingerprint(doc.get('content_hash'), doc.get('hash_middle'), doc.get('hash_end'), doc.get('file_size') or 0)
+    if not fingerprint:
+        return None
+    fingerprint_lookup_stats['db_hits'] += 1
+    fingerprint_cache.set(file_unique_id, fingerprint)
+    return fingerprint
@@ -0,0 +1,78 @@
+import sys
+import asyncio
+import hashlib
+import pymongo
+from time import perf_counter
+import database
+from database import build_processed_file_document, make_fingerprint_key, is_file_processed
+from config import MONGO_DB_NAME
+
+# Benchmark of the duplicate lookup: python3 fingerprint_benchmark.py [records] [lookups]
+# Fills processed_files in a scratch database next to MONGO_DB_NAME with synthetic records,
+# which is dropped afterwards, and times is_file_processed() with and without fingerprints.
+
+BATCH = 10000
+
+
+def _hash(value):
+    return hashlib.sha256(value.encode()).hexdigest()
+
+def synthetic_file(n):
+    """(is_file_processed() arguments, processed_files record) of synthetic file n."""
+    file_size = 500_000_000 + n * 1024
+    file_name = f"Show.{n // 1000}.S01E{n % 1000:03d}.1080p.WEB-DL.mkv"
+    hashes = (_hash(f"{n}:start"), _hash(f"{n}:middle"), _hash(f"{n}:end"))
+    fingerprint = make_fingerprint_key(file_size, *hashes)
+    args = (f"AgAD{n:012d}", file_name, *hashes, file_size, file_name, 1440, fingerprint)
+    return args, build_processed_file_document(*args[:8], message_id=n + 1, fingerprint=fingerprint)
+
+async def fill(collection, records):
+    await collection.delete_many({})
+    for start in range(0, records, BATCH):
+        await collection.insert_many([synthetic_file(n)[1] for n in range(start, min(start + BATCH, records))], ordered=False)
+
+    # The processed_files indexes of ensure_indexes()
+    await collection.create_index([("caption", pymongo.ASCENDING)])
+    for field in ("content_hash", "hash_middle", "hash_end", "file_name"):
+        await collection.create_index([(field, pymongo.ASCENDING)], sparse=True)
+    await collection.create_index([("file_name", pymongo.ASCENDING), ("file_size", pymongo.ASCENDING), ("duration", pymongo.ASCENDING)], sparse=True)
+    await collection.create_index([("fingerprint", pymongo.ASCENDING)], unique=True, sparse=True)
+
+async def measure(name, lookups, with_fingerprint, legacy):
+    """Times is_file_processed() for a mix of stored files (hits) and new files (misses)."""
+    database.legacy_hash_records = legacy
+    found = 0
+    start = perf_counter()
+    for args in lookups:
+        if not with_fingerprint:
+            args = args[:8]
+        found += await is_file_processed(*args) is not None
+    elapsed = perf_counter() - start
+    print(f"{name:<28} {elapsed / len(lookups) * 1000:7.3f} ms per lookup, {found} of {len(lookups)} found")
+
+async def main():
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    db_name = f"{MONGO_DB_NAME}_fingerprint_benchmark"
+    collection = database.async_client[db_name]['processed_files']
+
+    # is_file_processed() runs on the scratch collection only, without the dedup filter
+    database.processed_files = collection
+    database.processed_files_2 = None
+    database.dedup_filter = None
+    try:
+        start = perf_counter()
+        await fill(collection, records)
+        print(f"{records:,} synthetic records stored in {perf_counter() - start:.1f} s")
+
+        # Every other lookup is a file already stored, the rest are new uploads
+        step = max(1, records // count)
+        lookups = [synthetic_file(n * step % records if n % 2 == 0 else records + n)[0] for n in range(count)]
+        await measure("$or over all clauses", lookups, with_fingerprint=False, legacy=True)
+        await measure("fingerprint, ID and caption", lookups, with_fingerprint=True, legacy=False)
+    finally:
+        await database.async_client.drop_database(db_name)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
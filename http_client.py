@@ -0,0 +1,69 @@
+import logging
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# One pooled session per process, opened and closed by the bot / web app lifecycle
+_session = None
+
+http_stats = {
+    'requests': 0,
+    'new_connections': 0,
+    'reused_connections': 0,
+    'dns_cache_hits': 0,
+    'dns_cache_misses': 0
+}
+
+def _count(name):
+    async def handler(session, context, params):
+        http_stats[name] += 1
+    return handler
+
+def _trace_config():
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(_count('requests'))
+    trace.on_connection_create_end.append(_count('new_connections'))
+    trace.on_connection_reuseconn.append(_count('reused_connections'))
+    trace.on_dns_cache_hit.append(_count('dns_cache_hits'))
+    trace.on_dns_cache_miss.append(_count('dns_cache_misses'))
+    return trace
+
+async def start_http_client():
+    """Opens the shared session: keep-alive, cached DNS and bounded connections per host."""
+    global _session
+    if _session is not None and not _session.closed:
+        return _session
+    connector = aiohttp.TCPConnector(
+        limit=100,
+        limit_per_host=10,
+        ttl_dns_cache=300,
+        keepalive_timeout=30
+    )
+    _session = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=15, connect=5),
+        # Requests for different users must not share cookies
+        cookie_jar=aiohttp.DummyCookieJar(),
+        trace_configs=[_trace_config()]
+    )
+    logger.info("Shared HTTP client started.")
+    return _session
+
+async def get_http_session():
+    """Returns the shared session, opening it on first use if the lifecycle hook has not run."""
+    if _session is None or _session.closed:
+        return await start_http_client()
+    return _session
+
+async def close_http_client():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logger.info(f"Shared HTTP client closed. Stats: {get_http_stats()}")
+    _session = None
+
+def get_http_stats():
+    stats = dict(http_stats)
+    connections = stats['new_connections'] + stats['reused_connections']
+    stats['reuse_rate'] = stats['reused_connections'] / connections if connections else 0.0
+    return stats
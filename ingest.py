@@ -0,0 +1,591 @@
+import asyncio
+import heapq
+import logging
+import uuid
+from collections import deque
+from time import monotonic
+from pyrogram.errors import FloodWait
+from utils import notify_flood_wait
+from database import (
+    add_ingest_entries, lease_ingest_entries, renew_ingest_leases, update_ingest_states,
+    requeue_stale_ingest_entries, get_ingest_journal_stats,
+    JOURNAL_FINAL_STATES
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket shared by all ingest workers.
+    The refill rate and the allowed concurrency are halved whenever Telegram
+    answers with a FloodWait, and grow back slowly while files go through.
+    """
+
+    def __init__(self, rate_per_minute, max_concurrency, min_rate_per_minute=1):
+        self.min_rate = min_rate_per_minute
+        self.max_rate = max(rate_per_minute, min_rate_per_minute)
+        self.rate = self.max_rate
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = self.max_concurrency
+        self.flood_waits = 0
+        self.last_flood_wait = 0
+        self._tokens = float(self.max_concurrency)
+        self._updated = monotonic()
+        self._paused_until = 0.0
+        self._successes = 0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        self._tokens = min(float(self.concurrency), self._tokens + elapsed * self.rate / 60)
+
+    async def acquire(self):
+        """Waits until a token is available and consumes it."""
+        async with self._lock:
+            while True:
+                now = monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) * 60 / self.rate)
+
+    def report_flood_wait(self, seconds):
+        """Pauses the bucket for the FloodWait duration and backs off (multiplicative decrease)."""
+        self.flood_waits += 1
+        self.last_flood_wait = seconds
+        self._paused_until = max(self._paused_until, monotonic() + seconds)
+        self._tokens = 0.0
+        self._successes = 0
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.concurrency = max(1, self.concurrency // 2)
+        logger.warning(f"Ingest limiter: FloodWait of {seconds}s. Rate lowered to {self.rate:.1f} files/min, concurrency {self.concurrency}.")
+
+    def report_success(self):
+        """Slowly restores the rate and concurrency after a successful file (additive increase)."""
+        self._successes += 1
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+        if self._successes % 10 == 0 and self.concurrency < self.max_concurrency:
+            self.concurrency += 1
+
+
+class LaneQueue:
+    """
+    Ingest queue with one FIFO lane per kind of work (live uploads, backfills,
+    maintenance). get() serves the non-empty lanes by smooth weighted round
+    robin, so live uploads go first without starving the other lanes.
+    """
+
+    def __init__(self, weights):
+        self.weights = dict(weights)
+        self.lanes = list(self.weights) # Highest priority first
+        self._items = {lane: deque() for lane in self.lanes}
+        self._credit = {lane: 0 for lane in self.lanes}
+        self._waits = {lane: {'dequeued': 0, 'avg_wait': 0.0, 'max_wait': 0.0} for lane in self.lanes}
+        self._not_empty = asyncio.Event()
+
+    async def put(self, item, lane):
+        self._items[lane].append((monotonic(), item))
+        self._not_empty.set()
+
+    def _pick(self):
+        total = 0
+        best = None
+        for lane in self.lanes:
+            if not self._items[lane]:
+                continue
+            self._credit[lane] += self.weights[lane]
+            total += self.weights[lane]
+            if best is None or self._credit[lane] > self._credit[best]:
+                best = lane
+        self._credit[best] -= total
+        return best
+
+    async def get(self):
+        """Returns (item, lane)."""
+        while not any(self._items.values()):
+            self._not_empty.clear()
+            await self._not_empty.wait()
+
+        lane = self._pick()
+        enqueued_at, item = self._items[lane].popleft()
+        wait = monotonic() - enqueued_at
+        stats = self._waits[lane]
+        stats['dequeued'] += 1
+        stats['avg_wait'] = wait if stats['dequeued'] == 1 else stats['avg_wait'] * 0.9 + wait * 0.1
+        stats['max_wait'] = max(stats['max_wait'], wait)
+        return item, lane
+
+    def qsize(self, lane=None):
+        if lane is not None:
+            return len(self._items[lane])
+        return sum(len(items) for items in self._items.values())
+
+    def stats(self):
+        now = monotonic()
+        return {
+            lane: {
+                'depth': len(self._items[lane]),
+                'weight': self.weights[lane],
+                'oldest_wait': now - self._items[lane][0][0] if self._items[lane] else 0.0,
+                **self._waits[lane]
+            }
+            for lane in self.lanes
+        }
+
+
+class IngestJob:
+    """One DB_CHANNEL message travelling through the ingest stages. Stages attach their results as attributes."""
+
+    def __init__(self, seq, message, lane=None, priority=0, lane_seq=0):
+        self.seq = seq
+        self.message = message
+        self.lane = lane
+        self.priority = priority # Lane rank, 0 is served first by every stage
+        self.lane_seq = lane_seq # Arrival order within the lane
+
+
+class Stage:
+    """
+    One step of the ingest pipeline with its own workers and bounded input queue.
+    `handler(job)` returns None to pass the job on, or a final journal state to finish it.
+    The last stage may also return a future that resolves to the final state later.
+    Jobs from higher priority lanes are taken first. An ordered stage keeps the
+    arrival order within each lane and runs a single worker.
+    Workers of a throttled stage above the limiter's concurrency stay parked.
+    """
+
+    def __init__(self, name, handler, workers=1, queue_size=20, ordered=False, throttled=False):
+        self.name = name
+        self.handler = handler
+        self.ordered = ordered
+        self.throttled = throttled
+        self.workers = 1 if ordered else max(1, workers)
+        self.queue = _OrderedQueue(queue_size) if ordered else _PriorityQueue(queue_size)
+        self.active = 0
+        self.processed = 0
+
+
+class _PriorityQueue(asyncio.PriorityQueue):
+    """Bounded stage queue ordered by lane priority, then arrival."""
+
+    async def put(self, job):
+        await super().put((job.priority, job.seq, job))
+
+    async def get(self):
+        return (await super().get())[2]
+
+
+class _OrderedQueue:
+    """
+    Reorder buffer that hands out each lane's jobs by their lane sequence number
+    only, preferring the highest priority lane with a job due. Sequence numbers
+    of jobs that left the pipeline before reaching it are skipped. put() never
+    waits: a job that is due may still sit in an earlier stage behind the jobs
+    being put, so the buffer is bounded by the pipeline's in-flight slots instead.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._heaps = {}
+        self._next = {}
+        self._skipped = {}
+        self._changed = asyncio.Condition()
+
+    def _lane(self, lane):
+        if lane not in self._heaps:
+            self._heaps[lane] = []
+            self._next[lane] = 0
+            self._skipped[lane] = set()
+        return self._heaps[lane]
+
+    def _is_due(self, lane, lane_seq):
+        skipped = self._skipped[lane]
+        while self._next[lane] in skipped:
+            skipped.discard(self._next[lane])
+            self._next[lane] += 1
+        return lane_seq == self._next[lane]
+
+    def _due_job(self):
+        due = [
+            heap[0] for lane, heap in self._heaps.items()
+            if heap and self._is_due(lane, heap[0][1].lane_seq)
+        ]
+        return min(due, key=lambda entry: entry[1].priority) if due else None
+
+    async def put(self, job):
+        async with self._changed:
+            heapq.heappush(self._lane(job.lane), (job.lane_seq, job))
+            self._changed.notify_all()
+
+    async def skip(self, job):
+        async with self._changed:
+            self._lane(job.lane)
+            self._skipped[job.lane].add(job.lane_seq)
+            self._changed.notify_all()
+
+    async def get(self):
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._due_job() is not None)
+            lane_seq, job = self._due_job()
+            heapq.heappop(self._heaps[job.lane])
+            self._next[job.lane] += 1
+            self._changed.notify_all()
+            return job
+
+    def qsize(self):
+        return sum(len(heap) for heap in self._heaps.values())
+
+
+class IngestPipeline:
+    """
+    Runs messages from a LaneQueue through a chain of stages connected by bounded
+    queues, so a slow step (hashing, TMDB, a FloodWait while publishing) only
+    holds up its own stage. Full queues push back on the stage before them.
+    At most `max_in_flight` jobs (by default the capacity of all stage queues)
+    are between intake and their final state; a slot is taken when a job is
+    taken from the LaneQueue and given back when it finishes.
+    `await on_done(job, state, error)` runs once for every job.
+    """
+
+    def __init__(self, queue, stages, limiter, on_done, max_in_flight=None):
+        self.queue = queue
+        self.stages = stages
+        self.limiter = limiter
+        self.on_done = on_done
+        self.processed = 0
+        self.failed = 0
+        self.max_in_flight = max_in_flight or sum(stage.queue.maxsize for stage in stages)
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._in_flight = {}
+        self._seq = 0
+        self._lane_seq = {}
+        self._ordered_index = next((i for i, stage in enumerate(stages) if stage.ordered), None)
+        self._completed = deque()
+        self._tasks = []
+        self._intake_task = None
+
+    def start(self):
+        self._intake_task = asyncio.create_task(self._intake())
+        self._tasks.append(self._intake_task)
+        for index, stage in enumerate(self.stages):
+            for worker in range(stage.workers):
+                self._tasks.append(asyncio.create_task(self._worker(index, worker)))
+        logger.info("Ingest pipeline started: " + ", ".join(f"{stage.name} x{stage.workers}" for stage in self.stages))
+
+    async def _intake(self):
+        while True:
+            await self._slots.acquire()
+            message, lane = await self.queue.get()
+            lane_seq = self._lane_seq.get(lane, 0)
+            self._lane_seq[lane] = lane_seq + 1
+            job = IngestJob(self._seq, message, lane, self.queue.lanes.index(lane), lane_seq)
+            self._seq += 1
+            self._in_flight[job.seq] = job
+            try:
+                await self.stages[0].queue.put(job)
+            except asyncio.CancelledError:
+                # Stopped before the job entered the pipeline; its journal entry is requeued on the next start
+                self._in_flight.pop(job.seq, None)
+                self._slots.release()
+                raise
+
+    def stop_intake(self):
+        """Stops taking jobs from the LaneQueue; jobs already in the pipeline carry on."""
+        if self._intake_task is not None:
+            self._intake_task.cancel()
+            self._intake_task = None
+
+    def in_flight(self):
+        return len(self._in_flight)
+
+    async def _worker(self, index, worker):
+        stage = self.stages[index]
+        while True:
+            while stage.throttled and worker >= self.limiter.concurrency:
+                await asyncio.sleep(1)
+
+            job = await stage.queue.get()
+            stage.active += 1
+            try:
+                state = await stage.handler(job)
+            except Exception as e:
+                logger.error(f"Error in ingest stage {stage.name}: {e}", exc_info=True)
+                await self._finish(index, job, 'failed', str(e))
+                continue
+            finally:
+                stage.active -= 1
+            stage.processed += 1
+
+            if state is None and index + 1 < len(self.stages):
+                await self.stages[index + 1].queue.put(job)
+            elif isinstance(state, asyncio.Future):
+                asyncio.create_task(self._finish_deferred(index, job, state))
+            else:
+                await self._finish(index, job, state or 'failed')
+
+    async def _finish(self, index, job, state, error=None):
+        if self._ordered_index is not None and index < self._ordered_index:
+            await self.stages[self._ordered_index].queue.skip(job)
+        if self._in_flight.pop(job.seq, None) is not None:
+            self._slots.release()
+        try:
+            await self.on_done(job, state, error)
+        except Exception as e:
+            logger.error(f"Ingest on_done callback failed: {e}")
+        if state == 'failed':
+            self.failed += 1
+        else:
+            self.limiter.report_success()
+            self.processed += 1
+            self._completed.append(monotonic())
+
+    async def _finish_deferred(self, index, job, future):
+        try:
+            state = await future
+        except Exception as e:
+            await self._finish(index, job, 'failed', str(e))
+            return
+        await self._finish(index, job, state or 'failed')
+
+    def files_per_minute(self):
+        cutoff = monotonic() - 60
+        while self._completed and self._completed[0] < cutoff:
+            self._completed.popleft()
+        return len(self._completed)
+
+    def stats(self):
+        return {
+            'stages': [
+                {'name': stage.name, 'queued': stage.queue.qsize(), 'active': stage.active, 'workers': stage.workers, 'processed': stage.processed}
+                for stage in self.stages
+            ],
+            'active': sum(stage.active for stage in self.stages),
+            'in_flight': len(self._in_flight),
+            'max_in_flight': self.max_in_flight,
+            'concurrency': self.limiter.concurrency,
+            'files_per_minute': self.files_per_minute(),
+            'rate': self.limiter.rate,
+            'max_rate': self.limiter.max_rate,
+            'flood_waits': self.limiter.flood_waits,
+            'last_flood_wait': self.limiter.last_flood_wait,
+            'processed': self.processed,
+            'failed': self.failed,
+            'queued': self.queue.qsize(),
+            'lanes': self.queue.stats()
+        }
+
+
+class GroupingWindow:
+    """
+    Holds consecutive jobs that share a key until no further match arrives for
+    `window` seconds (or `max_size` jobs are held), then hands them to
+    `post(jobs)` at once. add() returns a future for the job's final state.
+    """
+
+    def __init__(self, window, max_size, post):
+        self.window = window
+        self.max_size = max(1, max_size)
+        self.post = post
+        self.groups_posted = 0
+        self.jobs_grouped = 0
+        self._key = None
+        self._jobs = []
+        self._futures = []
+        self._timer = None
+        self._lock = asyncio.Lock()
+
+    async def add(self, key, job):
+        async with self._lock:
+            if self._jobs and key != self._key:
+                await self._flush_locked()
+            future = asyncio.get_running_loop().create_future()
+            self._key = key
+            self._jobs.append(job)
+            self._futures.append(future)
+            if len(self._jobs) >= self.max_size:
+                await self._flush_locked()
+            else:
+                if self._timer is not None:
+                    self._timer.cancel()
+                self._timer = asyncio.create_task(self._expire())
+            return future
+
+    async def flush(self):
+        async with self._lock:
+            await self._flush_locked()
+
+    async def _expire(self):
+        await asyncio.sleep(self.window)
+        # The timer is only cleared under the lock, so a job added meanwhile can't open a second window
+        async with self._lock:
+            if self._timer is asyncio.current_task():
+                self._timer = None
+                await self._flush_locked()
+
+    async def _flush_locked(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        jobs, futures = self._jobs, self._futures
+        self._key, self._jobs, self._futures = None, [], []
+        if not jobs:
+            return
+
+        try:
+            state = await self.post(jobs)
+        except Exception as e:
+            logger.error(f"Failed to publish a group of {len(jobs)} files: {e}", exc_info=True)
+            state = 'failed'
+        if len(jobs) > 1:
+            self.groups_posted += 1
+            self.jobs_grouped += len(jobs)
+        for future in futures:
+            if not future.done():
+                future.set_result(state)
+
+
+class IngestJournal:
+    """
+    Persistent ingest queue backed by the `ingest_journal` collection.
+    Pending DB_CHANNEL message ids are leased in batches, fetched with one
+    get_messages call per batch and fed to the in-memory queue as it drains.
+    State changes are buffered and written back in bulk. Leases of messages
+    that are still queued or in the pipeline are renewed until they finish,
+    and a message already held is never fed a second time.
+    """
+
+    def __init__(self, client, channel_id, queue, batch_size=100, lease_seconds=900, flush_interval=2, precheck=None):
+        self.client = client
+        self.channel_id = channel_id
+        self.queue = queue
+        self.precheck = precheck # async callable(messages) -> messages that still need processing
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.flush_interval = flush_interval
+        self.owner = uuid.uuid4().hex
+        self._updates = []
+        self._prechecked = set()
+        self._held = set() # Message ids queued or in the pipeline, until their final state
+        self._renewed = monotonic()
+        self._wake = asyncio.Event()
+
+    async def recover(self):
+        requeued = await requeue_stale_ingest_entries()
+        if requeued:
+            logger.info(f"Ingest journal: {requeued} unfinished entries from the previous run were requeued.")
+
+    async def add_live(self, message):
+        """Journals a live upload and hands it to the workers without refetching it."""
+        await add_ingest_entries([message.id], 'live', self.owner, self.lease_seconds)
+        self._held.add(message.id)
+        await self.queue.put(message, 'live')
+
+    async def add_range(self, message_ids, source='index'):
+        count = await add_ingest_entries(list(message_ids), source)
+        self._wake.set()
+        return count
+
+    @staticmethod
+    def lane_for(entry):
+        """Live uploads recovered from the journal stay in the live lane, retries go to maintenance."""
+        if entry.get('attempts', 1) > 1:
+            return 'maintenance'
+        return 'live' if entry.get('source') == 'live' else 'backfill'
+
+    def take_prechecked(self, message_id):
+        """True (once) if the message already passed the batch duplicate pre-check."""
+        if message_id in self._prechecked:
+            self._prechecked.discard(message_id)
+            return True
+        return False
+
+    def mark(self, message_id, state, error=None):
+        if state in JOURNAL_FINAL_STATES:
+            self._held.discard(message_id)
+        self._updates.append((message_id, state, error))
+
+    async def renew_leases(self):
+        """Renews the held leases once a third of the lease time has passed."""
+        if monotonic() - self._renewed < self.lease_seconds / 3:
+            return
+        self._renewed = monotonic()
+        try:
+            await renew_ingest_leases(self.owner, self._held, self.lease_seconds)
+        except Exception as e:
+            logger.error(f"Ingest journal: failed to renew {len(self._held)} leases: {e}")
+
+    async def flush(self):
+        updates, self._updates = self._updates, []
+        if not updates:
+            return
+        try:
+            await update_ingest_states(updates)
+        except Exception as e:
+            logger.error(f"Ingest journal: failed to write {len(updates)} state updates: {e}")
+            self._updates = updates + self._updates
+
+    async def _idle(self):
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+        except asyncio.TimeoutError:
+            pass
+        self._wake.clear()
+
+    async def run(self):
+        logger.info("Task started: ingest journal feeder")
+        while True:
+            try:
+                await self.flush()
+                await self.renew_leases()
+
+                # Only lease more work once the workers have drained the queue
+                if self.queue.qsize() >= self.batch_size:
+                    await self._idle()
+                    continue
+
+                entries = await lease_ingest_entries(self.owner, self.batch_size, self.lease_seconds)
+                if not entries:
+                    await self._idle()
+                    continue
+
+                # An expired lease can come back while its message is still held here
+                entries = [entry for entry in entries if entry['_id'] not in self._held]
+                if not entries:
+                    await self._idle()
+                    continue
+
+                messages = await self.client.get_messages(self.channel_id, [entry['_id'] for entry in entries])
+                lanes = {entry['_id']: self.lane_for(entry) for entry in entries}
+                found = []
+                for message in messages:
+                    # Deleted ids and service/text messages never reach the workers
+                    if message.empty:
+                        self.mark(message.id, 'skipped', 'Message not found')
+                    elif not (message.document or message.video or message.audio or message.sticker):
+                        self.mark(message.id, 'skipped', 'No media')
+                    else:
+                        found.append(message)
+
+                if self.precheck and found:
+                    found = await self.precheck(found)
+                    self._prechecked.update(message.id for message in found)
+
+                for message in found:
+                    self._held.add(message.id)
+                    await self.queue.put(message, lanes.get(message.id, 'backfill'))
+            except FloodWait as e:
+                notify_flood_wait(e.value)
+                await asyncio.sleep(e.value)
+            except Exception as e:
+                logger.error(f"Error in ingest journal feeder: {e}", exc_info=True)
+                await asyncio.sleep(5)
+
+    async def stats(self, first_id=None, last_id=None):
+        return await get_ingest_journal_stats(first_id, last_id)
+
@@ -0,0 +1,76 @@
+import sys
+import asyncio
+from time import perf_counter
+import database
+from database import claim_file_quota, increment_files_shared_today, flush_daily_stats, get_daily_stats
+from config import MONGO_DB_NAME
+
+# Benchmark of the per-delivery quota writes: python3 quota_benchmark.py [deliveries] [concurrency]
+# Runs against a scratch database next to MONGO_DB_NAME, which is dropped afterwards.
+
+USERS = 50
+DAILY_LIMIT = 10
+
+
+async def sequential_writes(user_id, cache):
+    """The old path, replayed: limit checked from the cache, then the two separate writes it made."""
+    if cache[user_id] >= DAILY_LIMIT:
+        return False
+    await database.user_data.update_one({'_id': user_id}, {'$inc': {'file_count': 1}})
+    await database.daily_stats.update_one({'_id': database.STATS_ID}, {'$inc': {'files_shared_today': 1}}, upsert=True)
+    cache[user_id] += 1
+    return True
+
+async def atomic_claim(user_id, cache):
+    """The shipped path: claim_file_quota(), then the buffered daily stats increment."""
+    current_count = await claim_file_quota(user_id, DAILY_LIMIT)
+    if current_count is None:
+        return False
+    cache[user_id] = current_count
+    await increment_files_shared_today()
+    return True
+
+async def files_shared(path):
+    if path is sequential_writes:
+        doc = await database.daily_stats.find_one({'_id': database.STATS_ID}) or {}
+        return doc.get('files_shared_today', 0)
+    await flush_daily_stats()
+    return (await get_daily_stats())['files_shared_today']
+
+async def run(db, path, deliveries, concurrency):
+    await db['users'].delete_many({})
+    await db['daily_stats'].delete_many({})
+    await db['users'].insert_many([{'_id': user_id, 'file_count': 0} for user_id in range(USERS)])
+    cache = {user_id: 0 for user_id in range(USERS)}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def deliver(n):
+        async with semaphore:
+            return await path(n % USERS, cache)
+
+    start = perf_counter()
+    delivered = sum(await asyncio.gather(*(deliver(n) for n in range(deliveries))))
+    elapsed = perf_counter() - start
+    shared = await files_shared(path)
+    over_limit = await db['users'].count_documents({'file_count': {'$gt': DAILY_LIMIT}})
+    print(f"{path.__name__}: {deliveries / elapsed:,.0f} deliveries/s, {delivered} delivered, {shared} counted in daily stats, {over_limit} users over the limit")
+
+async def main():
+    deliveries = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    db_name = f"{MONGO_DB_NAME}_quota_benchmark"
+    db = database.async_client[db_name]
+
+    # The database functions run on the scratch collections only
+    database.user_data = db['users']
+    database.user_data_2 = None
+    database.daily_stats = db['daily_stats']
+    try:
+        for path in (sequential_writes, atomic_claim):
+            await run(db, path, deliveries, concurrency)
+    finally:
+        await database.async_client.drop_database(db_name)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
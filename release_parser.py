@@ -0,0 +1,104 @@
+import re
+import sys
+from functools import lru_cache
+from time import perf_counter
+from typing import NamedTuple, Optional
+
+# Compiled once; every caption goes through the same patterns
+EXTENSION_PATTERN = re.compile(r'\.(mkv|mp4|webm|avi|m4v|mov|ts)$', re.IGNORECASE)
+SEPARATOR_PATTERN = re.compile(r'[._]+')
+BRACKET_PATTERN = re.compile(r'[\(\)\[\]\{\}]')
+SPACE_PATTERN = re.compile(r'\s{2,}')
+YEAR_PATTERN = re.compile(r'(?<!\d)(19\d{2}|20\d{2})(?![\dp])', re.IGNORECASE)
+SEASON_EPISODE_PATTERN = re.compile(r'\bS(\d{1,2}) ?E(\d{1,4})\b', re.IGNORECASE)
+SEASON_PATTERN = re.compile(r'\b(?:S|Season ?)(\d{1,2})\b', re.IGNORECASE)
+EPISODE_PATTERN = re.compile(r'\b(?:EP?|Episode ?)(\d{1,4})\b', re.IGNORECASE)
+RESOLUTION_PATTERN = re.compile(r'\b(2160p|1440p|1080p|720p|576p|480p|360p|4k)\b', re.IGNORECASE)
+CODEC_PATTERN = re.compile(r'\b(x26[45]|h ?26[45]|hevc|avc|av1|vp9|xvid|divx)\b', re.IGNORECASE)
+# Release tags that never belong to a title
+TAG_PATTERN = re.compile(r'\b(web-?dl|webrip|bluray|brrip|hdrip|dvdrip|hdtv|remux|proper|repack|hindi|dual audio|esub)\b', re.IGNORECASE)
+
+
+class ReleaseInfo(NamedTuple):
+    title: Optional[str]
+    year: Optional[str]
+    season: Optional[int]
+    episode: Optional[int]
+    resolution: Optional[str]
+    codec: Optional[str]
+
+    @property
+    def episode_label(self):
+        """S01E02 / E02 / S01, or None for movies."""
+        if self.season is not None and self.episode is not None:
+            return f"S{self.season:02d}E{self.episode:02d}"
+        if self.episode is not None:
+            return f"E{self.episode:02d}"
+        if self.season is not None:
+            return f"S{self.season:02d}"
+        return None
+
+
+def strip_extension(caption):
+    return EXTENSION_PATTERN.sub('', caption.strip())
+
+@lru_cache(maxsize=4096)
+def parse_release(caption):
+    """
+    Splits a release name such as "Show.Name.S01E03.2021.1080p.x265.mkv" into
+    title, year, season, episode, resolution and codec. The title is the text
+    before the first release token. Results are memoized per caption.
+    """
+    if not caption:
+        return ReleaseInfo(None, None, None, None, None, None)
+
+    text = SPACE_PATTERN.sub(' ', BRACKET_PATTERN.sub(' ', SEPARATOR_PATTERN.sub(' ', strip_extension(caption)))).strip()
+
+    year = YEAR_PATTERN.search(text)
+    season_episode = SEASON_EPISODE_PATTERN.search(text)
+    season = None if season_episode else SEASON_PATTERN.search(text)
+    episode = None if season_episode else EPISODE_PATTERN.search(text)
+    resolution = RESOLUTION_PATTERN.search(text)
+    codec = CODEC_PATTERN.search(text)
+    tag = TAG_PATTERN.search(text)
+
+    tokens = [m for m in (year, season_episode, season, episode, resolution, codec, tag) if m]
+    title_end = min((m.start() for m in tokens), default=len(text))
+    title = text[:title_end].strip(' -')
+    if not title and year:
+        # Titles that are a year themselves ("1917 2019 1080p")
+        title = year.group(1)
+        year = YEAR_PATTERN.search(text, year.end())
+
+    return ReleaseInfo(
+        title=title or None,
+        year=year.group(1) if year else None,
+        season=int(season_episode.group(1)) if season_episode else int(season.group(1)) if season else None,
+        episode=int(season_episode.group(2)) if season_episode else int(episode.group(1)) if episode else None,
+        resolution=resolution.group(1).lower() if resolution else None,
+        codec=codec.group(1).lower().replace(' ', '') if codec else None
+    )
+
+def parser_cache_stats():
+    info = parse_release.cache_info()
+    lookups = info.hits + info.misses
+    return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize, 'hit_rate': info.hits / lookups if lookups else 0.0}
+
+
+if __name__ == "__main__":
+    # Micro-benchmark: python3 release_parser.py captions.txt (one DB_CHANNEL caption per line)
+    with open(sys.argv[1], encoding='utf-8') as f:
+        captions = [line.strip() for line in f if line.strip()]
+
+    start = perf_counter()
+    for caption in captions:
+        parse_release(caption)
+    elapsed = perf_counter() - start
+    stats = parser_cache_stats()
+    print(f"{len(captions)} captions in {elapsed * 1000:.1f} ms ({len(captions) / elapsed:,.0f}/s), cache hit rate {stats['hit_rate']:.1%}")
+
+    start = perf_counter()
+    for caption in captions:
+        parse_release.__wrapped__(caption)
+    elapsed = perf_counter() - start
+    print(f"Uncached: {len(captions) / elapsed:,.0f}/s")
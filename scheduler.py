@@ -0,0 +1,129 @@
+import asyncio
+import heapq
+import logging
+from collections import defaultdict
+from time import time as tm
+from pyrogram.errors import FloodWait
+from database import add_scheduled_deletions, load_scheduled_deletions, remove_scheduled_deletions
+
+logger = logging.getLogger(__name__)
+
+# Telegram accepts up to 100 message ids per delete_messages call
+DELETE_BATCH_SIZE = 100
+# Deletions falling due within this many seconds of each other share a batch
+DELETE_COALESCE_WINDOW = 1
+
+
+class DeletionScheduler:
+    """
+    Deletes messages at a later time without keeping a handler waiting.
+    Pending deletions live in a timer heap and in the `scheduled_deletions`
+    collection, so they survive restarts. Messages that fall due together are
+    removed with one delete_messages call per chat.
+    """
+
+    def __init__(self):
+        self.client = None
+        self._heap = [] # (due_at, chat_id, message_id)
+        self._pending = {} # (chat_id, message_id) -> due_at of the heap entry that deletes it
+        self._wake = asyncio.Event()
+        self._task = None
+        self.deleted = 0
+        self.failed = 0
+        self.batches = 0
+
+    async def schedule(self, chat_id, message_ids, delay):
+        """Registers the messages for deletion in `delay` seconds and returns immediately."""
+        due_at = tm() + delay
+        entries = [(due_at, chat_id, message_id) for message_id in message_ids if message_id]
+        if not entries:
+            return
+        earliest = self._heap[0][0] if self._heap else None
+        for entry in entries:
+            # A message scheduled twice keeps its earliest due time, as add_scheduled_deletions() does
+            if self._pending.get(entry[1:], due_at) >= due_at:
+                self._pending[entry[1:]] = due_at
+                heapq.heappush(self._heap, entry)
+        if earliest is None or due_at < earliest:
+            self._wake.set()
+        try:
+            await add_scheduled_deletions(entries)
+        except Exception as e:
+            logger.error(f"Could not persist scheduled deletion of {len(entries)} messages in {chat_id}: {e}")
+
+    async def start(self, client):
+        """Loads the deletions left over by the previous run and starts the timer task."""
+        self.client = client
+        try:
+            stored = await load_scheduled_deletions()
+        except Exception as e:
+            logger.error(f"Could not load scheduled deletions: {e}")
+            stored = []
+        for entry in stored:
+            if self._pending.get(entry[1:], entry[0]) >= entry[0]:
+                self._pending[entry[1:]] = entry[0]
+                self._heap.append(entry)
+        heapq.heapify(self._heap)
+        if stored:
+            logger.info(f"Deletion scheduler: {len(stored)} pending deletions restored.")
+        self._task = asyncio.create_task(self.run())
+        return self._task
+
+    def _pop_due(self, now):
+        """Pops every deletion due by now (plus the coalesce window), grouped per chat."""
+        due = defaultdict(list)
+        while self._heap and self._heap[0][0] <= now + DELETE_COALESCE_WINDOW:
+            due_at, chat_id, message_id = heapq.heappop(self._heap)
+            # Entries superseded by an earlier due time are skipped
+            if self._pending.get((chat_id, message_id)) == due_at:
+                del self._pending[(chat_id, message_id)]
+                due[chat_id].append(message_id)
+        return due
+
+    async def _wait(self):
+        timeout = self._heap[0][0] - tm() if self._heap else None
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wake.clear()
+
+    async def _delete_batch(self, chat_id, message_ids):
+        while True:
+            try:
+                await self.client.delete_messages(chat_id, message_ids)
+                self.deleted += len(message_ids)
+                break
+            except FloodWait as e:
+                logger.warning(f"Deletion scheduler: FloodWait of {e.value}s.")
+                await asyncio.sleep(e.value * 1.2)
+            except Exception as e:
+                # Blocked bot, deleted chat or messages already gone: nothing left to retry
+                logger.warning(f"Deletion scheduler: could not delete {len(message_ids)} messages in {chat_id}: {e}")
+                self.failed += len(message_ids)
+                break
+        self.batches += 1
+        try:
+            await remove_scheduled_deletions(chat_id, message_ids)
+        except Exception as e:
+            logger.error(f"Could not clear scheduled deletions in {chat_id}: {e}")
+
+    async def run(self):
+        logger.info("Task started: deletion scheduler")
+        while True:
+            try:
+                if not self._heap or self._heap[0][0] > tm():
+                    await self._wait()
+                    continue
+                for chat_id, message_ids in self._pop_due(tm()).items():
+                    for i in range(0, len(message_ids), DELETE_BATCH_SIZE):
+                        await self._delete_batch(chat_id, message_ids[i:i + DELETE_BATCH_SIZE])
+            except Exception as e:
+                logger.error(f"Error in deletion scheduler: {e}")
+                await asyncio.sleep(1)
+
+    def stats(self):
+        return {'pending': len(self._pending), 'deleted': self.deleted, 'failed': self.failed, 'batches': self.batches}
+
+
+deletion_scheduler = DeletionScheduler()
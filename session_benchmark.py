@@ -0,0 +1,99 @@
+import sys
+import asyncio
+from time import perf_counter, time as tm
+import database
+from user_session import UserSessionStore
+
+# Latency benchmark of the /start user lookups: python3 session_benchmark.py [rtt_ms] [users]
+# The users and banned_users collections are replaced by an in-process stand-in that
+# answers after a fixed round-trip time, so no real database is touched.
+
+
+class Result:
+    def __init__(self, matched_count):
+        self.matched_count = matched_count
+
+
+class FakeCollection:
+    def __init__(self, rtt, docs=None):
+        self.rtt = rtt
+        self.docs = docs or {}
+        self.calls = 0
+
+    async def find_one(self, query):
+        self.calls += 1
+        await asyncio.sleep(self.rtt)
+        return self.docs.get(query['_id'])
+
+    async def delete_one(self, query):
+        self.calls += 1
+        await asyncio.sleep(self.rtt)
+        self.docs.pop(query['_id'], None)
+
+    async def update_one(self, query, update):
+        self.calls += 1
+        await asyncio.sleep(self.rtt)
+        doc = self.docs.get(query['_id'])
+        if doc is not None:
+            doc.update(update.get('$set', {}))
+        return Result(int(doc is not None))
+
+
+async def old_start_path(user_id):
+    """
+    The /start lookups before sessions, replayed query by query:
+    present_user(), is_user_banned() and get_user_data(), each trying DB1 before DB2.
+    """
+    users, users_2, bans = database.user_data, database.user_data_2, database.banned_users
+
+    if not await users.find_one({'_id': user_id}):
+        await users_2.find_one({'_id': user_id})
+
+    # A ban that ran out was deleted and the bypass attempts reset on the spot
+    ban = await bans.find_one({'_id': user_id})
+    if ban and tm() >= ban.get('ban_until', 0):
+        await bans.delete_one({'_id': user_id})
+        res = await users.update_one({'_id': user_id}, {'$set': {'bypass_attempts': 0}})
+        if res.matched_count == 0:
+            await users_2.update_one({'_id': user_id}, {'$set': {'bypass_attempts': 0}})
+
+    user = await users.find_one({'_id': user_id})
+    if not user:
+        user = await users_2.find_one({'_id': user_id})
+    return user
+
+def collections():
+    return (database.user_data, database.user_data_2, database.user_directory, database.banned_users)
+
+async def measure(name, lookup, user_ids):
+    calls_before = sum(c.calls for c in collections())
+    start = perf_counter()
+    for user_id in user_ids:
+        await lookup(user_id)
+    elapsed = perf_counter() - start
+    calls = sum(c.calls for c in collections()) - calls_before
+    print(f"{name}: {elapsed / len(user_ids) * 1000:.2f} ms per /start, {calls / len(user_ids):.1f} queries")
+
+async def main():
+    rtt = (float(sys.argv[1]) if len(sys.argv) > 1 else 5) / 1000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    # Half of the users live in the second database, where the old path pays for a miss on DB1 first.
+    # Every 20th user has a ban that ran out, which the old path cleaned up during /start.
+    database.user_data = FakeCollection(rtt, {user_id: {'_id': user_id} for user_id in range(0, users, 2)})
+    database.user_data_2 = FakeCollection(rtt, {user_id: {'_id': user_id} for user_id in range(1, users, 2)})
+    database.user_directory = FakeCollection(rtt, {user_id: {'_id': user_id} for user_id in range(1, users, 2)})
+    database.banned_users = FakeCollection(rtt, {user_id: {'_id': user_id, 'ban_until': tm() - 60} for user_id in range(0, users, 20)})
+    user_ids = list(range(users))
+
+    store = UserSessionStore()
+    await measure("sequential lookups (before sessions)", old_start_path, user_ids)
+    await measure("session, cold", store.get, user_ids)
+    await measure("session, cached", store.get, user_ids)
+
+    # The shards learned on the first cold pass send every later load to the database holding the user
+    await measure("session, cold, shards cached", UserSessionStore().get, user_ids)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
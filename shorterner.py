@@ -1,5 +1,5 @@
-import aiohttp
 from config import *
+from http_client import get_http_session
 
 async def shorten_url(url, base_site=None, api_token=None):
     try:
@@ -13,15 +13,15 @@ async def shorten_url(url, base_site=None, api_token=None):
             "format": "text"
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(api_url, params=params) as response:
-                if response.status == 200:
-                    return (await response.text()).strip()
-                else:
-                    logger.error(
-                        f"URL shortening failed. Status code: {response.status}, Response: {await response.text()}"
-                    )
-                    return url
+        session = await get_http_session()
+        async with session.get(api_url, params=params) as response:
+            if response.status == 200:
+                return (await response.text()).strip()
+            else:
+                logger.error(
+                    f"URL shortening failed. Status code: {response.status}, Response: {await response.text()}"
+                )
+                return url
     except Exception as e:
         logger.error(f"URL shortening failed: {e}")
         return url
@@ -1,44 +1,129 @@
-import aiohttp
+import re
+import asyncio
+from http_client import get_http_session
 from config import *
+from utils import LRUCache
+from database import get_tmdb_cache, set_tmdb_cache
+
+# Posters rarely change; titles without a match are retried after a day
+TMDB_CACHE_TTL = 30 * 24 * 60 * 60
+TMDB_NEGATIVE_CACHE_TTL = 24 * 60 * 60
+
+tmdb_memory_cache = LRUCache(maxsize=2048)
+tmdb_cache_stats = {'memory_hits': 0, 'db_hits': 0, 'negative_hits': 0, 'coalesced': 0, 'misses': 0, 'errors': 0}
+
+# Lookups in flight, shared by concurrent callers asking for the same title
+_inflight = {}
+
+def tmdb_cache_key(movie_name, release_year):
+    """Normalized (title, year) key so case and punctuation differences share one entry."""
+    title = re.sub(r'[\W_]+', ' ', str(movie_name).lower()).strip()
+    return f"{title}|{release_year or ''}"
 
 async def get_by_name(movie_name, release_year):
+    """
+    Returns the TMDB poster/backdrop URL for a title, or None.
+    Answers come from the in-process LRU, then the tmdb_cache collection and
+    only then from TMDB itself; concurrent lookups for one title share a request.
+    """
+    if not TMDB_API_KEY:
+        return None
+
+    key = tmdb_cache_key(movie_name, release_year)
+    poster_url = tmdb_memory_cache.get(key)
+    if poster_url is not LRUCache.MISSING:
+        tmdb_cache_stats['memory_hits'] += 1
+        if poster_url is None:
+            tmdb_cache_stats['negative_hits'] += 1
+        return poster_url
+
+    if key in _inflight:
+        tmdb_cache_stats['coalesced'] += 1
+        return await asyncio.shield(_inflight[key])
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        poster_url = await _lookup(key, movie_name, release_year)
+        future.set_result(poster_url)
+        return poster_url
+    except Exception as e:
+        future.set_result(None)
+        logger.error(f"Error fetching TMDb ID: {e}")
+        return None
+    finally:
+        if not future.done():
+            future.cancel()
+        del _inflight[key]
+
+async def _lookup(key, movie_name, release_year):
+    try:
+        doc = await get_tmdb_cache(key)
+    except Exception as e:
+        logger.warning(f"TMDB cache read failed: {e}")
+        doc = None
+    if doc:
+        tmdb_cache_stats['db_hits'] += 1
+        if doc['poster_url'] is None:
+            tmdb_cache_stats['negative_hits'] += 1
+        tmdb_memory_cache.set(key, doc['poster_url'], ttl=TMDB_NEGATIVE_CACHE_TTL if doc['poster_url'] is None else TMDB_CACHE_TTL)
+        return doc['poster_url']
+
+    tmdb_cache_stats['misses'] += 1
+    try:
+        poster_url = await fetch_poster(movie_name, release_year)
+    except Exception:
+        # Failed requests are not cached, the next upload tries again
+        tmdb_cache_stats['errors'] += 1
+        raise
+
+    ttl = TMDB_NEGATIVE_CACHE_TTL if poster_url is None else TMDB_CACHE_TTL
+    tmdb_memory_cache.set(key, poster_url, ttl=ttl)
+    try:
+        await set_tmdb_cache(key, poster_url, ttl)
+    except Exception as e:
+        logger.warning(f"TMDB cache write failed: {e}")
+    return poster_url
+
+async def fetch_poster(movie_name, release_year):
     tmdb_search_url = f'https://api.themoviedb.org/3/search/multi?api_key={TMDB_API_KEY}&query={movie_name}'
-    if TMDB_API_KEY:
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(tmdb_search_url) as search_response:
-                    search_data = await search_response.json()
-
-                    if search_data['results']:
-                        matching_results = [
-                            result for result in search_data['results']
-                            if ('release_date' in result and result['release_date'][:4] == str(release_year)) or
-                            ('first_air_date' in result and result['first_air_date'][:4] == str(release_year))
-                        ]
-
-                        if matching_results:
-                            result = matching_results[0]
-                            media_type = result['media_type']
-                            tmdb_id = result['id']
-                            
-                            tmdb_movie_image_url = f'https://api.themoviedb.org/3/{media_type}/{tmdb_id}/images?api_key={TMDB_API_KEY}&language=en-US&include_image_language=en,hi'
-
-                            async with session.get(tmdb_movie_image_url) as movie_response:
-                                movie_images = await movie_response.json()
-                            # Use the backdrop_path or poster_path
-                                poster_path = None
-                                if 'backdrops' in movie_images and movie_images['backdrops']:
-                                    poster_path = movie_images['backdrops'][0]['file_path']
-                                                            
-                                elif 'poster_path' in result and result['poster_path']:
-                                    poster_path = result['poster_path']
-
-                                poster_url = f"https://image.tmdb.org/t/p/original{poster_path}"
-
-                            return poster_url
-
-            return None  # No matching results found
-        except Exception as e:
-            logger.error(f"Error fetching TMDb ID: {e}")
-            return None
-    return None
+    session = await get_http_session()
+    async with session.get(tmdb_search_url) as search_response:
+        search_data = await search_response.json()
+
+    if not search_data['results']:
+        return None  # No matching results found
+
+    matching_results = [
+        result for result in search_data['results']
+        if ('release_date' in result and result['release_date'][:4] == str(release_year)) or
+        ('first_air_date' in result and result['first_air_date'][:4] == str(release_year))
+    ]
+    if not matching_results:
+        return None
+
+    result = matching_results[0]
+    media_type = result['media_type']
+    tmdb_id = result['id']
+
+    tmdb_movie_image_url = f'https://api.themoviedb.org/3/{media_type}/{tmdb_id}/images?api_key={TMDB_API_KEY}&language=en-US&include_image_language=en,hi'
+    async with session.get(tmdb_movie_image_url) as movie_response:
+        movie_images = await movie_response.json()
+
+    # Use the backdrop_path or poster_path
+    poster_path = None
+    if 'backdrops' in movie_images and movie_images['backdrops']:
+        poster_path = movie_images['backdrops'][0]['file_path']
+    elif 'poster_path' in result and result['poster_path']:
+        poster_path = result['poster_path']
+
+    if not poster_path:
+        return None
+    return f"https://image.tmdb.org/t/p/original{poster_path}"
+
+def get_tmdb_cache_stats():
+    stats = dict(tmdb_cache_stats)
+    lookups = stats['memory_hits'] + stats['db_hits'] + stats['coalesced'] + stats['misses']
+    stats['hit_rate'] = (lookups - stats['misses']) / lookups if lookups else 0.0
+    stats['memory_entries'] = len(tmdb_memory_cache)
+    return stats
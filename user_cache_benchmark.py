@@ -0,0 +1,72 @@
+import sys
+import random
+import tracemalloc
+from time import perf_counter
+from utils import LRUCache
+from user_session import UserSession
+
+# Memory/startup benchmark of the user cache: python3 user_cache_benchmark.py [users ...] [--active 0.05]
+# Synthetic users only, no database is touched. Compares preloading every user into a
+# dict of dicts (the former load_all_user_data) with lazily loaded slotted sessions.
+
+CACHE_SIZE = 10000
+
+
+def synthetic_doc(user_id):
+    return {
+        '_id': user_id, 'token': f"{user_id:032x}", 'time': 1700000000.0 + user_id, 'status': 'verified',
+        'file_count': user_id % 10, 'extension_stage': 0, 'inittime': 1700000000.0 + user_id, 'bypass_attempts': 0
+    }
+
+def preload_all(users):
+    """What startup used to do: every user of both databases into a dict of 7-key dicts."""
+    all_user_data = {}
+    for user_id in range(users):
+        user = synthetic_doc(user_id)
+        all_user_data[user['_id']] = {
+            'token': user.get('token'),
+            'time': user.get('time', 0),
+            'status': user.get('status', 'unverified'),
+            'file_count': user.get('file_count', 0),
+            'extension_stage': user.get('extension_stage', 0),
+            'inittime': user.get('inittime', 0),
+            'bypass_attempts': user.get('bypass_attempts', 0)
+        }
+    return all_user_data
+
+def lazy_sessions(users, active):
+    """Nothing at startup; the day's active users are loaded into a bounded LRU of slotted sessions."""
+    cache = LRUCache(maxsize=CACHE_SIZE, ttl=300)
+    for user_id in random.Random(0).sample(range(users), active):
+        cache.set(user_id, UserSession(user_id, synthetic_doc(user_id)))
+    return cache
+
+def measure(name, build, *args):
+    tracemalloc.start()
+    start = perf_counter()
+    result = build(*args)
+    elapsed = perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"  {name:<30} {elapsed:7.2f} s {current / 1024 / 1024:9.1f} MB  ({len(result)} users held)")
+    del result
+
+def main():
+    args = sys.argv[1:]
+    active_share = 0.05
+    if '--active' in args:
+        index = args.index('--active')
+        active_share = float(args[index + 1])
+        del args[index:index + 2]
+    sizes = [int(arg) for arg in args] or [100_000, 1_000_000]
+
+    for users in sizes:
+        active = int(users * active_share)
+        print(f"{users:,} users, {active:,} active:")
+        measure("preload dict of dicts", preload_all, users)
+        measure("lazy slotted LRU, startup", lazy_sessions, users, 0)
+        measure("lazy slotted LRU, after a day", lazy_sessions, users, active)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+from utils import LRUCache
+from database import (
+    load_user_state, add_user, update_user_data, ban_user, unban_user, increment_bypass_attempts, ban_registry
+)
+
+# Fields of a users document and their values for a fresh user
+USER_DEFAULTS = {
+    'token': None,
+    'time': 0,
+    'status': 'unverified',
+    'file_count': 0,
+    'extension_stage': 0,
+    'inittime': 0,
+    'bypass_attempts': 0,
+    'user_channel_id': None,
+    'user_channel_name': None
+}
+
+
+class UserSession:
+    """
+    Cached state of one user: the fields of their users document, from
+    whichever database holds it, as slotted attributes (session.status,
+    session.file_count, ...). Bans come from the ban registry.
+    """
+
+    __slots__ = ('user_id', 'exists') + tuple(USER_DEFAULTS)
+
+    def __init__(self, user_id, doc=None):
+        self.user_id = user_id
+        self.exists = doc is not None
+        doc = doc or {}
+        for field, default in USER_DEFAULTS.items():
+            setattr(self, field, doc.get(field, default))
+
+    @property
+    def is_banned(self):
+        return ban_registry.is_banned(self.user_id)
+
+    def apply(self, update):
+        """Mirrors an update_user_data() payload (plain fields or $set/$unset) on the cached fields."""
+        for field in update.get('$unset', {}):
+            if field in USER_DEFAULTS:
+                setattr(self, field, USER_DEFAULTS[field])
+        for field, value in update.get('$set', update).items():
+            if field in USER_DEFAULTS:
+                setattr(self, field, value)
+
+
+class UserSessionStore:
+    """
+    Loads a user's document from both databases in one concurrent pass when
+    the user is first seen, and keeps up to `maxsize` recently active users
+    for `ttl` seconds. Changes go to the database first and are then applied
+    to the cached session (write-through).
+    """
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self._cache = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, user_id, create=False):
+        """Returns the user's session; with create=True an unknown user is added first (as /start does)."""
+        session = self._cache.get(user_id, None)
+        if session is not None:
+            self.hits += 1
+            return session
+
+        self.misses += 1
+        doc = await load_user_state(user_id)
+        if doc is None and create:
+            await add_user(user_id)
+            doc = {}
+
+        session = UserSession(user_id, doc)
+        if session.exists:
+            self._cache.set(user_id, session)
+        return session
+
+    def peek(self, user_id):
+        """The cached session, if any, without touching the database."""
+        return self._cache.get(user_id, None)
+
+    async def update(self, user_id, update):
+        await update_user_data(user_id, update)
+        session = self.peek(user_id)
+        if session:
+            session.apply(update)
+
+    async def add_bypass_attempt(self, user_id):
+        """Counts a bypass attempt and returns the new total."""
+        session = await self.get(user_id)
+        await increment_bypass_attempts(user_id)
+        session.bypass_attempts += 1
+        return session.bypass_attempts
+
+    async def ban(self, user_id, ban_duration):
+        await ban_user(user_id, ban_duration)
+
+    async def unban(self, user_id):
+        await unban_user(user_id)
+        self.bans_expired([user_id])
+
+    def bans_expired(self, user_ids):
+        """Unbanning resets the bypass attempts in the database; mirror that on cached sessions."""
+        for user_id in user_ids:
+            session = self.peek(user_id)
+            if session:
+                session.bypass_attempts = 0
+
+    def invalidate(self, user_id):
+        self._cache.pop(user_id)
+
+    def clear(self):
+        """Drops every cached session (after all users were deleted)."""
+        self._cache.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'cached': len(self._cache), 'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
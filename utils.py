@@ -1,7 +1,11 @@
 import io
 import re
 import asyncio
+from collections import OrderedDict
+from time import monotonic
 from config import *
+from release_parser import parse_release
+from scheduler import deletion_scheduler
 from datetime import datetime, timedelta, time, timezone
 from zoneinfo import ZoneInfo
 from mutagen import File as MutagenFile
@@ -25,27 +29,31 @@ def seconds_until_midnight_ist() -> float:
     midnight = datetime.combine(tomorrow, time(0, 0, 0), tzinfo=tz_ist)
     return (midnight - now).total_seconds()
 
+UNWANTED_SPLIT_PATTERN = re.compile(r'(\.mkv|\.mp4)')
+EXTENSION_REMOVE_PATTERN = re.compile(r'\.mkv|\.mp4|\.webm')
+
 async def remove_unwanted(input_string):
     # Use regex to match .mkv or .mp4 and everything that follows
-    result = re.split(r'(\.mkv|\.mp4)', input_string)
+    result = UNWANTED_SPLIT_PATTERN.split(input_string)
     # Join the first two parts to get the string up to the extension
     return ''.join(result[:2])
 
 async def remove_extension(caption):
     try:
         # Remove .mkv and .mp4 extensions if present
-        cleaned_caption = re.sub(r'\.mkv|\.mp4|\.webm', '', caption)
+        cleaned_caption = EXTENSION_REMOVE_PATTERN.sub('', caption)
         return cleaned_caption
     except Exception as e:
         logger.error(e)
         return None
     
 async def auto_delete_message(user_message, bot_message, delay=60):
+    """Deletes the user's message now and schedules the bot's reply for deletion after `delay` seconds."""
     try:
         if user_message:
             await user_message.delete()
-        await asyncio.sleep(delay)
-        await bot_message.delete()
+        if bot_message:
+            await deletion_scheduler.schedule(bot_message.chat.id, [bot_message.id], delay)
     except Exception as e:
         logger.error(f"{e}")
 
@@ -84,17 +92,13 @@ def humanbytes(size):
     return f"{f} {suffixes[i]}"
 
 async def extract_movie_info(caption):
+    """Returns (title, year) for TMDB lookups, or (None, None) when the caption has no year."""
     try:
-        regex = re.compile(r'(.+?)(\d{4})')
-        match = regex.search(caption)
-
-        if match:
-            # Replace '.' and remove '(' and ')' from movie_name
-            movie_name = match.group(1).replace('.', ' ').replace('(', '').replace(')', '').strip()
-            release_year = match.group(2)
-            return movie_name, release_year
+        info = parse_release(caption)
+        if info.year:
+            return info.title, info.year
     except Exception as e:
-        print(e)
+        logger.error(e)
     return None, None
 
 
@@ -144,6 +148,57 @@ async def get_audio_thumbnail(audio_path):
             return io.BytesIO(cover)
     return None
 
+class LRUCache:
+    """Small in-process LRU cache whose entries expire after `ttl` seconds."""
+
+    MISSING = object()
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=MISSING):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        value, expires_at = entry
+        if expires_at is not None and expires_at < monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        self._data[key] = (value, monotonic() + ttl if ttl is not None else None)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return entry[0] if entry else default
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not LRUCache.MISSING
+
+    def __len__(self):
+        return len(self._data)
+
+# Callbacks notified with the wait duration whenever a FloodWait is hit
+flood_wait_listeners = []
+
+def notify_flood_wait(seconds):
+    for listener in flood_wait_listeners:
+        try:
+            listener(seconds)
+        except Exception as e:
+            logger.error(f"Flood wait listener failed: {e}")
+
 async def safe_api_call(coro_factory, max_retries=3):
     """Utility wrapper to add delay and retry for flood waits."""
     retries = 0
@@ -153,6 +208,7 @@ async def safe_api_call(coro_factory, max_retries=3):
         except (UserIsBlocked, InputUserDeactivated, PeerIdInvalid, UserIsBot) as e:
             raise e
         except FloodWait as e:
+            notify_flood_wait(e.value)
             retries += 1
             if retries < max_retries:
                 sleep_duration = e.value * 1.2